@@ -0,0 +1,107 @@
+''' Compares Model.to_json() with the implementation it replaced, which
+parsed the include spec and scanned the fields on every call. No redis
+server is needed, run it from the root of the repository with::
+
+    PYTHONPATH=. python benchmarks/to_json.py
+'''
+from coralillo import Engine, Model, fields
+from coralillo.core import get_fields
+from coralillo.fields import Relation, MultipleRelation, SingleRelation
+from coralillo.utils import parse_embed
+from datetime import datetime
+from itertools import starmap
+from timeit import timeit
+
+eng = Engine()
+
+
+class Truck(Model):
+    plate = fields.Text()
+    brand = fields.Text()
+    model = fields.Text()
+    color = fields.Text()
+    year = fields.Integer()
+    capacity = fields.Float()
+    active = fields.Bool()
+    registered = fields.Datetime()
+    secret = fields.Text(private=True)
+    fleet = fields.ForeignIdRelation('Fleet')
+
+    class Meta:
+        engine = eng
+
+
+def legacy_to_json(self, *, include=None):
+    json = dict()
+
+    if include is None or 'id' in include or '*' in include:
+        json['id'] = self.id
+
+    if include is None or '_type' in include or '*' in include:
+        json['_type'] = type(self).cls_key()
+
+    def fieldfilter(fieldtuple):
+        return \
+            not fieldtuple[1].private and \
+            not isinstance(fieldtuple[1], Relation) and (
+                include is None or fieldtuple[0] in include or '*' in include
+            )
+
+    json.update(dict(starmap(
+        lambda fn, f: (fn, f.to_json(getattr(self, fn))),
+        filter(
+            fieldfilter,
+            get_fields(type(self))
+        )
+    )))
+
+    for relation_name, subfields in parse_embed(include):
+        if not hasattr(type(self), relation_name):
+            continue
+
+        if not isinstance(getattr(type(self), relation_name), Relation):
+            continue
+
+        relation = getattr(self, relation_name)
+
+        if isinstance(getattr(type(self), relation_name), MultipleRelation):
+            json[relation_name] = list(map(lambda o: o.to_json(include=subfields), relation.all()))
+        elif isinstance(getattr(type(self), relation_name), SingleRelation):
+            related = relation.get()
+            json[relation_name] = related.to_json(include=subfields) if related is not None else None
+
+    return json
+
+
+def main():
+    trucks = [Truck(
+        id='truck{}'.format(i),
+        plate='ABC{}'.format(i),
+        brand='Volvo',
+        model='FH16',
+        color='red',
+        year=2015,
+        capacity=25.5,
+        active=True,
+        registered=datetime(2018, 5, 1),
+        secret='x',
+    ) for i in range(1000)]
+
+    specs = [
+        ('all fields', None),
+        ('some fields', ['id', 'plate', 'year', 'registered']),
+    ]
+
+    for name, include in specs:
+        assert [t.to_json(include=include) for t in trucks] == [legacy_to_json(t, include=include) for t in trucks]
+
+        legacy = timeit(lambda: [legacy_to_json(t, include=include) for t in trucks], number=20)
+        compiled = timeit(lambda: [t.to_json(include=include) for t in trucks], number=20)
+
+        print('{:12} legacy {:.1f}ms  compiled {:.1f}ms  {:.1f}x'.format(
+            name, legacy * 50, compiled * 50, legacy / compiled,
+        ))
+
+
+if __name__ == '__main__':
+    main()
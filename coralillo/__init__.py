@@ -1,5 +1,7 @@
 import redis
+from coralillo.errors import ImproperlyConfiguredError
 from coralillo.lua import Lua
+from coralillo.session import Session
 from uuid import uuid1
 
 
@@ -9,7 +11,7 @@ def uuid1_id():
 
 class Engine:
 
-    def __init__(self, id_function=uuid1_id, **kwargs):
+    def __init__(self, id_function=uuid1_id, cache=None, **kwargs):
         try:
             url = kwargs.pop('url')
 
@@ -19,6 +21,46 @@ class Engine:
 
         self.id_function = id_function
 
+        # an optional coralillo.cache.ObjectCache for the reads by id
+        self.cache = cache
+
+        self.lua = Lua(self.redis)
+
+    def session(self):
+        ''' Opens a unit of work where each object is loaded once and the
+        saves are written together when it ends::
+
+            with engine.session():
+                car = Car.get(id)
+                car.driver.get().name = 'juan'
+                car.driver.get().save()
+        '''
+        return Session(self)
+
+
+class AsyncEngine(Engine):
+    ''' An engine built on the asyncio client of redis-py. Models bound to it
+    use the awaitable variants of the API, like ``await Model.aget(id)``,
+    ``await obj.asave()`` or ``async for obj in Model.q()`` '''
+
+    def __init__(self, id_function=uuid1_id, cache=None, **kwargs):
+        try:
+            from redis import asyncio as aioredis
+        except ImportError:
+            raise ImproperlyConfiguredError(
+                'AsyncEngine needs redis-py 4.2 or newer'
+            )
+
+        try:
+            url = kwargs.pop('url')
+
+            self.redis = aioredis.Redis.from_url(url, **kwargs)
+        except KeyError:
+            self.redis = aioredis.Redis(**kwargs)
+
+        self.id_function = id_function
+        self.cache = cache
+
         self.lua = Lua(self.redis)
 
 
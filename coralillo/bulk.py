@@ -0,0 +1,101 @@
+from itertools import islice
+from time import monotonic
+
+# objects sent in the first pipeline when no chunk size is given
+DEFAULT_CHUNK_SIZE = 500
+
+# the chunk size is adapted so every pipeline takes about this many seconds
+TARGET_CHUNK_TIME = 0.1
+
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 10000
+
+
+class ChunkSize:
+    ''' The amount of objects to send in each pipeline. If not fixed it is
+    adapted after each pipeline to the measured time per object, so big
+    objects or slow connections use smaller pipelines '''
+
+    def __init__(self, size=None):
+        self.fixed = size is not None
+        self.size = size or DEFAULT_CHUNK_SIZE
+
+    def record(self, elapsed, count):
+        ''' Takes note of the time a pipeline of count objects took '''
+        if self.fixed or not count:
+            return
+
+        if elapsed <= 0:
+            self.size = MAX_CHUNK_SIZE
+            return
+
+        size = int(TARGET_CHUNK_TIME * count / elapsed)
+
+        # grow slowly so a single fast pipeline doesn't make the next one huge
+        size = min(MAX_CHUNK_SIZE, size, self.size * 2)
+
+        self.size = max(MIN_CHUNK_SIZE, size)
+
+
+def chunks(items, chunk_size):
+    ''' Splits the items in lists of the current chunk_size.size '''
+    items = iter(items)
+
+    while True:
+        chunk = list(islice(items, chunk_size.size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def execute_chunk(redis, chunk, queue, chunk_size):
+    ''' Calls queue(item, pipe) for every item of the chunk on a non
+    transactional pipeline and executes it. Returns two lists with, for each
+    item, None or the first error raised while queueing or executing its
+    commands, and the replies to its commands '''
+    pipe = redis.pipeline(transaction=False)
+    errors = []
+    counts = []
+
+    for item in chunk:
+        before = len(pipe)
+
+        try:
+            queue(item, pipe)
+        except Exception as e:
+            # drop the commands of the failed item
+            del pipe.command_stack[before:]
+            errors.append(e)
+        else:
+            errors.append(None)
+
+        counts.append(len(pipe) - before)
+
+    start = monotonic()
+    replies = iter(pipe.execute(raise_on_error=False))
+    chunk_size.record(monotonic() - start, len(chunk))
+    item_replies = []
+
+    for i, count in enumerate(counts):
+        item_replies.append(list(islice(replies, count)))
+
+        for reply in item_replies[-1]:
+            if errors[i] is None and isinstance(reply, Exception):
+                errors[i] = reply
+
+    return errors, item_replies
+
+
+def publish_all(redis, notifications):
+    ''' Publishes the given (channel, data) tuples in a single round trip '''
+    if not notifications:
+        return
+
+    pipe = redis.pipeline(transaction=False)
+
+    for channel, data in notifications:
+        pipe.publish(channel, data)
+
+    pipe.execute()
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from coralillo.datamodel import debyte_string
+from threading import Lock
+from time import monotonic
+
+# returned by ObjectCache.get() for keys that are not cached, since None is a
+# valid cached value
+MISSING = object()
+
+
+def model_prefix(key):
+    ''' Returns the key prefix of the model of the given object key '''
+    return key[:-len(':obj')].rsplit(':', 1)[0]
+
+
+class ObjectCache:
+    ''' An in-process least recently used cache of the data read by
+    ``Model.get()``, ``Model.get_many()`` and the relations, and of the ids
+    found by ``Model.get_by()``. Give it to the engine to use it::
+
+        engine = Engine(cache=ObjectCache(maxsize=10000, ttl=30))
+
+    Objects are cached under their key, absent objects and lookups without
+    result are cached too. The writes made through the models of this
+    process invalidate their entries, writes from other processes are seen
+    when the entries expire or, for models that notify, as soon as
+    ``listen()`` receives their events '''
+
+    def __init__(self, maxsize=1024, ttl=60, clock=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> (expiration, generation, value). The generation is only
+        # checked for lookups, which become stale when any object of their
+        # model changes
+        self.entries = OrderedDict()
+        self.generations = dict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def generation(self, prefix):
+        ''' Returns a number that changes every time an object of the model
+        with the given key prefix is invalidated '''
+        return self.generations.get(prefix, 0)
+
+    def get(self, key, prefix=None):
+        ''' Returns the value cached for the given key or MISSING. Values
+        stored with a prefix are only valid while its generation is the
+        same '''
+        with self.lock:
+            entry = self.entries.get(key)
+
+            stale = entry is not None and (
+                entry[0] <= self.clock() or (
+                    prefix is not None and
+                    entry[1] != self.generation(prefix)
+                )
+            )
+
+            if stale:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+
+                return MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[2]
+
+    def set(self, key, value, prefix, since):
+        ''' Caches the value read when the generation of the given prefix was
+        since. Nothing is cached if the model changed in the meantime '''
+        with self.lock:
+            if self.generation(prefix) != since:
+                return
+
+            self.entries[key] = (self.clock() + self.ttl, since, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        ''' Drops the given object key and the lookups of its model '''
+        with self.lock:
+            self.entries.pop(key, None)
+            self._invalidate_lookups(model_prefix(key))
+
+    def invalidate_lookups(self, prefix):
+        ''' Drops the lookups of the model with the given key prefix '''
+        with self.lock:
+            self._invalidate_lookups(prefix)
+
+    def _invalidate_lookups(self, prefix):
+        self.generations[prefix] = self.generation(prefix) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def handle(self, message):
+        ''' Invalidates the entries affected by a message published by a model
+        that notifies '''
+        channel = debyte_string(message['channel'])
+
+        if channel.endswith(':obj'):
+            self.invalidate(channel)
+        else:
+            self.invalidate_lookups(channel)
+
+    def listen(self, redis, sleep_time=0.01):
+        ''' Subscribes to the events of every model in a background thread,
+        which is returned. The given client must be a synchronous one '''
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+
+        pubsub.psubscribe(**{'*': self.handle})
+
+        return pubsub.run_in_thread(sleep_time=sleep_time, daemon=True)
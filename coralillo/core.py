@@ -1,28 +1,213 @@
 from coralillo.fields import Field, Relation, MultipleRelation, SingleRelation
+from coralillo.fields import model_from_spec
 from coralillo.datamodel import debyte_hash, debyte_string
-from coralillo.errors import ValidationErrors, UnboundModelError, BadField, ModelNotFoundError
+from coralillo.errors import ValidationErrors, UnboundModelError, BadField
+from coralillo.errors import ModelNotFoundError, NotUniqueFieldError
+from coralillo.errors import DeleteRestrictedError, ImproperlyConfiguredError
 from coralillo.utils import snake_case, parse_embed
 from coralillo.auth import PermissionHolder
-from coralillo.queryset import QuerySet
+from coralillo.queryset import QuerySet, SetExpression, DEFAULT_BATCH_SIZE
+from coralillo.bulk import ChunkSize, chunks, execute_chunk, publish_all
+from coralillo.session import Session
+from coralillo.cache import MISSING
 from coralillo import Engine
 from itertools import starmap
+from time import time
+from redis.exceptions import ResponseError
 import json
 import re
 
 
+class FieldTable:
+    ''' The field metadata of a form or model class. It is computed once per
+    class so operations don't need to scan the class with dir() '''
+
+    def __init__(self, cls):
+        self.fields = []
+        self.validation_rules = []
+
+        for name in dir(cls):
+            attr = getattr(cls, name)
+
+            if not name.startswith('_') and isinstance(attr, Field):
+                self.fields.append((name, attr))
+
+            if getattr(attr, '_is_validation_rule', False):
+                self.validation_rules.append(attr)
+
+        self.relation_fields = [
+            ft for ft in self.fields if isinstance(ft[1], Relation)
+        ]
+        self.no_relation_fields = [
+            ft for ft in self.fields if not isinstance(ft[1], Relation)
+        ]
+        self.index_fields = [ft for ft in self.fields if ft[1].index]
+        self.external_fields = [ft for ft in self.fields if ft[1].external]
+
+        meta = getattr(cls, 'Meta', None)
+
+        self.compound_indexes = list(getattr(meta, 'indexes', []))
+
+        # keep the ids in a sorted set scored by creation time too
+        self.ordered_members = getattr(meta, 'ordered_members', False)
+
+        for index in self.compound_indexes:
+            index.bind(self.fields)
+
+        self.key_name = snake_case(cls.__name__)
+
+        # include spec -> compiled serializer, see serializer()
+        self.serializers = dict()
+
+
+class FormMeta(type):
+    ''' Builds the field table of every form class and rebuilds it when a
+    field is added or removed after the class was created '''
+
+    def __init__(cls, name, bases, attrs):
+        super().__init__(name, bases, attrs)
+
+        cls._field_table = FieldTable(cls)
+
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+
+        if isinstance(value, Field):
+            value.__set_name__(cls, name)
+            cls._invalidate_field_table()
+
+    def __delattr__(cls, name):
+        is_field = isinstance(cls.__dict__.get(name), Field)
+
+        super().__delattr__(name)
+
+        if is_field:
+            cls._invalidate_field_table()
+
+    def _invalidate_field_table(cls):
+        if '_field_table' in cls.__dict__:
+            type.__delattr__(cls, '_field_table')
+
+        for subclass in cls.__subclasses__():
+            subclass._invalidate_field_table()
+
+
+def field_table(cls):
+    ''' Returns the field table of the given class, rebuilding it if it was
+    invalidated '''
+    table = cls.__dict__.get('_field_table')
+
+    if table is None:
+        table = FieldTable(cls)
+        type.__setattr__(cls, '_field_table', table)
+
+    return table
+
+
+# serializers kept per class, the cache is emptied when it gets bigger
+MAX_SERIALIZERS = 256
+
+
+def serializer(cls, include):
+    ''' Returns the function that serializes the objects of the given model
+    class with the given include spec. It is compiled once per class and
+    spec '''
+    serializers = field_table(cls).serializers
+    key = None if include is None else tuple(include)
+    serialize = serializers.get(key)
+
+    if serialize is None:
+        if len(serializers) >= MAX_SERIALIZERS:
+            serializers.clear()
+
+        serialize = serializers[key] = compile_serializer(cls, include)
+
+    return serialize
+
+
+def compile_serializer(cls, include):
+    ''' Builds a function that serializes an object of class cls like
+    Model.to_json(), reading its values straight from its __dict__. It
+    receives the object and the Prefetch with its related objects or
+    None '''
+    everything = include is None or '*' in include
+    with_id = everything or 'id' in include
+    with_type = everything or '_type' in include
+
+    # (name, to_json) where to_json is None if the value is used as is
+    values = [
+        (
+            fieldname,
+            None if type(field).to_json is Field.to_json else field.to_json,
+        )
+        for fieldname, field in get_no_relation_fields(cls)
+        if not field.private and (everything or fieldname in include)
+    ]
+
+    names = frozenset(fieldname for fieldname, to_json in values)
+    relations = []
+
+    for relation_name, subfields in parse_embed(include):
+        field = getattr(cls, relation_name, None)
+
+        if isinstance(field, (MultipleRelation, SingleRelation)):
+            relations.append((
+                relation_name,
+                isinstance(field, MultipleRelation),
+                subfields,
+            ))
+
+    def serialize(obj, prefetch):
+        if not names.isdisjoint(obj._deferred):
+            obj._load_deferred()
+
+        data = obj.__dict__
+        json = dict()
+
+        if with_id:
+            json['id'] = obj.id
+
+        if with_type:
+            json['_type'] = cls.cls_key()
+
+        for fieldname, to_json in values:
+            value = data[fieldname]
+
+            json[fieldname] = value if to_json is None else to_json(value)
+
+        for relation_name, multiple, subfields in relations:
+            if prefetch is not None:
+                related = prefetch.related(obj, relation_name)
+            elif multiple:
+                related = getattr(obj, relation_name).all()
+            else:
+                related = getattr(obj, relation_name).get()
+
+            if multiple:
+                json[relation_name] = [
+                    serializer(type(o), subfields)(o, prefetch)
+                    for o in related
+                ]
+            elif related is not None:
+                serialize_related = serializer(type(related), subfields)
+                json[relation_name] = serialize_related(related, prefetch)
+            else:
+                json[relation_name] = None
+
+        return json
+
+    return serialize
+
+
 def get_fields(cls):
-    all_fields = dir(cls)
-    not_private = filter(lambda name: not name.startswith('_'), all_fields)
-    name_field_tuples = map(lambda name: (name, getattr(cls, name)), not_private)
-    only_field_types = filter(lambda ft: isinstance(ft[1], Field), name_field_tuples)
-    return only_field_types
+    return field_table(cls).fields
 
 
 def get_no_relation_fields(cls):
-    return filter(lambda ft: not isinstance(ft[1], Relation), get_fields(cls))
+    return field_table(cls).no_relation_fields
 
 
-class Form:
+class Form(metaclass=FormMeta):
     ''' Parent class of the Model class, defines validation and other useful
     functions. '''
 
@@ -66,14 +251,13 @@ class Form:
             )
 
         # Check for custom validation rules
-        for fieldname in dir(cls):
-            rule = getattr(cls, fieldname)
+        for rule in field_table(cls).validation_rules:
+            try:
+                rule(obj)
+            except BadField as e:
+                errors.append(e)
 
-            if hasattr(rule, '_is_validation_rule') and rule._is_validation_rule:
-                try:
-                    rule(obj)
-                except BadField as e:
-                    errors.append(e)
+        cls._validate_compound_indexes(obj, errors, redis)
 
         # Trigger errors if any
         if errors.has_errors():
@@ -82,6 +266,14 @@ class Form:
         # Return the object with the new data set
         return obj
 
+    @classmethod
+    def _validate_compound_indexes(cls, obj, errors, redis):
+        ''' Adds an error for every unique compound index whose values are
+        already used by another object '''
+        for index in field_table(cls).compound_indexes:
+            if not index.validate(obj, redis):
+                errors.append(NotUniqueFieldError(index.name))
+
     def __str__(self):
         return '<{} {}>'.format(type(self).__name__, ' '.join(starmap(
             lambda fn, f: '{}={}'.format(fn, repr(getattr(self, fn))),
@@ -121,14 +313,21 @@ class Model(Form):
 
     notify = False
 
+    # names of the fields not read yet, see get(only=..., defer=...)
+    _deferred = frozenset()
+
     def __init__(self, id=None, **kwargs):
-        super().__init__()
+        # This allows fast queries for set relations
+        self._old = dict()
         # Generate this object's id using the provided id function
         self.id = id if id else self.get_engine().id_function()
         self._persisted = False
 
-        for fieldname, field in get_no_relation_fields(type(self)):
-            value = field.init(kwargs.get(fieldname))
+        for fieldname, field in get_fields(type(self)):
+            if isinstance(field, Relation):
+                value = None
+            else:
+                value = field.init(kwargs.get(fieldname))
 
             setattr(
                 self,
@@ -136,32 +335,206 @@ class Model(Form):
                 value
             )
 
-    def save(self):
+    def save(self, force=False):
         ''' Persists this object to the database. Each field knows how to store
-        itself so we don't have to worry about it '''
+        itself so we don't have to worry about it. Once the object is persisted
+        only the fields assigned since it was loaded or saved are written,
+        unless force is True. Inside a session the write is deferred until the
+        session ends '''
+        session = Session.of(type(self))
+
+        if session is not None:
+            session.add(self, force)
+
+            return self
+
         redis = type(self).get_redis()
         pipe = redis.pipeline()
 
-        pipe.hset(self.key(), 'id', self.id)
+        self._queue_save(pipe, force)
+
+        pipe.execute()
+
+        for channel, data in self._saved():
+            redis.publish(channel, data)
+
+        return self
+
+    async def asave(self, force=False):
+        ''' Same as save() for models bound to an AsyncEngine '''
+        session = Session.of(type(self))
+
+        if session is not None:
+            session.add(self, force)
+
+            return self
+
+        redis = type(self).get_redis()
+        pipe = redis.pipeline()
+
+        self._queue_save(pipe, force)
+
+        await pipe.execute()
+
+        for channel, data in self._saved():
+            await redis.publish(channel, data)
+
+        return self
+
+    def _queue_save(self, pipe, force=False):
+        ''' Queues in the pipeline the commands that persist this object, or
+        only its changed fields if it is already persisted '''
+        everything = force or not self._persisted
+
+        if everything:
+            pipe.hset(self.key(), 'id', self.id)
 
         for fieldname, field in get_no_relation_fields(type(self)):
-            field.save(self, getattr(self, fieldname), pipe)
+            if everything or fieldname in self._old:
+                field.save(self, getattr(self, fieldname), pipe)
 
-        pipe.sadd(type(self).members_key(), self.id)
+        for index in field_table(type(self)).compound_indexes:
+            if everything or index.changed(self):
+                index.save(self, pipe)
 
-        pipe.execute()
+        if everything:
+            pipe.sadd(type(self).members_key(), self.id)
 
-        if self.notify:
-            data = json.dumps({
-                'event': 'create' if not self._persisted else 'update',
-                'data': self.to_json(),
-            })
-            redis.publish(type(self).cls_key(), data)
-            redis.publish(self.key(), data)
+        if not self._persisted and field_table(type(self)).ordered_members:
+            pipe.zadd(
+                type(self).ordered_members_key(),
+                {self.id: time()},
+                nx=True
+            )
 
+    @classmethod
+    def save_many(cls, objs, chunk_size=None):
+        ''' Saves the given objects using large non transactional pipelines.
+        Unless chunk_size is given the amount of objects per pipeline adapts to
+        the measured latency. Returns, for each object, None if it was saved or
+        the error that prevented it '''
+        redis = cls.get_redis()
+        size = ChunkSize(chunk_size)
+        results = []
+
+        for chunk in chunks(objs, size):
+            errors, replies = execute_chunk(
+                redis,
+                chunk,
+                lambda obj, pipe: obj._queue_save(pipe),
+                size
+            )
+            notifications = []
+
+            for obj, error in zip(chunk, errors):
+                if error is None:
+                    notifications.extend(obj._saved())
+
+            publish_all(redis, notifications)
+            results.extend(errors)
+
+        return results
+
+    @classmethod
+    def delete_many(cls, objs, chunk_size=None):
+        ''' Deletes the given objects, or the objects with the given ids, using
+        large non transactional pipelines like save_many(). Returns, for each
+        one, None if it was deleted or the error that prevented it '''
+        redis = cls.get_redis()
+        size = ChunkSize(chunk_size)
+        results = []
+
+        graph = CascadeGraph.of(cls)
+
+        for chunk in chunks(objs, size):
+            ids = [item for item in chunk if not isinstance(item, Model)]
+            loaded = iter(cls.get_many(ids))
+            chunk = [
+                item if isinstance(item, Model) else next(loaded)
+                for item in chunk
+            ]
+            notifications = []
+
+            if graph is not None:
+                def queue(obj, pipe):
+                    if obj is None:
+                        raise ModelNotFoundError(
+                            'This object does not exist in database'
+                        )
+
+                    cls.get_engine().lua.cascade(
+                        args=graph.args(obj),
+                        client=pipe
+                    )
+
+                errors, replies = execute_chunk(redis, chunk, queue, size)
+                errors = [
+                    graph.error(e) if e is not None else None
+                    for e in errors
+                ]
+
+                for obj, error, reply in zip(chunk, errors, replies):
+                    if error is None:
+                        obj._deleted(reply[0][::2])
+                        notifications.extend(
+                            graph.notifications(obj, reply[0])
+                        )
+            else:
+                deletion = Deletion(chunk)
+
+                def queue(root, pipe):
+                    if deletion.errors[root] is not None:
+                        raise deletion.errors[root]
+
+                    deletion.queue(root, pipe)
+
+                errors, replies = execute_chunk(
+                    redis, range(len(chunk)), queue, size
+                )
+
+                for root, error in enumerate(errors):
+                    if error is None:
+                        chunk[root]._deleted(
+                            obj.key() for obj in deletion.objs[root]
+                        )
+                        notifications.extend(deletion.notifications(root))
+
+            publish_all(redis, notifications)
+            results.extend(errors)
+
+        return results
+
+    def dirty_fields(self):
+        ''' Returns the names of the fields assigned since this object was
+        loaded or saved '''
+        return set(self._old)
+
+    def _saved(self):
+        ''' Marks this object as persisted. Returns the notifications that
+        must be published as (channel, data) tuples '''
+        # the values stored in the indexes are now the current ones
+        self._old = dict()
+
+        cache = self.get_engine().cache
+
+        if cache is not None:
+            cache.invalidate(self.key())
+
+        event = 'create' if not self._persisted else 'update'
         self._persisted = True
 
-        return self
+        return self._notifications(event)
+
+    def _notifications(self, event):
+        if not self.notify:
+            return []
+
+        data = json.dumps({
+            'event': event,
+            'data': self.to_json(),
+        })
+
+        return [(type(self).cls_key(), data), (self.key(), data)]
 
     def update(self, **kwargs):
         ''' validates the given data against this object's rules and then
@@ -190,6 +563,8 @@ class Model(Form):
                 value
             )
 
+        type(self)._validate_compound_indexes(self, errors, redis)
+
         if errors.has_errors():
             raise errors
 
@@ -202,41 +577,251 @@ class Model(Form):
         return re.match('^.*:obj$', key)
 
     @classmethod
-    def get(cls, id):
-        ''' Retrieves an object by id. Returns None in case of failure '''
-
+    def get(cls, id, *, only=None, defer=None):
+        ''' Retrieves an object by id. Returns None in case of failure. The
+        object's hash and the fields stored in other keys are read in a single
+        round trip. Given only or defer, a list of field names, just the
+        fields in only or not in defer are read, the rest are read together
+        the first time one of them is used '''
         if not id:
             return None
 
-        redis = cls.get_redis()
-        key = '{}:{}:obj'.format(cls.cls_key(), id)
+        return cls.get_many([id], only=only, defer=defer)[0]
+
+    @classmethod
+    def get_many(cls, ids, *, only=None, defer=None):
+        ''' Retrieves the objects with the given ids using a single round trip
+        to the database. Returns them in the same order as the given ids, with
+        None in place of the ones that don't exist. Inside a session the
+        objects already loaded are not read again. only and defer work like
+        in get() '''
+        pipe = cls.get_redis().pipeline(transaction=False)
+        fetch = cls._queue_fetch(pipe, ids, cls._projection(only, defer))
+
+        # nothing is sent if every object was already loaded
+        return cls._build_fetched(fetch, pipe.execute() if len(pipe) else [])
 
-        if not redis.exists(key):
+    @classmethod
+    async def aget(cls, id, *, only=None, defer=None):
+        ''' Same as get() for models bound to an AsyncEngine. only and defer
+        are checked but every field is read, since deferred fields are read
+        on attribute access, which can't be awaited '''
+        if not id:
             return None
 
-        obj = cls(id=id)
-        obj._persisted = True
+        return (await cls.aget_many([id], only=only, defer=defer))[0]
 
-        data = debyte_hash(redis.hgetall(key))
+    @classmethod
+    async def aget_many(cls, ids, *, only=None, defer=None):
+        ''' Same as get_many() for models bound to an AsyncEngine. The fields
+        left out by only and defer are read eagerly, like in aget() '''
+        cls._projection(only, defer)
 
-        for fieldname, field in get_fields(cls):
-            value = field.recover(obj, data, redis)
+        pipe = cls.get_redis().pipeline(transaction=False)
+        fetch = cls._queue_fetch(pipe, ids)
 
-            setattr(
-                obj,
-                fieldname,
-                value
+        # nothing is sent if every object was already loaded
+        results = await pipe.execute() if len(pipe) else []
+
+        return cls._build_fetched(fetch, results)
+
+    @classmethod
+    def _projection(cls, only, defer):
+        ''' Returns the names of the fields to read given the only and defer
+        arguments of get(), or None to read all of them. Relations are always
+        read '''
+        if only is None and defer is None:
+            return None
+
+        for fieldname in list(only or []) + list(defer or []):
+            field = getattr(cls, fieldname, None)
+
+            if fieldname != 'id' and not isinstance(field, Field):
+                raise AttributeError('Model {} does not have field {}'.format(
+                    cls.__name__,
+                    fieldname
+                ))
+
+        return frozenset(
+            fieldname for fieldname, field in get_fields(cls)
+            if isinstance(field, Relation) or (
+                (only is None or fieldname in only) and
+                (defer is None or fieldname not in defer)
             )
+        )
 
-        return obj
+    @classmethod
+    def _projected_fields(cls, fields):
+        ''' Returns the fields of the object's hash and the external fields
+        read for the given projection '''
+        table = field_table(cls)
+
+        if fields is None:
+            return None, table.external_fields
+
+        hashed = [
+            fieldname for fieldname, field in table.fields
+            if not field.external and fieldname in fields
+        ]
+        external = [ft for ft in table.external_fields if ft[0] in fields]
+
+        return hashed, external
+
+    @classmethod
+    def _queue_load(cls, pipe, ids, fields=None):
+        ''' Queues in the pipeline the commands that read the objects with
+        the given ids, or only the given fields of them. Returns the objects
+        that will hold the data, or None for the empty ids '''
+        hashed, external = cls._projected_fields(fields)
+        objs = []
+
+        for id in ids:
+            if not id:
+                objs.append(None)
+                continue
+
+            obj = cls(id=id)
+
+            if hashed is None:
+                pipe.hgetall(obj.key())
+            else:
+                pipe.hmget(obj.key(), ['id'] + hashed)
+
+            for fieldname, field in external:
+                field.fetch(obj, pipe)
+
+            objs.append(obj)
+
+        return objs
+
+    @classmethod
+    def _queue_fetch(cls, pipe, ids, fields=None):
+        ''' Same as _queue_load() but the objects already loaded in the current
+        session or found in the engine's cache are not read. Returns what
+        _build_fetched() needs. Projections are not cached '''
+        ids = list(ids)
+        session = Session.of(cls)
+        cache = cls.get_engine().cache if fields is None else None
+        missing = session.missing(cls, ids) if session is not None else ids
+
+        if cache is None:
+            objs = cls._queue_load(pipe, missing, fields)
+
+            return ids, session, None, None, objs, None, fields
+
+        since = cache.generation(cls.cls_key())
+        objs = []
+        cached = []
+
+        for id in missing:
+            key = '{}:{}:obj'.format(cls.cls_key(), id)
+            value = cache.get(key) if id else MISSING
+
+            if value is MISSING:
+                objs.extend(cls._queue_load(pipe, [id]))
+            else:
+                objs.append(cls(id=id))
+
+            cached.append(value)
+
+        return ids, session, cache, since, objs, cached, None
+
+    @classmethod
+    def _build_fetched(cls, fetch, results):
+        ''' Builds the objects queued by _queue_fetch(), caching the data
+        read from the database. Like _build_loaded() it only consumes its own
+        results '''
+        ids, session, cache, since, objs, cached, fields = fetch
+        results = iter(results)
+
+        if cache is None:
+            loaded = cls._build_loaded(objs, results, fields)
+        else:
+            count = 1 + len(field_table(cls).external_fields)
+            loaded = []
+
+            for obj, value in zip(objs, cached):
+                if obj is None:
+                    loaded.append(None)
+                    continue
+
+                if value is MISSING:
+                    value = [next(results) for i in range(count)]
+                    cache.set(obj.key(), value, cls.cls_key(), since)
+
+                loaded.extend(cls._build_loaded([obj], value))
+
+        if session is not None:
+            return session.merge(cls, ids, loaded)
+
+        return loaded
+
+    @classmethod
+    def _build_loaded(cls, objs, results, fields=None):
+        ''' Fills the objects returned by _queue_load() with the results of
+        executing the pipeline. The fields left out of the projection are
+        deferred '''
+        redis = cls.get_redis()
+        hashed, external = cls._projected_fields(fields)
+        external_count = len(external)
+        results = iter(results)
+        loaded = []
+
+        for obj in objs:
+            if obj is None:
+                loaded.append(None)
+                continue
+
+            data = next(results)
+            fetched = [next(results) for i in range(external_count)]
+
+            if hashed is not None:
+                # the values of hmget, the first one is the id
+                data = {
+                    name: value
+                    for name, value in zip(['id'] + hashed, data)
+                    if value is not None
+                } if data[0] is not None else None
+
+            if not data:
+                loaded.append(None)
+                continue
+
+            data = debyte_hash(data)
+            fetched = iter(fetched)
+
+            for fieldname, field in get_fields(cls):
+                if fields is not None and fieldname not in fields:
+                    del obj.__dict__[fieldname]
+                    continue
+
+                if field.external:
+                    value = field.recover_fetched(obj, next(fetched))
+                else:
+                    value = field.recover(obj, data, redis)
+
+                setattr(
+                    obj,
+                    fieldname,
+                    value
+                )
+
+            if fields is not None:
+                obj._deferred = frozenset(
+                    fieldname for fieldname, field in get_fields(cls)
+                    if fieldname not in fields
+                )
+
+            obj._persisted = True
+            loaded.append(obj)
+
+        return loaded
 
     @classmethod
     def q(cls, **kwargs):
         ''' Creates an iterator over the members of this class that applies the
         given filters and returns only the elements matching them '''
-        redis = cls.get_redis()
-
-        return QuerySet(cls, redis.sscan_iter(cls.members_key()))
+        return QuerySet(cls, cls.members_key())
 
     @classmethod
     def count(cls):
@@ -245,25 +830,61 @@ class Model(Form):
 
         return redis.scard(cls.members_key())
 
+    @classmethod
+    def expression(cls):
+        ''' Returns the set of ids of this model as a set expression, to
+        combine it with relations and indexes as in
+        ``Truck.expression() - fleet.trucks`` '''
+        return SetExpression(cls, cls.members_key())
+
+    @classmethod
+    def indexed(cls, fieldname, value):
+        ''' Returns the set of ids of the objects with the given value in a
+        non unique index as a set expression '''
+        field = getattr(cls, fieldname, None)
+
+        if not isinstance(field, Field) or not field.index or field.unique:
+            raise ImproperlyConfiguredError(
+                'Field {} of model {} does not have a non unique index'.format(
+                    fieldname,
+                    cls.__name__
+                )
+            )
+
+        return SetExpression(cls, field.set_key(cls, value))
+
+    def _load_deferred(self):
+        ''' Reads the deferred fields of this object in a single round trip '''
+        cls = type(self)
+        deferred = self._deferred
+        pipe = cls.get_redis().pipeline(transaction=False)
+        objs = cls._queue_load(pipe, [self.id], deferred)
+        loaded = cls._build_loaded(objs, pipe.execute(), deferred)[0]
+
+        if loaded is None:
+            raise ModelNotFoundError('This object has been deleted')
+
+        for fieldname in deferred:
+            self.__dict__[fieldname] = loaded.__dict__[fieldname]
+
+        self._deferred = frozenset()
+
     def reload(self):
         ''' reloads this object so if it was updated in the database it now
-        contains the new values'''
-        key = self.key()
-        redis = type(self).get_redis()
+        contains the new values. Reads like get() but never from the cache '''
+        pipe = type(self).get_redis().pipeline(transaction=False)
+        objs = type(self)._queue_load(pipe, [self.id])
+        loaded = type(self)._build_loaded(objs, pipe.execute())[0]
 
-        if not redis.exists(key):
+        if loaded is None:
             raise ModelNotFoundError('This object has been deleted')
 
-        data = debyte_hash(redis.hgetall(key))
-
         for fieldname, field in get_fields(type(self)):
-            value = field.recover(data, redis)
+            self.__dict__[fieldname] = loaded.__dict__[fieldname]
 
-            setattr(
-                self,
-                fieldname,
-                value
-            )
+        self._old = dict()
+        self._deferred = frozenset()
+        self._persisted = True
 
         return self
 
@@ -279,22 +900,113 @@ class Model(Form):
         return obj
 
     @classmethod
-    def get_by(cls, field, value):
+    def get_by(cls, *args, **fields):
         ''' Tries to retrieve an isinstance of this model from the database
-        given a value for a defined index. Return None in case of failure '''
+        given a value for a defined index, as in ``get_by('code', 'T13')``, or
+        the values of the fields of a compound index, as in
+        ``get_by(tenant='a', plate='T13')``. Other combinations of fields are
+        answered by a queryset and return its first match. Return None in
+        case of failure '''
         redis = cls.get_redis()
+
+        if args:
+            field, value = args
+            key = cls.cls_key() + ':index_' + field
+
+            id = cls._cached_lookup(
+                (key, value),
+                lambda: redis.hget(key, value)
+            )
+
+            if id:
+                return cls.get(debyte_string(id))
+
+            return None
+
+        for index in field_table(cls).compound_indexes:
+            if index.unique and set(index.fieldnames) == set(fields):
+                values = [fields[fieldname] for fieldname in index.fieldnames]
+                id = cls._cached_lookup(
+                    (index.key(cls), index.member(values)),
+                    lambda: index.lookup(cls, values, redis)
+                )
+
+                return cls.get(debyte_string(id)) if id else None
+
+        obj = next(cls.q().filter(**fields), None)
+        session = Session.of(cls)
+
+        if obj is not None and session is not None:
+            return session.register(obj)
+
+        return obj
+
+    @classmethod
+    def get_by_many(cls, field, values, *, only=None, defer=None):
+        ''' Retrieves the objects with the given values of an index, like
+        get_by(field, value) for each value. The ids are read with a single
+        HMGET and the objects with get_many(), which takes only and defer.
+        Returns a dict that maps every value to its object, or to None if no
+        object has it '''
+        values = list(dict.fromkeys(values))
         key = cls.cls_key() + ':index_' + field
+        cache = cls.get_engine().cache
+        ids = dict()
+        unknown = values
+
+        if cache is not None:
+            since = cache.generation(cls.cls_key())
+            ids = {
+                value: cache.get((key, value), cls.cls_key())
+                for value in values
+            }
+            unknown = [value for value in values if ids[value] is MISSING]
+
+        if unknown:
+            for value, id in zip(unknown, cls.get_redis().hmget(key, unknown)):
+                ids[value] = id
+
+                if cache is not None:
+                    cache.set((key, value), id, cls.cls_key(), since)
+
+        found = [value for value in values if ids[value]]
+        objs = cls.get_many(
+            [debyte_string(ids[value]) for value in found],
+            only=only,
+            defer=defer
+        )
+        result = dict.fromkeys(values)
+
+        result.update(zip(found, objs))
+
+        return result
+
+    @classmethod
+    def _cached_lookup(cls, key, read):
+        ''' Returns the id found by read(), which is remembered under the given
+        key if the engine has a cache '''
+        cache = cls.get_engine().cache
 
-        id = redis.hget(key, value)
+        if cache is None:
+            return read()
 
-        if id:
-            return cls.get(debyte_string(id))
+        since = cache.generation(cls.cls_key())
+        id = cache.get(key, cls.cls_key())
 
-        return None
+        if id is MISSING:
+            id = read()
+            cache.set(key, id, cls.cls_key(), since)
+
+        return id
+
+    @classmethod
+    def compound_indexes(cls):
+        ''' Returns the compound indexes declared in this model's Meta '''
+        return field_table(cls).compound_indexes
 
     @classmethod
-    def get_by_or_exception(cls, field, value):
-        obj = cls.get_by(field, value)
+    def get_by_or_exception(cls, *args, **fields):
+        obj = cls.get_by(*args, **fields)
 
         if obj is None:
             raise ModelNotFoundError('This object does not exist in database')
@@ -306,14 +1018,55 @@ class Model(Form):
         ''' Gets all available instances of this model from the database '''
         redis = cls.get_redis()
 
-        return list(map(
-            lambda id: cls.get(id),
-            map(
-                debyte_string,
-                redis.smembers(cls.members_key())
-            )
+        return cls.get_many(map(
+            debyte_string,
+            redis.smembers(cls.members_key())
         ))
 
+    @classmethod
+    def iter_all(cls, batch_size=DEFAULT_BATCH_SIZE):
+        ''' Yields all the instances of this model reading batch_size ids at
+        a time with SSCAN, so they are never all in memory '''
+        redis = cls.get_redis()
+        cursor = 0
+
+        while True:
+            cursor, ids = redis.sscan(
+                cls.members_key(),
+                cursor,
+                count=batch_size
+            )
+
+            for obj in cls.get_many(map(debyte_string, ids)):
+                if obj is not None:
+                    yield obj
+
+            if not int(cursor):
+                return
+
+    @classmethod
+    def latest(cls, count, offset=0):
+        ''' Returns the count most recently created objects, skipping the
+        first offset ones. Needs ``ordered_members = True`` in the model's
+        Meta '''
+        if not field_table(cls).ordered_members:
+            raise ImproperlyConfiguredError(
+                'Model {} does not keep its ordered members'.format(
+                    cls.__name__
+                )
+            )
+
+        ids = cls.get_redis().zrevrange(
+            cls.ordered_members_key(),
+            offset,
+            offset + count - 1
+        )
+
+        return [
+            obj for obj in cls.get_many(map(debyte_string, ids))
+            if obj is not None
+        ]
+
     @classmethod
     def tree_match(cls, field, string):
         ''' Given a tree index, retrieves the ids atached to the given prefix,
@@ -332,19 +1085,16 @@ class Model(Form):
             for i in range(len(pieces))
         )
 
-        return sorted(map(
-            lambda id: cls.get(id),
-            map(
-                debyte_string,
-                ans
-            )
-        ), key=lambda x: x.id)
+        return sorted(cls.get_many(map(
+            debyte_string,
+            ans
+        )), key=lambda x: x.id)
 
     @classmethod
     def cls_key(cls):
         ''' Returns the redis key prefix assigned to this model '''
 
-        return snake_case(cls.__name__)
+        return field_table(cls).key_name
 
     @classmethod
     def members_key(cls):
@@ -352,6 +1102,13 @@ class Model(Form):
         from this class '''
         return cls.cls_key() + ':members'
 
+    @classmethod
+    def ordered_members_key(cls):
+        ''' This key holds a sorted set with the ids of the objects of this
+        class scored by their creation time, if the model's Meta sets
+        ordered_members '''
+        return cls.cls_key() + ':ordered_members'
+
     def key(self):
         ''' Returns the redis key to access this object's values '''
         prefix = type(self).cls_key()
@@ -375,45 +1132,20 @@ class Model(Form):
     def to_json(self, *, include=None):
         ''' Serializes this model to a JSON representation so it can be sent
         via an HTTP REST API '''
-        json = dict()
-
-        if include is None or 'id' in include or '*' in include:
-            json['id'] = self.id
-
-        if include is None or '_type' in include or '*' in include:
-            json['_type'] = type(self).cls_key()
-
-        def fieldfilter(fieldtuple):
-            return \
-                not fieldtuple[1].private and \
-                not isinstance(fieldtuple[1], Relation) and (
-                    include is None or fieldtuple[0] in include or '*' in include
-                )
-
-        json.update(dict(starmap(
-            lambda fn, f: (fn, f.to_json(getattr(self, fn))),
-            filter(
-                fieldfilter,
-                get_fields(type(self))
-            )
-        )))
+        return self._to_json(include, None)
 
-        for relation_name, subfields in parse_embed(include):
-            if not hasattr(type(self), relation_name):
-                continue
-
-            if not isinstance(getattr(type(self), relation_name), Relation):
-                continue
-
-            relation = getattr(self, relation_name)
+    @classmethod
+    def to_json_many(cls, objs, *, include=None):
+        ''' Serializes the given objects like to_json(). The related objects
+        embedded by include are read for all the objects at once, with two
+        round trips per level of embedding '''
+        objs = list(objs)
+        prefetch = Prefetch(objs, include)
 
-            if isinstance(getattr(type(self), relation_name), MultipleRelation):
-                json[relation_name] = list(map(lambda o: o.to_json(include=subfields), relation.all()))
-            elif isinstance(getattr(type(self), relation_name), SingleRelation):
-                related = relation.get()
-                json[relation_name] = related.to_json(include=subfields) if related is not None else None
+        return [obj._to_json(include, prefetch) for obj in objs]
 
-        return json
+    def _to_json(self, include, prefetch):
+        return serializer(type(self), include)(self, prefetch)
 
     def __eq__(self, other):
         ''' Compares this object to another. Returns true if both are of the
@@ -428,29 +1160,423 @@ class Model(Form):
 
     def delete(self):
         ''' Deletes this model from the database, calling delete in each field
-        to properly delete special cases '''
+        to properly delete special cases. Unless some field customizes how it
+        is deleted, the object and everything deleted in cascade with it are
+        removed by a script in a single round trip '''
         redis = type(self).get_redis()
+        graph = CascadeGraph.of(type(self))
+
+        if graph is not None:
+            try:
+                deleted = self.get_engine().lua.cascade(args=graph.args(self))
+            except ResponseError as e:
+                raise graph.error(e)
+
+            self._deleted(deleted[::2])
+            publish_all(redis, graph.notifications(self, deleted))
+
+            return self
+
+        # the related ids are read one level of cascade deletes at a time,
+        # then everything is removed in a single transaction
+        deletion = Deletion([self])
+
+        if deletion.errors[0] is not None:
+            raise deletion.errors[0]
+
+        pipe = redis.pipeline()
+
+        deletion.queue(0, pipe)
+
+        pipe.execute()
+
+        self._deleted(obj.key() for obj in deletion.objs[0])
+        publish_all(redis, deletion.notifications(0))
+
+        return self
+
+    def _deleted(self, keys):
+        ''' Drops the objects deleted with this one, given by their keys, from
+        the current session and the engine's cache '''
+        keys = [debyte_string(key) for key in keys]
+        session = Session.of(type(self))
+        cache = self.get_engine().cache
+
+        if session is not None:
+            session.forget(keys)
+
+        if cache is not None:
+            for key in keys:
+                cache.invalidate(key)
 
+    def _queue_delete(self, pipe):
+        ''' Queues the commands that remove this object's fields, indexes and
+        keys. The related objects are handled by Deletion '''
         for fieldname, field in get_fields(type(self)):
-            field._delete(self, redis)
+            field._delete(self, pipe)
 
-        redis.delete(self.key())
-        redis.srem(type(self).members_key(), self.id)
+        self._queue_delete_keys(pipe)
+
+    def _queue_delete_keys(self, pipe):
+        for index in field_table(type(self)).compound_indexes:
+            index.delete(self, pipe)
+
+        pipe.delete(self.key())
+        pipe.srem(type(self).members_key(), self.id)
+
+        if field_table(type(self)).ordered_members:
+            pipe.zrem(type(self).ordered_members_key(), self.id)
 
         if isinstance(self, PermissionHolder):
-            redis.delete(self.allow_key())
+            pipe.delete(self.allow_key())
+
+    async def adelete(self):
+        ''' Same as delete() for models bound to an AsyncEngine. The writes of
+        this object are sent in a single transaction '''
+        redis = type(self).get_redis()
+        graph = CascadeGraph.of(type(self))
+
+        if graph is not None:
+            try:
+                deleted = await self.get_engine().lua.cascade(
+                    args=graph.args(self)
+                )
+            except ResponseError as e:
+                raise graph.error(e)
+
+            self._deleted(deleted[::2])
+
+            for channel, data in graph.notifications(self, deleted):
+                await redis.publish(channel, data)
+
+            return self
+
+        pipe = redis.pipeline()
+
+        for fieldname, field in get_fields(type(self)):
+            if isinstance(field, Relation):
+                await field._adelete(self, pipe)
+            else:
+                field._delete(self, pipe)
+
+        self._queue_delete_keys(pipe)
+
+        await pipe.execute()
 
-        if self.notify:
-            data = json.dumps({
-                'event': 'delete',
-                'data': self.to_json(),
-            })
-            redis.publish(type(self).cls_key(), data)
-            redis.publish(self.key(), data)
+        self._deleted([self.key()])
+
+        for channel, data in self._notifications('delete'):
+            await redis.publish(channel, data)
 
         return self
 
 
+class Prefetch:
+    ''' The objects embedded by to_json_many(). The related ids of every
+    level of embedding are read in a single round trip, and the related
+    objects in another one '''
+
+    def __init__(self, objs, include):
+        # (object key, relation name) -> related object or list of objects
+        self.found = dict()
+
+        level = [(objs, include)]
+
+        while level:
+            level = self.read_level(level)
+
+    def read_level(self, level):
+        ''' Reads the objects related to each group of objects of a level
+        through the relations in its include. Returns the groups of the next
+        level '''
+        queued = []
+        pipe = None
+
+        for objs, include in level:
+            for relation_name, subfields in parse_embed(include):
+                for obj in objs:
+                    field = getattr(type(obj), relation_name, None)
+
+                    if not isinstance(field, Relation):
+                        continue
+
+                    if pipe is None:
+                        redis = type(obj).get_redis()
+                        pipe = redis.pipeline(transaction=False)
+
+                    field.queue_related_ids(obj, pipe)
+                    queued.append((obj, field, subfields))
+
+        if not queued:
+            return []
+
+        results = pipe.execute()
+
+        # all the objects of each related model are read with one fetch
+        related_ids = []
+        by_model = dict()
+
+        for (obj, field, subfields), result in zip(queued, results):
+            model = model_from_spec(field.modelspec)
+
+            related_ids.append(field.related_ids(result))
+            by_model.setdefault(model, dict()).update(
+                dict.fromkeys(related_ids[-1])
+            )
+
+        pipe = type(queued[0][0]).get_redis().pipeline(transaction=False)
+        fetches = [
+            (model, model._queue_fetch(pipe, list(ids)))
+            for model, ids in by_model.items()
+        ]
+        results = iter(pipe.execute() if len(pipe) else [])
+        loaded = dict()
+
+        for model, fetch in fetches:
+            for obj in model._build_fetched(fetch, results):
+                if obj is not None:
+                    loaded[(model, obj.id)] = obj
+
+        next_level = []
+
+        for (obj, field, subfields), ids in zip(queued, related_ids):
+            model = model_from_spec(field.modelspec)
+            related = [
+                loaded[(model, id)] for id in ids if (model, id) in loaded
+            ]
+
+            if isinstance(field, MultipleRelation):
+                self.found[(obj.key(), field.name)] = related
+            else:
+                self.found[(obj.key(), field.name)] = (
+                    related[0] if related else None
+                )
+
+            if subfields and related:
+                next_level.append((related, subfields))
+
+        return next_level
+
+    def related(self, obj, relation_name):
+        return self.found[(obj.key(), relation_name)]
+
+
+class CascadeGraph:
+    ''' The models reachable from a model through relations, described for
+    the cascade script: the key prefix of each one, how to remove its fields
+    from the indexes and its relations with their on_delete rules '''
+
+    def __init__(self, spec, models):
+        self.spec = json.dumps(spec)
+        self.models = models
+
+    @classmethod
+    def of(cls, model):
+        ''' Builds the graph of the given model. Returns None if some field
+        can't be described and must be deleted in python '''
+        spec = dict()
+        models = dict()
+        pending = [model]
+
+        while pending:
+            current = pending.pop()
+            prefix = current.cls_key()
+
+            if prefix in spec:
+                continue
+
+            table = field_table(current)
+            ops = []
+            relations = []
+            fetch = []
+
+            for fieldname, field in table.fields:
+                field_ops = field.delete_ops(current)
+
+                if field_ops is None:
+                    return None
+
+                ops.extend(field_ops)
+
+            # the external fields are read for the events of the model
+            if current.notify:
+                for fieldname, field in table.external_fields:
+                    op = field.fetch_op(current)
+
+                    if op is None:
+                        return None
+
+                    fetch.append(op)
+
+            for index in table.compound_indexes:
+                ops.extend(index.delete_ops(current))
+
+            if table.ordered_members:
+                ops.append(['zrem', current.ordered_members_key()])
+
+            for fieldname, field in table.relation_fields:
+                relation = field.relation_spec()
+
+                if relation is None:
+                    return None
+
+                relations.append(relation)
+                pending.append(model_from_spec(field.modelspec))
+
+            spec[prefix] = {
+                'ops': ops,
+                'relations': relations,
+                'allow': issubclass(current, PermissionHolder),
+                'notify': current.notify,
+                'fetch': fetch,
+            }
+            models[prefix] = current
+
+        return cls(spec, models)
+
+    def args(self, obj):
+        return [self.spec, type(obj).cls_key(), obj.id]
+
+    def error(self, e):
+        ''' Turns the restriction error of the script into the one raised by
+        Model.delete() '''
+        if str(e).startswith('restricted'):
+            return DeleteRestrictedError(
+                'attempt to delete with relations and restrict flag'
+            )
+
+        return e
+
+    def notifications(self, root, deleted):
+        ''' The notifications of the objects deleted by the script, built from
+        the values it returned '''
+        notifications = []
+
+        for key, data in zip(deleted[::2], deleted[1::2]):
+            key = debyte_string(key)
+
+            if key == root.key():
+                notifications.extend(root._notifications('delete'))
+                continue
+
+            if not data:
+                continue
+
+            data, external = data
+            prefix, id = key[:-len(':obj')].rsplit(':', 1)
+            model = self.models[prefix]
+            obj = model._build_loaded(
+                [model(id=id)],
+                [dict(zip(data[::2], data[1::2]))] + list(external)
+            )[0]
+
+            notifications.extend(obj._notifications('delete'))
+
+        return notifications
+
+
+class Deletion:
+    ''' Everything that must be written to delete some objects, called the
+    roots. The ids related to the objects are read one level at a time in a
+    single round trip per level, and only the objects deleted in cascade are
+    loaded, so their indexes can be cleaned. A root that can't be deleted,
+    because it doesn't exist or something in its tree is restricted, gets an
+    error in errors and nothing of its tree is written '''
+
+    def __init__(self, roots):
+        self.errors = [None] * len(roots)
+        # the objects to delete and the (field, object, ids) to unrelate from
+        # the inverse relations, per root
+        self.objs = [[] for root in roots]
+        self.unrelated = [[] for root in roots]
+
+        level = []
+        seen = set()
+
+        for root, obj in enumerate(roots):
+            if obj is None:
+                self.errors[root] = ModelNotFoundError(
+                    'This object does not exist in database'
+                )
+                continue
+
+            level.append((obj, root))
+            seen.add(obj.fqn())
+
+        while level:
+            level = self.read_level(level, seen)
+
+    def read_level(self, level, seen):
+        ''' Reads the related ids of the objects of a level and returns the
+        objects of the next level, the ones deleted in cascade '''
+        redis = type(level[0][0]).get_redis()
+        pipe = redis.pipeline(transaction=False)
+
+        for obj, root in level:
+            for fieldname, field in field_table(type(obj)).relation_fields:
+                field.queue_related_ids(obj, pipe)
+
+        results = iter(pipe.execute())
+        cascade = []
+
+        for obj, root in level:
+            self.objs[root].append(obj)
+
+            for fieldname, field in field_table(type(obj)).relation_fields:
+                ids = field.related_ids(next(results))
+
+                if not ids:
+                    continue
+
+                if field.on_delete == 'restrict':
+                    self.errors[root] = DeleteRestrictedError(
+                        'attempt to delete with relations and restrict flag'
+                    )
+                elif field.on_delete == 'cascade':
+                    model = model_from_spec(field.modelspec)
+
+                    for id in ids:
+                        if '{}:{}'.format(model.cls_key(), id) not in seen:
+                            seen.add('{}:{}'.format(model.cls_key(), id))
+                            cascade.append((model, id, root))
+                elif field.unrelates_on_delete():
+                    self.unrelated[root].append((field, obj, ids))
+
+        if not cascade:
+            return []
+
+        pipe = redis.pipeline(transaction=False)
+        queued = [
+            (model._queue_load(pipe, [id])[0], model, root)
+            for model, id, root in cascade
+        ]
+        results = iter(pipe.execute())
+        next_level = []
+
+        for obj, model, root in queued:
+            # each call consumes only the results of its object
+            loaded = model._build_loaded([obj], results)[0]
+
+            if loaded is not None:
+                next_level.append((loaded, root))
+
+        return next_level
+
+    def queue(self, root, pipe):
+        ''' Queues the commands that delete the tree of the given root '''
+        for obj in self.objs[root]:
+            obj._queue_delete(pipe)
+
+        for field, obj, ids in self.unrelated[root]:
+            field.queue_unrelate(obj, ids, pipe)
+
+    def notifications(self, root):
+        ''' The notifications of the objects deleted with the given root '''
+        return [
+            n for obj in self.objs[root] for n in obj._notifications('delete')
+        ]
+
+
 class BoundedModel(Model):
     ''' A bounded model is bounded to a prefix in the database '''
 
@@ -460,4 +1586,4 @@ class BoundedModel(Model):
 
     @classmethod
     def cls_key(cls):
-        return cls.prefix() + ':' + snake_case(cls.__name__)
+        return cls.prefix() + ':' + field_table(cls).key_name
@@ -1,8 +1,14 @@
 from . import datamodel
 from .datamodel import debyte_string
-from .errors import MissingFieldError, InvalidFieldError, ReservedFieldError, NotUniqueFieldError, DeleteRestrictedError
+from .errors import MissingFieldError, InvalidFieldError, ReservedFieldError
+from .errors import NotUniqueFieldError, DeleteRestrictedError
+from .errors import ImproperlyConfiguredError
 from .hashing import make_password, is_hashed
-from coralillo.queryset import QuerySet
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from coralillo.queryset import QuerySet, SetExpression, DEFAULT_BATCH_SIZE
+from coralillo.queryset import SetScan, SetUnion, ScoreRange, LexRange
+from coralillo.queryset import HashLookup, GeoRadius
+from coralillo.queryset import RANGE_FILTERS, LEX_FILTERS
 from importlib import import_module
 import datetime
 import json
@@ -13,10 +19,53 @@ class Field:
     ''' Defines a field of a model. Represents how to store this specific
     datatype in the redis database '''
 
-    def __init__(self, *, name=None, index=False, required=True, default=None, private=False, regex=None, forbidden=None, allowed=None, fillable=True):
+    # Fields whose value is stored outside of the object's hash set this so
+    # loaders can retrieve them with fetch() in the same round trip
+    external = False
+
+    # Values that can be changed in place, like dicts. Assigning them always
+    # marks the field as changed, since the value compares equal to itself
+    mutable = False
+
+    # How the stored value is compared when filtering in the database, one of
+    # 'str', 'num' or 'bool'. None means the filters are applied in python
+    query_type = 'str'
+
+    def __init__(self, *, name=None, index=False, unique=True,
+                 range_index=False, prefix_index=False, required=True,
+                 default=None, private=False, regex=None, forbidden=None,
+                 allowed=None, fillable=True):
         # This field's value is mapped to the ID in a redis hash so you can Model.get_by(field, value)
         self.index = index
 
+        # Whether the index is unique. A non unique index keeps a set with
+        # the ids of the objects that have each value
+        self.unique = unique
+
+        # The ids are kept in a sorted set scored by this field's value so
+        # range filters don't need to scan the whole model. Only for numeric
+        # fields
+        self.range_index = range_index
+
+        # The values are kept in a lexicographically sorted set so prefix
+        # searches and ordering don't need to scan the whole model. Only for
+        # text fields
+        self.prefix_index = prefix_index
+
+        if range_index and self.query_type != 'num':
+            raise ImproperlyConfiguredError(
+                '{} fields can not have a range index'.format(
+                    type(self).__name__
+                )
+            )
+
+        if prefix_index and not isinstance(self, Text):
+            raise ImproperlyConfiguredError(
+                '{} fields can not have a prefix index'.format(
+                    type(self).__name__
+                )
+            )
+
         # This field is required in validation
         self.required = required
 
@@ -50,11 +99,44 @@ class Field:
         if isinstance(self, Relation):
             return self.manager(instance)
 
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            if self.name not in getattr(instance, '_deferred', ()):
+                raise
+
+        instance._load_deferred()
+
         return instance.__dict__[self.name]
 
     def __set__(self, instance, value):
+        # the previous value is needed to track the change
+        if self.name in getattr(instance, '_deferred', ()):
+            instance._load_deferred()
+
+        # remember the value stored in the database, so save() knows that this
+        # field changed and can remove the old value from the indexes
+        persisted = getattr(instance, '_persisted', False)
+
+        if persisted and self.name not in instance._old:
+            old_value = instance.__dict__.get(self.name)
+
+            if self.mutable or old_value != value:
+                instance._old[self.name] = old_value
+
         instance.__dict__[self.name] = value
 
+    def persisted_value(self, instance):
+        ''' Returns this field's value as it was last read from or written to
+        the database '''
+        if self.name in instance._old:
+            return instance._old[self.name]
+
+        if self.name in instance._deferred:
+            instance._load_deferred()
+
+        return instance.__dict__.get(self.name)
+
     def value_or_default(self, value):
         ''' Returns the given value or the specified default value for this
         field '''
@@ -86,6 +168,21 @@ class Field:
 
         return str(value)
 
+    def fetch(self, instance, pipe):
+        ''' Queues in the given pipeline the command that retrieves this
+        field's value. Only needed for external fields '''
+        raise NotImplementedError()
+
+    def recover_fetched(self, instance, value):
+        ''' Parses the result of the command queued by fetch() '''
+        raise NotImplementedError()
+
+    def fetch_op(self, cls):
+        ''' Describes for the cascade script how to read this external field
+        of an object of class cls, like fetch() does. Returns None if it can't
+        be described '''
+        return None
+
     def prepare(self, value):
         ''' Prepare this field's value to insert in database '''
         if value is None:
@@ -99,27 +196,69 @@ class Field:
 
     def save(self, instance, value, redis):
         ''' Sets this field's value in the databse '''
+        if self.range_index:
+            if value is not None:
+                redis.zadd(
+                    self.range_key(instance),
+                    {instance.id: self.score(value)}
+                )
+            else:
+                redis.zrem(self.range_key(instance), instance.id)
+
+        # set_key() and lex_member() take the value before prepare()
+        raw = value
         value = self.prepare(value)
+        old = instance._old.get(self.name)
 
         if value is not None:
             redis.hset(instance.key(), self.name, value)
         else:
             redis.hdel(instance.key(), self.name)
 
-        if self.index:
+        if self.index and self.unique:
             key = self.key(instance)
 
-            if self.name in instance._old:
-                redis.hdel(key, instance._old[self.name])
+            if old is not None:
+                redis.hdel(key, self.prepare(old))
 
             if value is not None:
                 redis.hset(key, value, instance.id)
 
+        if self.index and not self.unique:
+            if old is not None:
+                redis.srem(self.set_key(instance, old), instance.id)
+
+            if value is not None:
+                redis.sadd(self.set_key(instance, raw), instance.id)
+
+        if self.prefix_index:
+            key = self.lex_key(instance)
+
+            if old is not None:
+                redis.zrem(key, self.lex_member(old, instance.id))
+
+            if value is not None:
+                redis.zadd(key, {self.lex_member(raw, instance.id): 0})
+
     def _delete(self, instance, redis):
         ''' Deletes this field's value from the databse. Should be implemented
         in special cases '''
-        if self.index:
-            redis.hdel(self.key(instance), getattr(instance, self.name))
+        value = self.persisted_value(instance)
+
+        if self.index and value is not None:
+            if self.unique:
+                redis.hdel(self.key(instance), self.prepare(value))
+            else:
+                redis.srem(self.set_key(instance, value), instance.id)
+
+        if self.range_index:
+            redis.zrem(self.range_key(instance), instance.id)
+
+        if self.prefix_index and value is not None:
+            redis.zrem(
+                self.lex_key(instance),
+                self.lex_member(value, instance.id)
+            )
 
     def validate(self, instance, value, redis):
         '''
@@ -144,22 +283,178 @@ class Field:
         if self.allowed and value not in self.allowed:
             raise InvalidFieldError(self.name)
 
-        if self.index:
+        if self.index and self.unique:
             key = self.key(instance)
 
             old = debyte_string(redis.hget(key, value)) if value is not None else None
-            old_value = getattr(instance, self.name)
 
             if old is not None and old != instance.id:
                 raise NotUniqueFieldError(self.name)
-            elif old_value != value:
-                instance._old[self.name] = old_value
 
         return value
 
+    def delete_ops(self, cls):
+        ''' Describes for the cascade script how to remove this field's value
+        and index entries from an object of class cls. Returns None if
+        _delete() was customized in a subclass and can't be described '''
+        if overrides(type(self), '_delete', 'delete_ops'):
+            return None
+
+        ops = []
+
+        if self.index and self.unique:
+            ops.append(['hdel', self.key(cls), self.name])
+
+        if self.index and not self.unique:
+            prefix = '{}:sindex_{}:'.format(cls.cls_key(), self.name)
+
+            ops.append(['srem', prefix, self.name])
+
+        if self.range_index:
+            ops.append(['zrem', self.range_key(cls)])
+
+        if self.prefix_index:
+            ops.append(['zrem_lex', self.lex_key(cls), self.name])
+
+        return ops
+
     def key(self, obj):
         return obj.cls_key() + ':index_' + self.name
 
+    def set_key(self, obj, value):
+        ''' The key of the set that holds the ids of the objects with the given
+        value in a non unique index '''
+        return '{}:sindex_{}:{}'.format(
+            obj.cls_key(),
+            self.name,
+            self.prepare(value)
+        )
+
+    def access_paths(self, cls, conditions, ordering=False, reverse=False):
+        ''' Returns the ways this field's indexes can read the ids that match
+        some of the given conditions as (source, conditions answered) tuples.
+        ordering tells if the results are sorted by this field '''
+        conditions = [
+            c for c in conditions if c[0] == self.name and c[2] is not None
+        ]
+        paths = []
+
+        if self.index:
+            for condition in conditions:
+                if condition[2] is None:
+                    continue
+
+                if condition[1] == 'eq':
+                    values = [condition[2]]
+                elif condition[1] == 'in':
+                    values = condition[2]
+                else:
+                    continue
+
+                if self.unique:
+                    source = HashLookup(
+                        self.key(cls),
+                        [self.prepare(v) for v in values]
+                    )
+                elif condition[1] == 'eq':
+                    # a single set can be intersected with other conditions
+                    source = SetScan(self.set_key(cls, condition[2]))
+                else:
+                    source = SetUnion([self.set_key(cls, v) for v in values])
+
+                paths.append((source, [condition]))
+
+        # the indexes don't hold the objects without value, so they only give
+        # the ordering when some bound already excludes those objects
+        if self.range_index:
+            bounds = [c for c in conditions if c[1] in RANGE_FILTERS]
+
+            if bounds:
+                source = ScoreRange(
+                    self.range_key(cls),
+                    *self.score_range(bounds),
+                    reverse=reverse,
+                    fieldname=self.name
+                )
+                paths.append((source, bounds))
+
+        if self.prefix_index:
+            bounds = [c for c in conditions if c[1] in LEX_FILTERS]
+
+            if bounds:
+                source = LexRange(
+                    self.lex_key(cls),
+                    *self.lex_range(bounds),
+                    reverse=reverse,
+                    fieldname=self.name
+                )
+                paths.append((source, bounds))
+
+        return paths
+
+    def range_key(self, obj):
+        return obj.cls_key() + ':range_' + self.name
+
+    def score(self, value):
+        ''' The score of the given value in this field's range index '''
+        return float(self.prepare(value))
+
+    def score_range(self, bounds):
+        ''' Given a list of (fieldname, filter, value) tuples using lt, lte, gt
+        or gte returns the min and max arguments for ZRANGEBYSCORE '''
+        min, max = '-inf', '+inf'
+        low = high = None
+
+        for fieldname, query_func, value in bounds:
+            score = self.score(value)
+            exclusive = query_func in ('gt', 'lt')
+
+            if query_func in ('gt', 'gte'):
+                if low is None or score > low or (score == low and exclusive):
+                    low = score
+                    min = '(' + repr(score) if exclusive else repr(score)
+            elif high is None or score < high or (score == high and exclusive):
+                high = score
+                max = '(' + repr(score) if exclusive else repr(score)
+
+        return min, max
+
+    def lex_key(self, obj):
+        return obj.cls_key() + ':lex_' + self.name
+
+    def lex_member(self, value, id):
+        ''' The member of the prefix index that stands for the given value of
+        the object with the given id '''
+        return '{}\0{}'.format(self.prepare(value), id)
+
+    def lex_range(self, bounds):
+        ''' Given a list of (fieldname, filter, value) tuples using lt, lte,
+        gt, gte or startswith returns the min and max arguments for
+        ZRANGEBYLEX '''
+        low, high = (b'', True), (b'\xff', True)
+
+        for fieldname, query_func, value in bounds:
+            value = self.prepare(value).encode('utf8')
+
+            if query_func == 'startswith':
+                low = max(low, (value, True))
+                high = min(high, (value + b'\xff', True))
+            elif query_func == 'gt':
+                low = max(low, (value + b'\x01', True))
+            elif query_func == 'gte':
+                low = max(low, (value, True))
+            elif query_func == 'lt':
+                high = min(high, (value, False))
+            elif query_func == 'lte':
+                high = min(high, (value + b'\x01', False))
+
+        min_arg = b'-' if not low[0] else (b'[' if low[1] else b'(') + low[0]
+        max_arg = b'+' if high[0] == b'\xff' else (
+            (b'[' if high[1] else b'(') + high[0]
+        )
+
+        return min_arg, max_arg
+
 
 class Text(Field):
     pass
@@ -178,16 +473,50 @@ class TreeIndex(Field):
 
         key = self.key(instance)
 
-        if self.name in instance._old:
-            redis.hdel(key, instance._old[self.name])
+        if instance._old.get(self.name) is not None:
+            old = self.prepare(instance._old[self.name])
 
-        redis.sadd(key + ':' + value, instance.id)
+            redis.srem(key + ':' + old, instance.id)
+
+        if value is not None:
+            redis.sadd(key + ':' + value, instance.id)
 
     def _delete(self, instance, redis):
         ''' Deletes this field's value from the databse. Should be implemented
         in special cases '''
-        value = getattr(instance, self.name)
-        redis.srem(self.key(instance) + ':' + value, instance.id)
+        value = self.persisted_value(instance)
+
+        if value is not None:
+            redis.srem(
+                self.key(instance) + ':' + self.prepare(value),
+                instance.id
+            )
+
+    def delete_ops(self, cls):
+        if overrides(type(self), '_delete', 'delete_ops'):
+            return None
+
+        return [['srem', self.key(cls) + ':', self.name]]
+
+    def access_paths(self, cls, conditions, ordering=False, reverse=False):
+        paths = []
+
+        for condition in conditions:
+            if condition[0] != self.name or condition[2] is None:
+                continue
+
+            if condition[1] == 'eq':
+                key = self.key(cls) + ':' + self.prepare(condition[2])
+
+                paths.append((SetScan(key), [condition]))
+            elif condition[1] == 'in':
+                keys = [
+                    self.key(cls) + ':' + self.prepare(v) for v in condition[2]
+                ]
+
+                paths.append((SetUnion(keys), [condition]))
+
+        return paths
 
     def key(self, obj):
         return obj.cls_key() + ':tree_' + self.name
@@ -196,6 +525,8 @@ class TreeIndex(Field):
 class Hash(Text):
     ''' A value that should be stored as a hash, for example a password '''
 
+    query_type = None
+
     def init(self, value):
         ''' hash passwords given in the constructor '''
         value = self.value_or_default(value)
@@ -231,6 +562,8 @@ class Hash(Text):
 class Bool(Field):
     ''' A boolean value '''
 
+    query_type = 'bool'
+
     def validate(self, instance, value, redis):
         value = self.value_or_default(value)
 
@@ -257,6 +590,8 @@ class Bool(Field):
 class Integer(Field):
     ''' An integer value '''
 
+    query_type = 'num'
+
     def validate(self, instance, value, redis):
         value = self.value_or_default(value)
 
@@ -284,6 +619,8 @@ class Integer(Field):
 
 class Float(Field):
 
+    query_type = 'num'
+
     def validate(self, instance, value, redis):
         value = self.value_or_default(value)
 
@@ -309,6 +646,8 @@ class Float(Field):
 class Datetime(Field):
     ''' A datetime that can be used transparently as such in the model '''
 
+    query_type = 'num'
+
     def validate(self, instance, value, redis):
         '''
         Validates data obtained from a request in ISO 8061 and returns it in Datetime data type
@@ -353,6 +692,10 @@ class Datetime(Field):
 class Location(Field):
     ''' A geolocation '''
 
+    external = True
+    query_type = None
+    mutable = True
+
     def prepare(self, value):
         return value
 
@@ -360,7 +703,10 @@ class Location(Field):
         key = self.key(instance)
 
         if value is not None:
-            redis.geoadd(key, value.lon, value.lat, instance.id)
+            # the signature of geoadd() changed in redis-py 4
+            redis.execute_command(
+                'GEOADD', key, value.lon, value.lat, instance.id
+            )
         else:
             redis.zrem(key, instance.id)
 
@@ -369,6 +715,12 @@ class Location(Field):
 
         redis.zrem(key, instance.id)
 
+    def delete_ops(self, cls):
+        if overrides(type(self), '_delete', 'delete_ops'):
+            return None
+
+        return [['zrem', self.key(cls)]]
+
     def to_json(self, value):
         if value is None:
             return None
@@ -376,16 +728,36 @@ class Location(Field):
         return value.to_json()
 
     def recover(self, instance, data, redis):
-        key = self.key(instance)
-        value = redis.geopos(key, instance.id)
+        return self.recover_fetched(
+            instance,
+            redis.geopos(self.key(instance), instance.id)
+        )
+
+    def fetch(self, instance, pipe):
+        pipe.geopos(self.key(instance), instance.id)
+
+    def access_paths(self, cls, conditions, ordering=False, reverse=False):
+        return [
+            (GeoRadius(self.key(cls), *c[2]), [c])
+            for c in conditions
+            if c[0] == self.name and c[1] == 'near' and c[2] is not None
+        ]
+
+    def fetch_op(self, cls):
+        if overrides(type(self), 'fetch', 'fetch_op'):
+            return None
 
+        return ['geopos', self.key(cls)]
+
+    def recover_fetched(self, instance, value):
         if not value:
             return None
 
         if value[0] is None:
             return None
 
-        return datamodel.Location(*value[0])
+        # the cascade script returns the coordinates as strings
+        return datamodel.Location(*map(float, value[0]))
 
     def validate(self, instance, value, redis):
         value = self.value_or_default(value)
@@ -412,6 +784,10 @@ class Location(Field):
 class Dict(Field):
     ''' A dict that can be used transparently as such in the model '''
 
+    external = True
+    query_type = None
+    mutable = True
+
     def validate(self, instance, value, redis):
         if not value:
             return dict()
@@ -440,6 +816,12 @@ class Dict(Field):
 
         redis.delete(key)
 
+    def delete_ops(self, cls):
+        if overrides(type(self), '_delete', 'delete_ops'):
+            return None
+
+        return [['del', ':dict_' + self.name]]
+
     def to_json(self, value):
         if value is None:
             return dict()
@@ -447,10 +829,23 @@ class Dict(Field):
         return value
 
     def recover(self, instance, data, redis):
-        key = self.key(instance)
+        return self.recover_fetched(
+            instance,
+            redis.hget(self.key(instance), self.name)
+        )
+
+    def fetch(self, instance, pipe):
+        pipe.hget(self.key(instance), self.name)
+
+    def fetch_op(self, cls):
+        if overrides(type(self), 'fetch', 'fetch_op'):
+            return None
+
+        return ['hget', ':dict_' + self.name, self.name]
 
+    def recover_fetched(self, instance, value):
         try:
-            value = json.loads(redis.hget(key, self.name))
+            value = json.loads(value)
         except TypeError:
             value = dict()
 
@@ -460,6 +855,15 @@ class Dict(Field):
         return '{}:{}:dict_{}'.format(obj.cls_key(), obj.id, self.name)
 
 
+def overrides(cls, name, other):
+    ''' Tells if the method name of cls is defined in a subclass of the one
+    that defines the method other '''
+    owner = next(c for c in cls.__mro__ if name in c.__dict__)
+    other_owner = next(c for c in cls.__mro__ if other in c.__dict__)
+
+    return owner is not other_owner and issubclass(owner, other_owner)
+
+
 def model_from_spec(modelspec):
     if type(modelspec) == str:
         pieces = modelspec.split('.')
@@ -471,15 +875,91 @@ def model_from_spec(modelspec):
 
 class Relation(Field):
 
+    query_type = None
+
+    # how the cascade script reads this relation: 'fid' for ids stored in the
+    # object's hash, 'srel' and 'zrel' for sets and sorted sets
+    kind = None
+
     def __init__(self, model, *, private=False, on_delete='set_null', inverse=None):
         self.index = False
+        self.unique = True
+        self.range_index = False
+        self.prefix_index = False
         self.modelspec = model
         self.private = private
         self.on_delete = on_delete
         self.inverse = inverse
         self.fillable = False
 
-    def _delete(self, instance, redis):
+    def queue_related_ids(self, instance, pipe):
+        ''' Queues in the pipeline the command that reads the ids related to
+        the given object through this field '''
+        raise NotImplementedError()
+
+    def related_ids(self, result):
+        ''' Turns the result of the command queued by queue_related_ids() into
+        a list of ids '''
+        return [debyte_string(id) for id in result]
+
+    def unrelates_on_delete(self):
+        ''' Tells if deleting an object removes it from the inverse relation of
+        the related objects '''
+        return self.on_delete == 'set_null' and self.inverse
+
+    def queue_unrelate(self, instance, ids, pipe):
+        ''' Queues the commands that remove the object being deleted from the
+        inverse relation of the related objects with the given ids '''
+        model = model_from_spec(self.modelspec)
+        inverse = getattr(model, self.inverse)
+
+        for id in ids:
+            inverse.unrelate_id(model, id, instance, pipe)
+
+    def unrelate_id(self, cls, id, obj, pipe):
+        ''' Queues the command that removes obj from this relation of the
+        object of class cls with the given id '''
+        raise NotImplementedError()
+
+    def _delete(self, instance, pipe):
+        ''' Queues the commands that remove the keys of this relation, the
+        related objects are handled by Model.delete() '''
+        pass
+
+    def delete_ops(self, cls):
+        # relations are described by relation_spec()
+        return []
+
+    def relation_spec(self):
+        ''' Describes this relation for the cascade script. Returns None if it
+        can't be described '''
+        if self.kind is None:
+            return None
+
+        model = model_from_spec(self.modelspec)
+        spec = [
+            self.kind,
+            self.name,
+            self.on_delete,
+            model.cls_key(),
+            bool(self.unrelates_on_delete()),
+            None,
+            None,
+        ]
+
+        if spec[4]:
+            inverse = getattr(model, self.inverse)
+
+            if inverse.kind is None:
+                return None
+
+            spec[5:] = [inverse.kind, self.inverse]
+
+        return spec
+
+    async def _adelete(self, instance, pipe):
+        ''' Applies the on_delete rule of this field for models bound to an
+        AsyncEngine, the writes are queued in the given pipeline '''
         raise NotImplementedError()
 
 
@@ -489,6 +969,8 @@ class SingleRelation(Relation):
 
 class ForeignIdRelation(SingleRelation):
 
+    kind = 'fid'
+
     def __init__(self, model, *, private=False, on_delete='set_null', inverse=None):
         super().__init__(model, private=private, on_delete=on_delete, inverse=inverse)
         self.default = None
@@ -509,8 +991,20 @@ class ForeignIdRelation(SingleRelation):
             assert type(value) == model_from_spec(self.modelspec)
             redis.hset(instance.key(), self.name, value.id)
 
-    def _delete(self, instance, redis):
-        item = getattr(instance, self.name).get()
+    def queue_related_ids(self, instance, pipe):
+        pipe.hget(instance.key(), self.name)
+
+    def related_ids(self, result):
+        return [debyte_string(result)] if result else []
+
+    def unrelates_on_delete(self):
+        return self.on_delete != 'cascade' and self.inverse
+
+    def unrelate_id(self, cls, id, obj, pipe):
+        pipe.hdel('{}:{}:obj'.format(cls.cls_key(), id), self.name)
+
+    async def _adelete(self, instance, pipe):
+        item = await getattr(instance, self.name).aget()
 
         if item is None:
             return
@@ -519,9 +1013,9 @@ class ForeignIdRelation(SingleRelation):
             raise DeleteRestrictedError('attempt to delete with relations and restrict flag')
 
         if self.on_delete == 'cascade':
-            item.delete()
+            await item.adelete()
         elif self.inverse:
-            getattr(item, self.inverse)._unrelate(instance, redis)
+            getattr(item, self.inverse)._unrelate(instance, pipe)
 
     def manager(self, instance):
         return SingleRelationManager(instance, self.inverse, self.modelspec, self.name)
@@ -564,6 +1058,32 @@ class SingleRelationManager:
         if self.inverse:
             getattr(obj, self.inverse)._relate(self.instance, redis)
 
+    async def aget(self):
+        redis = self.instance.get_redis()
+        value = debyte_string(await redis.hget(self.instance.key(), self.name))
+
+        return await model_from_spec(self.modelspec).aget(value)
+
+    async def aset(self, obj):
+        pipe = self.instance.get_redis().pipeline()
+        prev = await self.aget()
+
+        if prev is not None and self.inverse:
+            getattr(prev, self.inverse)._unrelate(self.instance, pipe)
+
+        if obj is None:
+            pipe.hdel(self.instance.key(), self.name)
+        else:
+            pipe.hset(self.instance.key(), self.name, obj.id)
+
+            if self.inverse:
+                getattr(obj, self.inverse)._relate(self.instance, pipe)
+
+        await pipe.execute()
+
+        if obj is None:
+            setattr(self.instance, self.name, None)
+
 
 class MultipleRelationManager:
 
@@ -600,21 +1120,198 @@ class MultipleRelationManager:
     def all(self, **kwargs):
         ''' Returns this relation '''
         redis = self.instance.get_redis()
-        related = list(map(
-            lambda id: model_from_spec(self.modelspec).get(debyte_string(id)),
+
+        return model_from_spec(self.modelspec).get_many(map(
+            debyte_string,
             self.get_related_ids(redis, **kwargs)
         ))
 
-        return related
+    def ids(self):
+        ''' Returns the set of related ids without loading the objects '''
+        ids = self.get_related_ids(self.instance.get_redis())
+
+        return set(map(debyte_string, ids))
 
     def remove(self, value):
-        assert isinstance(value, model_from_spec(self.modelspec))
-        redis = self.instance.get_redis()
+        self.remove_many([value])
+
+    def add_many(self, objs):
+        ''' Relates the given objects in a single transaction '''
+        objs = list(objs)
+        pipe = self._queue_add_many(objs)
+
+        if pipe is not None:
+            pipe.execute()
+            self._invalidate(obj.id for obj in objs)
 
-        self._unrelate(value, redis)
+    def remove_many(self, objs):
+        ''' Removes the given objects from this relation in a single
+        transaction '''
+        objs = list(objs)
+        pipe = self._queue_remove_many(objs)
+
+        if pipe is not None:
+            pipe.execute()
+            self._invalidate(obj.id for obj in objs)
+
+    def _queue_add_many(self, objs):
+        ''' Returns a transaction with the commands that relate the given
+        objects, or None if there are none '''
+        model = model_from_spec(self.modelspec)
+
+        assert all(isinstance(obj, model) for obj in objs)
+
+        if not objs:
+            return None
+
+        pipe = self.instance.get_redis().pipeline()
+
+        self._relate_all(objs, pipe)
+
+        if self.inverse:
+            for obj in objs:
+                getattr(obj, self.inverse)._relate(self.instance, pipe)
+
+        return pipe
+
+    def _queue_remove_many(self, objs):
+        ''' Returns a transaction with the commands that unrelate the given
+        objects, or None if there are none '''
+        model = model_from_spec(self.modelspec)
+
+        assert all(isinstance(obj, model) for obj in objs)
+
+        if not objs:
+            return None
+
+        pipe = self.instance.get_redis().pipeline()
+
+        for obj in objs:
+            self._unrelate(obj, pipe)
+
+        self._queue_unrelate_inverse([obj.id for obj in objs], pipe)
+
+        return pipe
+
+    def _queue_clear(self, pipe):
+        ''' Reads the related ids with the given pipeline, which watches the
+        relation key, and queues the commands that empty this relation.
+        Returns the ids '''
+        ids = set(map(debyte_string, self.get_related_ids(pipe)))
+
+        pipe.multi()
+        pipe.delete(self.relation_key)
+        self._queue_unrelate_inverse(ids, pipe)
+
+        return ids
+
+    async def _aqueue_clear(self, pipe):
+        ''' Same as _queue_clear() for models bound to an AsyncEngine '''
+        ids = set(map(debyte_string, await self.get_related_ids(pipe)))
+
+        pipe.multi()
+        pipe.delete(self.relation_key)
+        self._queue_unrelate_inverse(ids, pipe)
+
+        return ids
+
+    def _queue_unrelate_inverse(self, ids, pipe):
+        ''' Queues the commands that remove this object from the inverse
+        relation of the related objects with the given ids, without loading
+        them '''
+        if not self.inverse:
+            return
+
+        model = model_from_spec(self.modelspec)
+        inverse = getattr(model, self.inverse)
+
+        for id in ids:
+            inverse.unrelate_id(model, id, self.instance, pipe)
+
+    def _invalidate(self, ids):
+        ''' Drops the related objects from the engine's cache after a change
+        of their inverse relation '''
+        cache = self.instance.get_engine().cache
+
+        if cache is None or not self.inverse:
+            return
+
+        model = model_from_spec(self.modelspec)
+
+        for id in ids:
+            cache.invalidate('{}:{}:obj'.format(model.cls_key(), id))
+
+    async def aset(self, value):
+        pipe = self.instance.get_redis().pipeline()
+
+        pipe.delete(self.relation_key)
+
+        self._relate_all(value, pipe)
+
+        for related in value:
+            if self.inverse:
+                getattr(related, self.inverse)._relate(self.instance, pipe)
+
+        await pipe.execute()
+
+    async def aadd(self, obj):
+        assert isinstance(obj, model_from_spec(self.modelspec))
+        pipe = self.instance.get_redis().pipeline()
+
+        self._relate(obj, pipe)
 
         if self.inverse:
-            getattr(value, self.inverse)._unrelate(self.instance, redis)
+            getattr(obj, self.inverse)._relate(self.instance, pipe)
+
+        await pipe.execute()
+
+    async def aall(self, **kwargs):
+        redis = self.instance.get_redis()
+
+        return await model_from_spec(self.modelspec).aget_many(map(
+            debyte_string,
+            await self.get_related_ids(redis, **kwargs)
+        ))
+
+    async def aids(self):
+        ''' Same as ids() for models bound to an AsyncEngine '''
+        ids = await self.get_related_ids(self.instance.get_redis())
+
+        return set(map(debyte_string, ids))
+
+    async def aremove(self, value):
+        await self.aremove_many([value])
+
+    async def aadd_many(self, objs):
+        ''' Same as add_many() for models bound to an AsyncEngine '''
+        objs = list(objs)
+        pipe = self._queue_add_many(objs)
+
+        if pipe is not None:
+            await pipe.execute()
+            self._invalidate(obj.id for obj in objs)
+
+    async def aremove_many(self, objs):
+        ''' Same as remove_many() for models bound to an AsyncEngine '''
+        objs = list(objs)
+        pipe = self._queue_remove_many(objs)
+
+        if pipe is not None:
+            await pipe.execute()
+            self._invalidate(obj.id for obj in objs)
+
+    async def acount(self, **kwargs):
+        return await self.count(**kwargs)
+
+    async def aclear(self):
+        ''' Same as clear() for models bound to an AsyncEngine '''
+        ids = await self.instance.get_redis().transaction(
+            self._aqueue_clear,
+            self.relation_key,
+            value_from_callable=True
+        )
+
+        self._invalidate(ids)
 
     def count(self):
         raise NotImplementedError('count is not implemented yet for this subclass of MultipleRelation')
@@ -631,9 +1328,18 @@ class MultipleRelationManager:
         raise NotImplementedError()
 
     def clear(self):
-        ''' Clears all the relations of this field to another model '''
-        for related in self.all():
-            self.remove(related)
+        ''' Clears all the relations of this field to another model. The
+        related objects are not loaded, the inverse relations are updated
+        using their ids in a single transaction. The relation is watched
+        while its ids are read, so the transaction is retried if an object is
+        added or removed meanwhile '''
+        ids = self.instance.get_redis().transaction(
+            self._queue_clear,
+            self.relation_key,
+            value_from_callable=True
+        )
+
+        self._invalidate(ids)
 
 
 class SetRelationManager(MultipleRelationManager):
@@ -653,10 +1359,65 @@ class SetRelationManager(MultipleRelationManager):
     def count(self):
         return self.instance.get_redis().scard(self.relation_key)
 
-    def q(self):
+    def iter(self, batch_size=DEFAULT_BATCH_SIZE):
+        ''' Yields the related objects reading batch_size ids at a time with
+        SSCAN, so they are never all in memory '''
         redis = self.instance.get_redis()
+        model = model_from_spec(self.modelspec)
+        cursor = 0
+
+        while True:
+            cursor, ids = redis.sscan(
+                self.relation_key,
+                cursor,
+                count=batch_size
+            )
+
+            for obj in model.get_many(map(debyte_string, ids)):
+                if obj is not None:
+                    yield obj
+
+            if not int(cursor):
+                return
+
+    async def aiter(self, batch_size=DEFAULT_BATCH_SIZE):
+        ''' Same as iter() for models bound to an AsyncEngine '''
+        redis = self.instance.get_redis()
+        model = model_from_spec(self.modelspec)
+        cursor = 0
+
+        while True:
+            cursor, ids = await redis.sscan(
+                self.relation_key,
+                cursor,
+                count=batch_size
+            )
+
+            for obj in await model.aget_many(map(debyte_string, ids)):
+                if obj is not None:
+                    yield obj
+
+            if not int(cursor):
+                return
+
+    def q(self):
+        return QuerySet(model_from_spec(self.modelspec), self.relation_key)
+
+    def expression(self):
+        ''' Returns this relation as a set expression, to combine it with
+        other relations and indexes of the same model '''
+        model = model_from_spec(self.modelspec)
+
+        return SetExpression(model, self.relation_key)
+
+    def __and__(self, other):
+        return self.expression() & other
+
+    def __or__(self, other):
+        return self.expression() | other
 
-        return QuerySet(model_from_spec(self.modelspec), redis.sscan_iter(self.relation_key))
+    def __sub__(self, other):
+        return self.expression() - other
 
     def __contains__(self, item):
         if not isinstance(item, model_from_spec(self.modelspec)):
@@ -664,6 +1425,14 @@ class SetRelationManager(MultipleRelationManager):
 
         return self.instance.get_redis().sismember(self.relation_key, item.id)
 
+    async def acontains(self, item):
+        if not isinstance(item, model_from_spec(self.modelspec)):
+            return False
+
+        redis = self.instance.get_redis()
+
+        return await redis.sismember(self.relation_key, item.id)
+
 
 class SortedSetRelationManager(MultipleRelationManager):
 
@@ -697,8 +1466,150 @@ class SortedSetRelationManager(MultipleRelationManager):
 
         return redis.zrange(self.relation_key, 0, -1)
 
-    def count(self):
+    def score(self, value):
+        ''' Returns the score of the given value of the sort key. Numbers and
+        redis score bounds like '-inf' or '(5' are used as they are '''
+        if isinstance(value, (int, float, str)):
+            return value
+
+        field = getattr(model_from_spec(self.modelspec), self.sort_key)
+
+        return int(field.prepare(value))
+
+    def _range(self, redis, start, stop, reverse):
+        if reverse:
+            return redis.zrevrange(self.relation_key, start, stop)
+
+        return redis.zrange(self.relation_key, start, stop)
+
+    def _by_score(self, redis, min, max, offset, count, reverse,
+                  withscores=False):
+        min, max = self.score(min), self.score(max)
+        num = -1 if count is None else count
+
+        if reverse:
+            return redis.zrevrangebyscore(
+                self.relation_key,
+                max,
+                min,
+                start=offset,
+                num=num,
+                withscores=withscores
+            )
+
+        return redis.zrangebyscore(
+            self.relation_key,
+            min,
+            max,
+            start=offset,
+            num=num,
+            withscores=withscores
+        )
+
+    def _page(self, cursor, count, reverse):
+        ''' Reads the (id, score) items of the page after the given cursor '''
+        if cursor is None:
+            min, max, skip = '-inf', '+inf', 0
+        else:
+            score, skip = self._load_cursor(cursor)
+            min, max = ('-inf', score) if reverse else (score, '+inf')
+
+        return self._by_score(
+            self.instance.get_redis(),
+            min,
+            max,
+            skip,
+            count,
+            reverse,
+            withscores=True
+        )
+
+    def _load_cursor(self, cursor):
+        return json.loads(urlsafe_b64decode(cursor.encode()).decode())
+
+    def _next_cursor(self, items, count, cursor):
+        ''' Returns the cursor of the page after the given (id, score) items,
+        which holds the last score read and how many objects with that score
+        were already read, or None if there are no more '''
+        if len(items) < count:
+            return None
+
+        score = items[-1][1]
+        skip = sum(1 for id, s in items if s == score)
+
+        if cursor is not None:
+            previous, previous_skip = self._load_cursor(cursor)
+
+            if previous == score:
+                skip += previous_skip
+
+        return urlsafe_b64encode(json.dumps([score, skip]).encode()).decode()
+
+    def range(self, start=0, stop=-1, *, reverse=False):
+        ''' Returns the related objects between the given positions, both
+        included, ordered by the sort key or from the last one if reverse is
+        True, as in ``truck.trips.range(0, 19, reverse=True)`` '''
+        ids = self._range(self.instance.get_redis(), start, stop, reverse)
+        model = model_from_spec(self.modelspec)
+
+        return model.get_many(map(debyte_string, ids))
+
+    def by_score(self, min='-inf', max='+inf', offset=0, count=None, *,
+                 reverse=False):
+        ''' Returns the related objects whose sort key is between min and max,
+        skipping the first offset ones and returning at most count. The
+        bounds can be values of the sort key or redis score bounds '''
+        redis = self.instance.get_redis()
+        ids = self._by_score(redis, min, max, offset, count, reverse)
+        model = model_from_spec(self.modelspec)
+
+        return model.get_many(map(debyte_string, ids))
+
+    def page(self, cursor=None, count=20, *, reverse=False):
+        ''' Returns at most count related objects and the cursor of the next
+        page, which is None after the last one. The cursor holds a score, so
+        the pages don't shift when objects before it are added or
+        removed '''
+        items = self._page(cursor, count, reverse)
+        model = model_from_spec(self.modelspec)
+        objs = model.get_many([debyte_string(id) for id, score in items])
+
+        return objs, self._next_cursor(items, count, cursor)
+
+    async def arange(self, start=0, stop=-1, *, reverse=False):
+        ''' Same as range() for models bound to an AsyncEngine '''
+        redis = self.instance.get_redis()
+        ids = await self._range(redis, start, stop, reverse)
+        model = model_from_spec(self.modelspec)
+
+        return await model.aget_many(map(debyte_string, ids))
+
+    async def aby_score(self, min='-inf', max='+inf', offset=0, count=None, *,
+                        reverse=False):
+        ''' Same as by_score() for models bound to an AsyncEngine '''
         redis = self.instance.get_redis()
+        ids = await self._by_score(redis, min, max, offset, count, reverse)
+        model = model_from_spec(self.modelspec)
+
+        return await model.aget_many(map(debyte_string, ids))
+
+    async def apage(self, cursor=None, count=20, *, reverse=False):
+        ''' Same as page() for models bound to an AsyncEngine '''
+        items = await self._page(cursor, count, reverse)
+        model = model_from_spec(self.modelspec)
+        objs = await model.aget_many(
+            [debyte_string(id) for id, score in items]
+        )
+
+        return objs, self._next_cursor(items, count, cursor)
+
+    def count(self, score=None):
+        ''' Returns the amount of related objects, or of the ones whose sort
+        key is in the given (min, max) score range '''
+        redis = self.instance.get_redis()
+
+        if score:
+            return redis.zcount(self.relation_key, *map(self.score, score))
 
         return redis.zcard(self.relation_key)
 
@@ -710,6 +1621,14 @@ class SortedSetRelationManager(MultipleRelationManager):
 
         return redis.zscore(self.relation_key, item.id) is not None
 
+    async def acontains(self, item):
+        if not isinstance(item, model_from_spec(self.modelspec)):
+            return False
+
+        redis = self.instance.get_redis()
+
+        return await redis.zscore(self.relation_key, item.id) is not None
+
 
 class MultipleRelation(Relation):
     ''' Indicates that this field can associate with multiple objects of some other class '''
@@ -717,28 +1636,40 @@ class MultipleRelation(Relation):
     def manager(self):
         raise NotImplementedError('Must be implemented in subclass')
 
-    def _delete(self, instance, redis):
-        key = self.key(instance)
+    def key(self, instance):
+        return self.id_key(type(instance), instance.id)
+
+    def queue_related_ids(self, instance, pipe):
+        self.manager(instance).get_related_ids(pipe)
 
-        items = getattr(instance, self.name).all()
+    def _delete(self, instance, pipe):
+        pipe.delete(self.key(instance))
+
+    async def _adelete(self, instance, pipe):
+        items = await getattr(instance, self.name).aall()
 
         if self.on_delete == 'restrict' and len(items) > 0:
             raise DeleteRestrictedError('attempt to delete with relations and restrict flag')
 
         for item in items:
             if self.on_delete == 'cascade':
-                item.delete()
+                await item.adelete()
             elif self.on_delete == 'set_null' and self.inverse:
-                getattr(item, self.inverse)._unrelate(instance, redis)
+                getattr(item, self.inverse)._unrelate(instance, pipe)
 
-        redis.delete(key)
+        pipe.delete(self.key(instance))
 
 
 class SetRelation(MultipleRelation):
     ''' A relationship with another model where order doesn't matter '''
 
-    def key(self, instance):
-        return '{}:{}:srel_{}'.format(instance.cls_key(), instance.id, self.name)
+    kind = 'srel'
+
+    def id_key(self, cls, id):
+        return '{}:{}:srel_{}'.format(cls.cls_key(), id, self.name)
+
+    def unrelate_id(self, cls, id, obj, pipe):
+        pipe.srem(self.id_key(cls, id), obj.id)
 
     def manager(self, instance):
         return SetRelationManager(instance, self.key(instance), self.inverse, self.modelspec)
@@ -748,12 +1679,17 @@ class SortedSetRelation(MultipleRelation):
     ''' A relationship with another model that ensures the same ordering every
     time '''
 
+    kind = 'zrel'
+
     def __init__(self, model, sort_key, **kwargs):
         super().__init__(model, **kwargs)
         self.sort_key = sort_key
 
-    def key(self, instance):
-        return '{}:{}:zrel_{}'.format(instance.cls_key(), instance.id, self.name)
+    def id_key(self, cls, id):
+        return '{}:{}:zrel_{}'.format(cls.cls_key(), id, self.name)
+
+    def unrelate_id(self, cls, id, obj, pipe):
+        pipe.zrem(self.id_key(cls, id), obj.id)
 
     def manager(self, instance):
         return SortedSetRelationManager(instance, self.key(instance), self.inverse, self.modelspec, self.sort_key)
@@ -0,0 +1,165 @@
+from coralillo.datamodel import debyte_string
+from coralillo.errors import ImproperlyConfiguredError
+from coralillo.fields import Relation
+from coralillo.queryset import HashLookup, SetScan
+
+
+class CompoundIndex:
+    ''' An index over the values of several fields, declared in the model's
+    Meta::
+
+        class Meta:
+            indexes = [
+                CompoundIndex('tenant', 'plate'),
+                CompoundIndex('driver', 'shift_date', unique=False),
+            ]
+
+    A unique index maps the values to the id in a redis hash, a non unique
+    one keeps a set with the ids of the objects that have each combination
+    of values. Objects with a None value in any of the fields are not
+    indexed. Relations can't be part of a compound index, since they are
+    written by their managers instead of save() '''
+
+    def __init__(self, *fieldnames, unique=True):
+        if len(fieldnames) < 2:
+            raise ImproperlyConfiguredError(
+                'A compound index needs at least two fields'
+            )
+
+        self.fieldnames = fieldnames
+        self.unique = unique
+        self.name = '_'.join(fieldnames)
+        self.fields = None
+
+    def bind(self, fields):
+        ''' Finds the fields of this index among the given (name, field)
+        tuples of the model '''
+        fields = dict(fields)
+
+        for fieldname in self.fieldnames:
+            if fieldname not in fields:
+                raise ImproperlyConfiguredError(
+                    'Field {} of compound index {} does not exist'.format(
+                        fieldname,
+                        self.name
+                    )
+                )
+
+            if isinstance(fields[fieldname], Relation):
+                raise ImproperlyConfiguredError(
+                    'Relation {} can not be part of compound index {}'.format(
+                        fieldname,
+                        self.name
+                    )
+                )
+
+        self.fields = [fields[fieldname] for fieldname in self.fieldnames]
+
+    def member(self, values):
+        ''' Joins the prepared values of the fields. Returns None if any of
+        them is None '''
+        prepared = [
+            field.prepare(value) for field, value in zip(self.fields, values)
+        ]
+
+        if any(value is None for value in prepared):
+            return None
+
+        return '\0'.join(prepared)
+
+    def key(self, cls):
+        return '{}:cindex_{}'.format(cls.cls_key(), self.name)
+
+    def set_key(self, cls, member):
+        return '{}:csindex_{}:{}'.format(cls.cls_key(), self.name, member)
+
+    def changed(self, instance):
+        ''' Tells if any of the fields of this index changed since the object
+        was last loaded or saved '''
+        return any(fieldname in instance._old for fieldname in self.fieldnames)
+
+    def save(self, instance, pipe):
+        ''' Queues in the pipeline the commands that move the object to the
+        entry of its current values '''
+        cls = type(instance)
+        old = self.member(
+            field.persisted_value(instance) for field in self.fields
+        )
+        new = self.member(
+            getattr(instance, fieldname) for fieldname in self.fieldnames
+        )
+
+        if instance._persisted and old is not None and old != new:
+            self.remove(cls, instance.id, old, pipe)
+
+        if new is not None:
+            if self.unique:
+                pipe.hset(self.key(cls), new, instance.id)
+            else:
+                pipe.sadd(self.set_key(cls, new), instance.id)
+
+    def delete(self, instance, pipe):
+        member = self.member(
+            field.persisted_value(instance) for field in self.fields
+        )
+
+        if member is not None:
+            self.remove(type(instance), instance.id, member, pipe)
+
+    def remove(self, cls, id, member, pipe):
+        if self.unique:
+            pipe.hdel(self.key(cls), member)
+        else:
+            pipe.srem(self.set_key(cls, member), id)
+
+    def delete_ops(self, cls):
+        ''' Describes for the cascade script how to remove an object of class
+        cls from this index '''
+        if self.unique:
+            return [['hdel', self.key(cls)] + list(self.fieldnames)]
+
+        return [['srem', self.set_key(cls, '')] + list(self.fieldnames)]
+
+    def lookup(self, cls, values, redis):
+        ''' Returns the id mapped to the given values of an unique index '''
+        member = self.member(values)
+
+        if member is None:
+            return None
+
+        return redis.hget(self.key(cls), member)
+
+    def validate(self, instance, redis):
+        ''' Tells if the values of the object are not used by another object
+        in this unique index '''
+        if not self.unique:
+            return True
+
+        values = [
+            getattr(instance, fieldname) for fieldname in self.fieldnames
+        ]
+        id = self.lookup(type(instance), values, redis)
+
+        return id is None or debyte_string(id) == instance.id
+
+    def access_paths(self, cls, conditions):
+        ''' Returns the way this index reads the ids when there is an equality
+        condition for each of its fields '''
+        used = []
+
+        for fieldname in self.fieldnames:
+            for condition in conditions:
+                matches = condition[0] == fieldname and condition[1] == 'eq'
+
+                if matches and condition[2] is not None:
+                    used.append(condition)
+                    break
+            else:
+                return []
+
+        member = self.member(condition[2] for condition in used)
+
+        if self.unique:
+            return [(HashLookup(self.key(cls), [member]), used)]
+
+        return [(SetScan(self.set_key(cls, member)), used)]
@@ -0,0 +1,188 @@
+-- Deletes an object and everything deleted in cascade with it. Nothing is
+-- written if a relation with on_delete='restrict' is not empty.
+--
+-- ARGV[1] the relation graph, a json object that maps the key prefix of each
+--         model to:
+--         ops       how to remove the value and index entries of each field,
+--                   lists of an operation, a key and field names:
+--                   {'hdel', key, fields...}     HDEL key values
+--                   {'srem', key, fields...}     SREM key..values id
+--                   {'zrem', key}                ZREM key id
+--                   {'zrem_lex', key, fields...} ZREM key values..'\0'..id
+--                   {'del', suffix}              DEL prefix:id..suffix
+--                   several values are joined with '\0'
+--         relations {kind, name, on_delete, target, unrelate, inverse kind,
+--                   inverse name} kind is 'fid', 'srel' or 'zrel'
+--         allow     the model has an allow key
+--         notify    the model publishes its events
+--         fetch     how to read the external fields of the events:
+--                   {'geopos', key}             GEOPOS key id
+--                   {'hget', suffix, field}     HGET prefix:id..suffix field
+-- ARGV[2] the key prefix of the object's model
+-- ARGV[3] the id of the object
+--
+-- Returns a list with the key of every deleted object followed by its values
+-- and the replies of its fetch operations if its model notifies events, or
+-- an error starting with 'restricted'
+local graph = cjson.decode(ARGV[1])
+
+local function obj_key(prefix, id)
+    return prefix..':'..id..':obj'
+end
+
+local function rel_key(prefix, id, kind, name)
+    return prefix..':'..id..':'..kind..'_'..name
+end
+
+local function related_ids(prefix, id, relation)
+    local kind, name = relation[1], relation[2]
+
+    if kind == 'fid' then
+        local related = redis.call('HGET', obj_key(prefix, id), name)
+
+        if related then
+            return {related}
+        end
+
+        return {}
+    elseif kind == 'srel' then
+        return redis.call('SMEMBERS', rel_key(prefix, id, kind, name))
+    else
+        return redis.call('ZRANGE', rel_key(prefix, id, kind, name), 0, -1)
+    end
+end
+
+-- first read everything, so a restriction is found before writing
+local nodes = {{ARGV[2], ARGV[3]}}
+local seen = {[ARGV[2]..':'..ARGV[3]] = true}
+local unrelated = {}
+local i = 1
+
+while i <= #nodes do
+    local prefix, id = nodes[i][1], nodes[i][2]
+
+    for _, relation in ipairs(graph[prefix].relations) do
+        local ids = related_ids(prefix, id, relation)
+        local on_delete, target = relation[3], relation[4]
+
+        if #ids > 0 then
+            if on_delete == 'restrict' then
+                return redis.error_reply('restricted: attempt to delete with relations and restrict flag')
+            elseif on_delete == 'cascade' then
+                for _, related in ipairs(ids) do
+                    local fqn = target..':'..related
+
+                    if not seen[fqn] and redis.call('EXISTS', obj_key(target, related)) == 1 then
+                        seen[fqn] = true
+                        nodes[#nodes+1] = {target, related}
+                    end
+                end
+            elseif relation[5] then
+                unrelated[#unrelated+1] = {id, relation, ids}
+            end
+        end
+    end
+
+    i = i + 1
+end
+
+local function joined(values, op)
+    local pieces = {}
+
+    for j = 3, #op do
+        local value = values[op[j]]
+
+        if not value then
+            return nil
+        end
+
+        pieces[#pieces+1] = value
+    end
+
+    return table.concat(pieces, '\0')
+end
+
+local result = {}
+
+for _, node in ipairs(nodes) do
+    local prefix, id = node[1], node[2]
+    local model = graph[prefix]
+    local key = obj_key(prefix, id)
+    local data = redis.call('HGETALL', key)
+    local fetched = {}
+    local values = {}
+
+    if model.notify then
+        for j, op in ipairs(model.fetch) do
+            if op[1] == 'geopos' then
+                fetched[j] = redis.call('GEOPOS', op[2], id)
+            else
+                fetched[j] = redis.call('HGET', prefix..':'..id..op[2], op[3])
+            end
+        end
+    end
+
+    for j = 1, #data, 2 do
+        values[data[j]] = data[j+1]
+    end
+
+    for _, op in ipairs(model.ops) do
+        local name = op[1]
+
+        if name == 'zrem' then
+            redis.call('ZREM', op[2], id)
+        elseif name == 'del' then
+            redis.call('DEL', prefix..':'..id..op[2])
+        else
+            local value = joined(values, op)
+
+            if value then
+                if name == 'hdel' then
+                    redis.call('HDEL', op[2], value)
+                elseif name == 'srem' then
+                    redis.call('SREM', op[2]..value, id)
+                elseif name == 'zrem_lex' then
+                    redis.call('ZREM', op[2], value..'\0'..id)
+                end
+            end
+        end
+    end
+
+    for _, relation in ipairs(model.relations) do
+        if relation[1] ~= 'fid' then
+            redis.call('DEL', rel_key(prefix, id, relation[1], relation[2]))
+        end
+    end
+
+    redis.call('DEL', key)
+    redis.call('SREM', prefix..':members', id)
+
+    if model.allow then
+        redis.call('DEL', prefix..':'..id..':allow')
+    end
+
+    result[#result+1] = key
+
+    if model.notify then
+        result[#result+1] = {data, fetched}
+    else
+        result[#result+1] = {}
+    end
+end
+
+for _, item in ipairs(unrelated) do
+    local id, relation, ids = item[1], item[2], item[3]
+    local target, kind, name = relation[4], relation[6], relation[7]
+
+    for _, related in ipairs(ids) do
+        if kind == 'fid' then
+            redis.call('HDEL', obj_key(target, related), name)
+        elseif kind == 'srel' then
+            redis.call('SREM', rel_key(target, related, kind, name), id)
+        else
+            redis.call('ZREM', rel_key(target, related, kind, name), id)
+        end
+    end
+end
+
+return result
@@ -0,0 +1,158 @@
+-- Reads one batch of ids from KEYS[1] and returns a number that tells how to
+-- continue followed by the ids of the objects that belong to every set in
+-- KEYS[2..] and match all the given filters. For sets the number is the
+-- cursor for the next batch, for sorted sets it is the amount of members
+-- read.
+--
+-- ARGV[1] how to read the batch, 'sscan', 'hmget', 'georadius' or one of the
+--         sorted set range commands: 'zrangebyscore', 'zrevrangebyscore',
+--         'zrangebylex' or 'zrevrangebylex'. Members of prefix indexes are
+--         'value\0id'
+-- ARGV[2] amount of arguments for the reading command, n
+-- ARGV[3..n+2] arguments for the reading command
+-- ARGV[n+3] key prefix of the model
+-- ARGV[n+4..] groups of four: field, filter, value type and expected value.
+--             The values of the 'in' filter are separated by null characters
+local source_key = KEYS[1]
+
+local mode = ARGV[1]
+local nargs = tonumber(ARGV[2])
+local prefix = ARGV[nargs + 3]
+
+local function parse(valuetype, value)
+    if not value or value == 'None' then
+        return nil
+    end
+
+    if valuetype == 'num' then
+        return tonumber(value)
+    end
+
+    if valuetype == 'bool' then
+        if value == 'True' or value == 'true' or value == '1' then
+            return 'True'
+        end
+
+        return 'False'
+    end
+
+    return value
+end
+
+local filters = {}
+local fieldnames = {}
+
+for i = nargs + 4, #ARGV, 4 do
+    local expected
+
+    if ARGV[i+1] == 'in' then
+        expected = {}
+
+        for value in (ARGV[i+3]..'\0'):gmatch('(.-)%z') do
+            expected[parse(ARGV[i+2], value)] = true
+        end
+    else
+        expected = parse(ARGV[i+2], ARGV[i+3])
+    end
+
+    filters[#filters+1] = {
+        op = ARGV[i+1],
+        valuetype = ARGV[i+2],
+        expected = expected,
+    }
+    fieldnames[#fieldnames+1] = ARGV[i]
+end
+
+local function matches(value, op, expected)
+    if value == nil then
+        return op == 'ne'
+    end
+
+    if op == 'eq' then
+        return value == expected
+    elseif op == 'ne' then
+        return value ~= expected
+    elseif op == 'lt' then
+        return value < expected
+    elseif op == 'lte' then
+        return value <= expected
+    elseif op == 'gt' then
+        return value > expected
+    elseif op == 'gte' then
+        return value >= expected
+    elseif op == 'startswith' then
+        return value:sub(1, #expected) == expected
+    elseif op == 'endswith' then
+        return #expected == 0 or value:sub(-#expected) == expected
+    elseif op == 'in' then
+        return expected[value] ~= nil
+    end
+
+    return false
+end
+
+local progress, ids
+
+if mode == 'sscan' then
+    local scan = redis.call('SSCAN', source_key, ARGV[3], 'COUNT', ARGV[4])
+
+    progress, ids = scan[1], scan[2]
+elseif mode == 'zrangebyscore' or mode == 'zrevrangebyscore' then
+    ids = redis.call(mode, source_key, ARGV[3], ARGV[4], 'LIMIT', ARGV[5], ARGV[6])
+    progress = #ids
+elseif mode == 'zrangebylex' or mode == 'zrevrangebylex' then
+    local members = redis.call(mode, source_key, ARGV[3], ARGV[4], 'LIMIT', ARGV[5], ARGV[6])
+
+    ids = {}
+
+    for i, member in ipairs(members) do
+        ids[i] = member:match('%z(.*)$')
+    end
+
+    progress = #ids
+elseif mode == 'hmget' then
+    ids = {}
+
+    for _, id in ipairs(redis.call('HMGET', source_key, unpack(ARGV, 3, nargs + 2))) do
+        if id then
+            ids[#ids+1] = id
+        end
+    end
+
+    progress = #ids
+elseif mode == 'georadius' then
+    ids = redis.call('GEORADIUS', source_key, ARGV[3], ARGV[4], ARGV[5], 'm')
+    progress = #ids
+else
+    return redis.error_reply('unknown mode '..mode)
+end
+
+local result = {progress}
+
+for _, id in ipairs(ids) do
+    local match = true
+
+    for i = 2, #KEYS do
+        if redis.call('SISMEMBER', KEYS[i], id) == 0 then
+            match = false
+            break
+        end
+    end
+
+    if match and #filters > 0 then
+        local values = redis.call('HMGET', prefix..':'..id..':obj', unpack(fieldnames))
+
+        for i, filter in ipairs(filters) do
+            if not matches(parse(filter.valuetype, values[i]), filter.op, filter.expected) then
+                match = false
+                break
+            end
+        end
+    end
+
+    if match then
+        result[#result+1] = id
+    end
+end
+
+return result
@@ -1,37 +1,845 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from coralillo.datamodel import debyte_string
+from collections import namedtuple
+from hashlib import sha1
+from itertools import islice
+from math import ceil
+import json
 
 # these return false if the value is null
-NULL_AFFECTED_FILTERS = ['lt', 'lte', 'gt', 'gte', 'startswith', 'endswith']
+NULL_AFFECTED_FILTERS = [
+    'lt', 'lte', 'gt', 'gte', 'startswith', 'endswith', 'near', 'in',
+]
 
 # these ones don't give a shit about null values
 FILTERS = ['eq', 'ne'] + NULL_AFFECTED_FILTERS
 
+# filters that can be evaluated in the database for each value type
+LUA_FILTERS = {
+    'str': [
+        'eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'startswith', 'endswith', 'in',
+    ],
+    'num': ['eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in'],
+    'bool': ['eq', 'ne'],
+}
+
+# filters that can be answered by a range index
+RANGE_FILTERS = ['lt', 'lte', 'gt', 'gte']
+
+# filters that can be answered by a prefix index
+LEX_FILTERS = RANGE_FILTERS + ['startswith']
+
+# amount of members of the set scanned in every call to the filter script
+DEFAULT_BATCH_SIZE = 500
+
+# how a queryset reads the results of its plan
+Reading = namedtuple('Reading', [
+    'args', 'filters', 'batch_size', 'offset', 'skip', 'max_items', 'ordered',
+])
+
+
+def describe(bound):
+    ''' Renders a bound of a range, which may hold bytes that are not valid
+    utf8 like the end of a prefix range '''
+    if isinstance(bound, bytes):
+        return bound.decode('utf8', 'backslashreplace')
+
+    return str(bound)
+
+
+class Source:
+    ''' A way of reading the candidate ids of a queryset from the database '''
+
+    # the source can start reading at an offset
+    can_skip = False
+
+    # the ids come sorted by the value of the field named fieldname
+    ordered = False
+
+    fieldname = None
+
+    def batches(self, lua, keys, args, batch_size, offset=0):
+        ''' Yields lists with the ids that pass the filters given in args and
+        belong to all the sets given in keys '''
+        state = self.start(offset)
+
+        while state is not None:
+            res = lua.filter(**self.call(state, keys, args, batch_size))
+
+            yield res[1:]
+
+            state = self.advance(state, res, batch_size)
+
+    async def abatches(self, lua, keys, args, batch_size, offset=0):
+        ''' Same as batches() for the scripts of an AsyncEngine '''
+        state = self.start(offset)
+
+        while state is not None:
+            res = await lua.filter(**self.call(state, keys, args, batch_size))
+
+            yield res[1:]
+
+            state = self.advance(state, res, batch_size)
+
+    def start(self, offset):
+        ''' Returns the state of the first call to the filter script, or None
+        if there is nothing to read '''
+        return 0
+
+    def call(self, state, keys, args, batch_size):
+        ''' Returns the keys and arguments of the call to the filter script
+        for the given state '''
+        raise NotImplementedError()
+
+    def advance(self, state, res, batch_size):
+        ''' Returns the state of the next call given the result of the last
+        one, or None if the source is exhausted '''
+        return None
+
+    def estimate(self, pipe):
+        ''' Queues in the pipeline the commands that count the candidates of
+        this source. Returns the amount of queued commands '''
+        raise NotImplementedError()
+
+    def candidates(self, results):
+        ''' Turns the results of the commands queued by estimate() into the
+        amount of candidates '''
+        return sum(map(int, results))
+
+    def exact_count(self, redis, within):
+        ''' Counts the ids of this source that belong to every set in within
+        without reading them. Returns None if it can't be done '''
+        return None
+
+
+class SetScan(Source):
+    ''' Reads the ids stored in a set using SSCAN '''
+
+    def __init__(self, key):
+        self.key = key
+
+    def call(self, cursor, keys, args, batch_size):
+        return dict(
+            keys=[self.key] + keys,
+            args=['sscan', 2, cursor, batch_size] + args
+        )
+
+    def advance(self, cursor, res, batch_size):
+        return int(res[0]) or None
+
+    def estimate(self, pipe):
+        pipe.scard(self.key)
+
+        return 1
+
+    def exact_count(self, redis, within):
+        if within:
+            return len(redis.sinter([self.key] + within))
+
+        return redis.scard(self.key)
+
+    def __str__(self):
+        return 'SSCAN {}'.format(self.key)
+
+
+class SetUnion(Source):
+    ''' Reads the ids stored in several disjoint sets, one after the other '''
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def start(self, offset):
+        # the position of the key being scanned and the cursor
+        return (0, 0) if self.keys else None
+
+    def call(self, state, keys, args, batch_size):
+        position, cursor = state
+
+        return dict(
+            keys=[self.keys[position]] + keys,
+            args=['sscan', 2, cursor, batch_size] + args
+        )
+
+    def advance(self, state, res, batch_size):
+        position, cursor = state[0], int(res[0])
+
+        if cursor:
+            return position, cursor
+
+        if position + 1 < len(self.keys):
+            return position + 1, 0
+
+        return None
+
+    def estimate(self, pipe):
+        for key in self.keys:
+            pipe.scard(key)
+
+        return len(self.keys)
+
+    def exact_count(self, redis, within):
+        if within:
+            return None
+
+        pipe = redis.pipeline(transaction=False)
+
+        self.estimate(pipe)
+
+        return self.candidates(pipe.execute())
+
+    def __str__(self):
+        return 'SSCAN {}'.format(', '.join(self.keys))
+
+
+class ScoreRange(Source):
+    ''' Reads the ids whose score is within a range from a sorted set using
+    ZRANGEBYSCORE, in score order '''
+
+    can_skip = True
+    ordered = True
+    mode = 'zrangebyscore'
+
+    def __init__(self, key, min, max, reverse=False, fieldname=None):
+        self.key = key
+        self.min = min
+        self.max = max
+        self.reverse = reverse
+        self.fieldname = fieldname
+
+    def command(self):
+        if self.reverse:
+            return self.mode.replace('range', 'revrange'), self.max, self.min
+
+        return self.mode, self.min, self.max
+
+    def start(self, offset):
+        return offset
+
+    def call(self, offset, keys, args, batch_size):
+        mode, low, high = self.command()
+
+        return dict(
+            keys=[self.key] + keys,
+            args=[mode, 4, low, high, offset, batch_size] + args
+        )
+
+    def advance(self, offset, res, batch_size):
+        if int(res[0]) < batch_size:
+            return None
+
+        return offset + batch_size
+
+    def estimate(self, pipe):
+        pipe.zcount(self.key, self.min, self.max)
+
+        return 1
+
+    def exact_count(self, redis, within):
+        if within:
+            return None
+
+        pipe = redis.pipeline(transaction=False)
+
+        self.estimate(pipe)
+
+        return self.candidates(pipe.execute())
+
+    def __str__(self):
+        mode, low, high = self.command()
+
+        return '{} {} {} {}'.format(
+            mode.upper(),
+            self.key,
+            describe(low),
+            describe(high)
+        )
+
+
+class LexRange(ScoreRange):
+    ''' Reads the ids whose value is within a range from a prefix index using
+    ZRANGEBYLEX, in lexicographical order '''
+
+    mode = 'zrangebylex'
+
+    def estimate(self, pipe):
+        pipe.zlexcount(self.key, self.min, self.max)
+
+        return 1
+
+
+class HashLookup(Source):
+    ''' Reads the ids mapped to some values in a unique index '''
+
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+    def start(self, offset):
+        return 0 if self.values else None
+
+    def call(self, position, keys, args, batch_size):
+        values = self.values[position:position + batch_size]
+
+        return dict(
+            keys=[self.key] + keys,
+            args=['hmget', len(values)] + values + args
+        )
+
+    def advance(self, position, res, batch_size):
+        if position + batch_size < len(self.values):
+            return position + batch_size
+
+        return None
+
+    def estimate(self, pipe):
+        return 0
+
+    def candidates(self, results):
+        return len(self.values)
+
+    def __str__(self):
+        return 'HMGET {} {}'.format(self.key, ' '.join(self.values))
+
+
+class GeoRadius(Source):
+    ''' Reads the ids located within a radius in meters of a point from a
+    geo index '''
+
+    def __init__(self, key, location, radius):
+        self.key = key
+        self.location = location
+        self.radius = radius
+
+    def call(self, state, keys, args, batch_size):
+        return dict(keys=[self.key] + keys, args=[
+            'georadius', 3, self.location.lon, self.location.lat, self.radius,
+        ] + args)
+
+    def estimate(self, pipe):
+        # the size of the whole index is an upper bound
+        pipe.zcard(self.key)
+
+        return 1
+
+    def __str__(self):
+        return 'GEORADIUS {} {} {} {} m'.format(
+            self.key,
+            self.location.lon,
+            self.location.lat,
+            self.radius
+        )
+
+
+class Nothing(Source):
+    ''' The source of a queryset that can't match anything, like one with
+    an empty ``in`` filter '''
+
+    can_skip = True
+
+    def start(self, offset):
+        return None
+
+    def estimate(self, pipe):
+        return 0
+
+    def exact_count(self, redis, within):
+        return 0
+
+    def __str__(self):
+        return 'NOTHING'
+
+
+class Plan:
+    ''' How a queryset reads its results: where the candidate ids come from,
+    which sets they must also belong to and the conditions left to check '''
+
+    def __init__(self, source, conditions, within, candidates=None):
+        self.source = source
+        self.conditions = conditions
+        self.within = within
+        self.candidates = candidates
+
+    def to_json(self, queryset):
+        lua_filters = []
+        python_filters = []
+
+        for fieldname, query_func, value in self.conditions:
+            name = '{}__{}'.format(fieldname, query_func)
+
+            lua_filter = queryset.make_lua_filter(fieldname, query_func, value)
+
+            if lua_filter is not None:
+                lua_filters.append(name)
+            else:
+                python_filters.append(name)
+
+        # every batch takes a call to the filter script and a get_many(),
+        # plus the call that counted the candidates
+        batches = max(1, ceil(self.candidates / queryset.batch_size))
+
+        return {
+            'source': str(self.source),
+            'within': self.within,
+            'lua_filters': lua_filters,
+            'python_filters': python_filters,
+            'ordered_by_index': (
+                queryset.ordering is not None and
+                queryset.is_ordered_by(self.source)
+            ),
+            'estimated_candidates': self.candidates,
+            'estimated_round_trips': 2 * batches + 1,
+        }
+
 
 class QuerySet:
 
-    def __init__(self, cls, iterator):
-        self.iterator = iterator
-        self.filters = []
+    def __init__(self, cls, key, *, batch_size=DEFAULT_BATCH_SIZE):
+        self.key = key
+        self.conditions = []
         self.cls = cls
+        self.batch_size = batch_size
+        self.skip = 0
+        self.max_items = None
+        self.ordering = None
+        self.iterator = None
+        self.only_fields = None
+        self.deferred_fields = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        for item in self.iterator:
-            obj = self.cls.get(debyte_string(item))
+        if self.iterator is None:
+            self.iterator = self.iterate()
 
-            if self.matches_filters(obj):
-                return obj
+        return next(self.iterator)
 
-        raise StopIteration
+    def __aiter__(self):
+        return self.aiterate()
 
-    def matches_filters(self, item):
-        for filt in self.filters:
-            if not filt(item):
-                return False
+    def is_ordered_by(self, source):
+        ''' Tells if the given source reads the ids in the requested order '''
+        if not source.ordered:
+            return False
+
+        return (source.fieldname, source.reverse) == self.ordering
+
+    def access_paths(self):
+        ''' Lists the indexes that can answer some of the conditions of this
+        queryset or give its ordering, as (source, conditions answered)
+        tuples '''
+        fieldnames = []
+
+        for fieldname, query_func, value in self.conditions:
+            if fieldname not in fieldnames:
+                fieldnames.append(fieldname)
+
+        if self.ordering is not None and self.ordering[0] not in fieldnames:
+            fieldnames.append(self.ordering[0])
+
+        paths = []
+
+        for fieldname in fieldnames:
+            field = getattr(self.cls, fieldname)
+
+            if not hasattr(field, 'access_paths'):
+                continue
+
+            reverse = self.ordering == (fieldname, True)
+            ordering = self.ordering in ((fieldname, False), (fieldname, True))
+
+            paths.extend(field.access_paths(
+                self.cls, self.conditions, ordering, reverse
+            ))
+
+        for index in self.cls.compound_indexes():
+            paths.extend(index.access_paths(self.cls, self.conditions))
+
+        return paths
+
+    def plan(self, estimate=False):
+        ''' Picks the cheapest way of reading the candidate ids. The candidates
+        of each option are counted, in a single round trip, only when the
+        choice is not obvious or if estimate is True '''
+        options, choice = self.options()
+        results = None
+
+        if choice is None or estimate:
+            pipe = self.cls.get_redis().pipeline(transaction=False)
+            queued = [source.estimate(pipe) for source, used in options]
+            results = (queued, pipe.execute())
+
+        return self.choose(options, choice, results)
+
+    async def aplan(self, estimate=False):
+        ''' Same as plan() for models bound to an AsyncEngine '''
+        options, choice = self.options()
+        results = None
+
+        if choice is None or estimate:
+            pipe = self.cls.get_redis().pipeline(transaction=False)
+            queued = [source.estimate(pipe) for source, used in options]
+            results = (queued, await pipe.execute())
+
+        return self.choose(options, choice, results)
+
+    def options(self):
+        ''' Lists the ways of reading the candidates, starting with a scan of
+        the whole key, and the one that is obviously the best if any '''
+        base = (SetScan(self.key), [])
+        empty = [
+            c for c in self.conditions
+            if c[1] == 'in' and c[2] is not None and not c[2]
+        ]
+
+        if empty:
+            # nothing is in an empty list, don't read anything
+            nothing = (Nothing(), empty)
+
+            return [base, nothing], nothing
+
+        paths = self.access_paths()
+        model_wide = self.key == self.cls.members_key()
+        lookups = [p for p in paths if isinstance(p[0], HashLookup)]
+        ordered = [
+            p for p in paths
+            if self.ordering is not None and self.is_ordered_by(p[0])
+        ]
+        choice = None
+
+        if lookups:
+            # an unique index gives at most one candidate per value
+            choice = lookups[0]
+        elif ordered and self.max_items is not None:
+            # reading in order lets us stop as soon as the limit is reached
+            choice = ordered[0]
+        elif not paths:
+            choice = base
+        elif model_wide and len(paths) == 1:
+            # an index of the model has at most as many ids as the model
+            choice = paths[0]
+
+        return [base] + paths, choice
+
+    def choose(self, options, choice, results=None):
+        ''' Builds the plan of the given choice. If it is None the option with
+        fewer candidates is used, according to the results of the commands
+        queued by the estimate() method of each option '''
+        base, paths = options[0], options[1:]
+        model_wide = self.key == self.cls.members_key()
+        candidates = None
+
+        if results is not None:
+            queued, results = results
+            results = iter(results)
+            counts = [
+                source.candidates([next(results) for i in range(amount)])
+                for (source, used), amount in zip(options, queued)
+            ]
+
+            if choice is None:
+                choice = min(zip(options, counts), key=lambda oc: oc[1])[0]
+
+            candidates = counts[options.index(choice)]
+
+        source, used = choice
+        conditions = [c for c in self.conditions if c not in used]
+        within = []
+
+        if choice is not base and not model_wide:
+            within.append(self.key)
+
+        # sets that answer other equality conditions are intersected with the
+        # candidates instead of checking the values of each object
+        for other, other_used in paths:
+            if other is source or not isinstance(other, SetScan):
+                continue
+
+            if other_used and all(c in conditions for c in other_used):
+                within.append(other.key)
+                conditions = [c for c in conditions if c not in other_used]
+
+        return Plan(source, conditions, within, candidates)
 
-        return True
+    def resume(self, description):
+        ''' Builds the plan that reads from the source with the given
+        description, so a cursor is resumed with the same source it was
+        created with '''
+        options, choice = self.options()
+
+        for option in options:
+            if str(option[0]) == description:
+                return self.choose(options, option)
+
+        raise ValueError('The cursor does not belong to this queryset')
+
+    def explain(self):
+        ''' Describes how this queryset reads its results, including the
+        estimated amount of candidates and of round trips to the database '''
+        return self.plan(estimate=True).to_json(self)
+
+    def iterate(self):
+        ''' Runs the filter script over the source one batch at a time, then
+        retrieves the matching objects and applies the filters that could not
+        be evaluated in the database '''
+        plan = self.plan()
+        reading = self.reading(plan)
+        results = self.read(
+            plan.source,
+            self.cls.get_engine().lua,
+            plan.within,
+            *reading[:4]
+        )
+
+        if not reading.ordered:
+            results = self.sort(results)
+
+        yield from self.window(results, reading.skip, reading.max_items)
+
+    async def aiterate(self):
+        ''' Same as iterate() for models bound to an AsyncEngine '''
+        plan = await self.aplan()
+        reading = self.reading(plan)
+        results = self.aread(
+            plan.source,
+            self.cls.get_engine().lua,
+            plan.within,
+            *reading[:4]
+        )
+
+        if not reading.ordered:
+            objs = self.sort([obj async for obj in results])
+
+            for obj in self.window(objs, reading.skip, reading.max_items):
+                yield obj
+
+            return
+
+        skip, max_items = reading.skip, reading.max_items
+
+        if max_items == 0:
+            return
+
+        async for obj in results:
+            if skip:
+                skip -= 1
+                continue
+
+            yield obj
+
+            if max_items is not None:
+                max_items -= 1
+
+                if max_items == 0:
+                    return
+
+    def reading(self, plan):
+        ''' Works out how to read the results of the given plan '''
+        ordered = self.ordering is None or self.is_ordered_by(plan.source)
+        args, filters = self.compile(plan.conditions)
+
+        skip, max_items = self.skip, self.max_items
+        offset = 0
+        batch_size = self.batch_size
+
+        # when the source gives the exact results it can skip the offset and
+        # read only as much as needed
+        exact = len(args) == 1 and not filters and not plan.within
+
+        if plan.source.can_skip and ordered and exact:
+            offset, skip = skip, 0
+
+            if max_items is not None:
+                batch_size = max(1, min(batch_size, max_items))
+
+        return Reading(
+            args, filters, batch_size, offset, skip, max_items, ordered
+        )
+
+    def sort(self, results):
+        ''' Sorts the objects by the ordering field when the source doesn't
+        give them in order '''
+        fieldname, reverse = self.ordering
+
+        return sorted(results, key=lambda obj: (
+            getattr(obj, fieldname) is not None,
+            getattr(obj, fieldname),
+        ), reverse=reverse)
+
+    def window(self, results, skip, max_items):
+        ''' Drops the first skip objects and stops after max_items '''
+        if max_items == 0:
+            return
+
+        for obj in results:
+            if skip:
+                skip -= 1
+                continue
+
+            yield obj
+
+            if max_items is not None:
+                max_items -= 1
+
+                if max_items == 0:
+                    return
+
+    def compile(self, conditions):
+        ''' Splits the given conditions into the arguments of the filter
+        script and the filters that must be applied in python '''
+        args = [self.cls.cls_key()]
+        filters = []
+
+        for fieldname, query_func, value in conditions:
+            lua_filter = self.make_lua_filter(fieldname, query_func, value)
+
+            if lua_filter is not None:
+                args.extend(lua_filter)
+            else:
+                filters.append(self.make_filter(fieldname, query_func, value))
+
+        return args, filters
+
+    def count(self):
+        ''' Returns the amount of objects matching this queryset. Indexes and
+        set intersections are counted in the database without reading the
+        ids, other queries count the ids returned by the filter script and
+        only load the objects if some filter must be applied in python '''
+        plan = self.plan()
+        total = None
+
+        if not plan.conditions:
+            total = plan.source.exact_count(self.cls.get_redis(), plan.within)
+
+        if total is None:
+            lua = self.cls.get_engine().lua
+            args, filters = self.compile(plan.conditions)
+
+            if filters:
+                total = sum(1 for obj in self.read(
+                    plan.source,
+                    lua,
+                    plan.within,
+                    args,
+                    filters,
+                    self.batch_size,
+                    0
+                ))
+            else:
+                total = sum(len(ids) for ids in plan.source.batches(
+                    lua, plan.within, args, self.batch_size
+                ))
+
+        total = max(0, total - self.skip)
+
+        if self.max_items is not None:
+            total = min(total, self.max_items)
+
+        return total
+
+    def paginate(self, cursor=None, page_size=50):
+        ''' Returns a page of at most page_size objects and the cursor of the
+        next page, which is None after the last one. The cursor is an opaque
+        string that holds the position of the scan, so reading a page doesn't
+        depend on how many came before it. When the objects are sorted in
+        python, by a field without a range or prefix index, the cursor holds
+        the amount of objects read instead. limit() is ignored '''
+        if cursor is not None:
+            description, state, skip = json.loads(
+                urlsafe_b64decode(cursor.encode()).decode()
+            )
+        else:
+            description, state, skip = None, None, 0
+
+        plan = self.plan() if description is None else self.resume(description)
+        args, filters = self.compile(plan.conditions)
+
+        if self.ordering is not None and not self.is_ordered_by(plan.source):
+            results = self.sort(self.read(
+                plan.source,
+                self.cls.get_engine().lua,
+                plan.within,
+                args,
+                filters,
+                self.batch_size,
+                0
+            ))
+            page = results[skip:skip + page_size]
+            more = skip + page_size < len(results)
+
+            if not more:
+                return page, None
+
+            return page, self.cursor(None, None, skip + page_size)
+
+        source = plan.source
+        lua = self.cls.get_engine().lua
+        state = source.start(0) if description is None else state
+        page = []
+
+        while state is not None:
+            res = lua.filter(**source.call(
+                state, plan.within, args, self.batch_size
+            ))
+            objs = [
+                obj for obj in self.cls.get_many(
+                    map(debyte_string, res[1:]), **self.projection()
+                )
+                if obj is not None and all(filt(obj) for filt in filters)
+            ][skip:]
+            needed = page_size - len(page)
+
+            if len(objs) > needed:
+                # the next page starts in the middle of this batch
+                page.extend(objs[:needed])
+
+                return page, self.cursor(source, state, skip + needed)
+
+            page.extend(objs)
+            state = source.advance(state, res, self.batch_size)
+            skip = 0
+
+            if len(page) == page_size:
+                break
+
+        if state is None:
+            return page, None
+
+        return page, self.cursor(source, state, 0)
+
+    def cursor(self, source, state, skip):
+        ''' Encodes the position of paginate() in an opaque string '''
+        description = None if source is None else str(source)
+
+        cursor = json.dumps([description, state, skip]).encode()
+
+        return urlsafe_b64encode(cursor).decode()
+
+    def read(self, source, lua, within, args, filters, batch_size, offset):
+        ''' Yields the objects whose ids come from the source and match the
+        filters '''
+        for ids in source.batches(lua, within, args, batch_size, offset):
+            objs = self.cls.get_many(
+                map(debyte_string, ids), **self.projection()
+            )
+
+            for obj in objs:
+                if obj is not None and all(filt(obj) for filt in filters):
+                    yield obj
+
+    async def aread(self, source, lua, within, args, filters, batch_size,
+                    offset):
+        ''' Same as read() for models bound to an AsyncEngine '''
+        batches = source.abatches(lua, within, args, batch_size, offset)
+
+        async for ids in batches:
+            objs = await self.cls.aget_many(
+                map(debyte_string, ids), **self.projection()
+            )
+
+            for obj in objs:
+                if obj is not None and all(filt(obj) for filt in filters):
+                    yield obj
 
     def make_filter(self, fieldname, query_func, expct_value):
         ''' makes a filter that will be appliead to an object's property based
@@ -59,11 +867,36 @@ class QuerySet:
                 return value.startswith(expct_value)
             elif query_func == 'endswith':
                 return value.endswith(expct_value)
+            elif query_func == 'near':
+                location, radius = expct_value
+
+                return value.distance(location) <= radius
+            elif query_func == 'in':
+                return value in expct_value
 
         actual_filter.__doc__ = '{} {} {}'.format('val', query_func, expct_value)
 
         return actual_filter
 
+    def make_lua_filter(self, fieldname, query_func, expct_value):
+        ''' returns the arguments that the filter script needs to evaluate
+        this filter in the database, or None if it can't be done there '''
+        field = getattr(self.cls, fieldname)
+        query_type = getattr(field, 'query_type', None)
+
+        supported = LUA_FILTERS.get(query_type, [])
+
+        if expct_value is None or query_func not in supported:
+            return None
+
+        if query_func == 'in':
+            # the values are sent separated by null characters
+            values = '\0'.join(field.prepare(v) for v in expct_value)
+
+            return [fieldname, query_func, query_type, values]
+
+        return [fieldname, query_func, query_type, field.prepare(expct_value)]
+
     def filter(self, **kwargs):
         for key, value in kwargs.items():
             try:
@@ -80,7 +913,71 @@ class QuerySet:
             if query_func not in FILTERS:
                 raise AttributeError('Filter {} does not exist'.format(query_func))
 
-            self.filters.append(self.make_filter(fieldname, query_func, value))
+            self.conditions.append((fieldname, query_func, value))
+
+        return self
+
+    def order_by(self, fieldname):
+        ''' Sorts the results by the given field, descending if its name is
+        prefixed with a dash. Range and prefix indexes give the order directly
+        but only contain the objects that have a value for the field, other
+        fields are sorted in python '''
+        reverse = fieldname.startswith('-')
+        fieldname = fieldname.lstrip('-')
+
+        if not hasattr(self.cls, fieldname):
+            raise AttributeError('Model {} does not have field {}'.format(
+                self.cls.__name__,
+                fieldname,
+            ))
+
+        self.ordering = (fieldname, reverse)
+
+        return self
+
+    def only(self, *fieldnames):
+        ''' Reads only the given fields of the objects, the rest are read the
+        first time one of them is used. With an AsyncEngine they are read
+        eagerly '''
+        self.only_fields = fieldnames
+
+        return self
+
+    def defer(self, *fieldnames):
+        ''' Leaves the given fields out of the objects until one of them is
+        used. With an AsyncEngine they are read eagerly '''
+        self.deferred_fields = fieldnames
+
+        return self
+
+    def projection(self):
+        ''' The arguments for get_many() that read the requested fields plus
+        the ones needed to filter and sort in python '''
+        needed = [condition[0] for condition in self.conditions]
+
+        if self.ordering is not None:
+            needed.append(self.ordering[0])
+
+        return {
+            'only': None if self.only_fields is None else (
+                list(self.only_fields) + needed
+            ),
+            'defer': None if self.deferred_fields is None else [
+                f for f in self.deferred_fields if f not in needed
+            ],
+        }
+
+    def batch(self, size):
+        ''' Sets the amount of members scanned by each call to the database,
+        so it is not blocked for long periods by big sets '''
+        self.batch_size = size
+
+        return self
+
+    def limit(self, count, offset=0):
+        ''' Returns at most count elements, skipping the first offset ones '''
+        self.max_items = count
+        self.skip = offset
 
         return self
 
@@ -89,3 +986,198 @@ class QuerySet:
 
     def all(self):
         return list(self)
+
+    async def aall(self):
+        return [obj async for obj in self]
+
+    def json_chunks(self, include, chunk_size):
+        ''' Yields the results serialized as lists of dicts of at most
+        chunk_size objects. Only one chunk of objects is kept in memory '''
+        objs = iter(self)
+
+        while True:
+            chunk = list(islice(objs, chunk_size or self.batch_size))
+
+            if not chunk:
+                return
+
+            yield self.cls.to_json_many(chunk, include=include)
+
+    def iter_json(self, include=None, chunk_size=None):
+        ''' Yields the pieces of a JSON array with the results serialized like
+        to_json(include=include), to stream collections of any size. The
+        objects are read and their embedded relations prefetched chunk_size
+        objects at a time, by default the batch size '''
+        separator = '['
+
+        for chunk in self.json_chunks(include, chunk_size):
+            yield separator + ','.join(map(json.dumps, chunk))
+            separator = ','
+
+        yield ']' if separator == ',' else '[]'
+
+    def iter_ndjson(self, include=None, chunk_size=None):
+        ''' Same as iter_json() but each piece is a chunk of newline delimited
+        JSON, one object per line '''
+        for chunk in self.json_chunks(include, chunk_size):
+            yield ''.join(json.dumps(item) + '\n' for item in chunk)
+
+
+class SetExpression:
+    ''' A combination of sets of ids of the same model, like the members of
+    set relations, the model's members or the objects with a value in a non
+    unique index, built with ``&`` (intersection), ``|`` (union) and ``-``
+    (difference)::
+
+        expr = fleet.trucks & group.trucks - Truck.indexed('status', 'broken')
+
+    Nothing is read until the expression is counted or queried. Then it is
+    evaluated in the database with SINTERSTORE, SUNIONSTORE and SDIFFSTORE in
+    a single transaction, every partial result stored in a key that expires
+    after ttl seconds, and no object is loaded '''
+
+    COMMANDS = {
+        '&': 'sinterstore',
+        '|': 'sunionstore',
+        '-': 'sdiffstore',
+    }
+
+    def __init__(self, cls, key=None, operator=None, operands=()):
+        self.cls = cls
+        self.key = key
+        self.operator = operator
+        self.operands = operands
+
+    @staticmethod
+    def of(value):
+        ''' Returns the expression of the given value, which can be a set
+        relation '''
+        if isinstance(value, SetExpression):
+            return value
+
+        if hasattr(value, 'expression'):
+            return value.expression()
+
+        raise TypeError('Cannot combine {} with a set expression'.format(
+            type(value).__name__
+        ))
+
+    def combine(self, operator, other):
+        other = SetExpression.of(other)
+
+        if other.cls is not self.cls:
+            raise TypeError('Cannot combine sets of {} and {}'.format(
+                self.cls.__name__,
+                other.cls.__name__
+            ))
+
+        operands = (self, other)
+
+        # a & b & c is a single SINTERSTORE, same for unions. Differences
+        # only flatten on the left side, as in a - b - c
+        if self.operator == operator:
+            operands = self.operands + (other,)
+
+        if operator != '-' and other.operator == operator:
+            operands = operands[:-1] + other.operands
+
+        return SetExpression(self.cls, operator=operator, operands=operands)
+
+    def __and__(self, other):
+        return self.combine('&', other)
+
+    def __or__(self, other):
+        return self.combine('|', other)
+
+    def __sub__(self, other):
+        return self.combine('-', other)
+
+    def result_key(self):
+        ''' The key where the result of this expression is stored. Equal
+        expressions share it '''
+        if self.operator is None:
+            return self.key
+
+        digest = sha1(str(self).encode('utf8')).hexdigest()
+
+        return '{}:expr_{}'.format(self.cls.cls_key(), digest)
+
+    def queue(self, pipe, ttl):
+        ''' Queues the commands that store this expression and returns the key
+        that will hold the result '''
+        if self.operator is None:
+            return self.key
+
+        keys = [operand.queue(pipe, ttl) for operand in self.operands]
+        key = self.result_key()
+
+        getattr(pipe, self.COMMANDS[self.operator])(key, keys)
+        pipe.expire(key, ttl)
+
+        return key
+
+    def pipeline(self, ttl):
+        ''' Returns a transaction with this expression queued and the key of
+        the result '''
+        pipe = self.cls.get_redis().pipeline()
+
+        return pipe, self.queue(pipe, ttl)
+
+    def store(self, ttl=60):
+        ''' Evaluates the expression and returns the key of the set with the
+        resulting ids, which expires after ttl seconds '''
+        pipe, key = self.pipeline(ttl)
+
+        if len(pipe):
+            pipe.execute()
+
+        return key
+
+    async def astore(self, ttl=60):
+        ''' Same as store() for models bound to an AsyncEngine '''
+        pipe, key = self.pipeline(ttl)
+
+        if len(pipe):
+            await pipe.execute()
+
+        return key
+
+    def count(self, ttl=60):
+        ''' Returns the amount of ids in the result in a single round trip '''
+        pipe, key = self.pipeline(ttl)
+        pipe.scard(key)
+
+        return pipe.execute()[-1]
+
+    async def acount(self, ttl=60):
+        ''' Same as count() for models bound to an AsyncEngine '''
+        pipe, key = self.pipeline(ttl)
+        pipe.scard(key)
+
+        return (await pipe.execute())[-1]
+
+    def ids(self, ttl=60):
+        ''' Returns the set of ids in the result without loading the
+        objects '''
+        pipe, key = self.pipeline(ttl)
+        pipe.smembers(key)
+
+        return set(map(debyte_string, pipe.execute()[-1]))
+
+    def q(self, ttl=60):
+        ''' Stores the result and returns a queryset over it that can be
+        filtered, sorted and paginated like any other. The objects are only
+        read when it is iterated, which must happen before ttl seconds '''
+        return QuerySet(self.cls, self.store(ttl))
+
+    async def aq(self, ttl=60):
+        ''' Same as q() for models bound to an AsyncEngine '''
+        return QuerySet(self.cls, await self.astore(ttl))
+
+    def __str__(self):
+        if self.operator is None:
+            return self.key
+
+        operator = ' {} '.format(self.operator)
+
+        return '({})'.format(operator.join(map(str, self.operands)))
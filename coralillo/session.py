@@ -0,0 +1,147 @@
+from contextvars import ContextVar
+from coralillo.bulk import publish_all
+
+# the session open in the current thread or asyncio task
+current_session = ContextVar('coralillo_session', default=None)
+
+
+class Session:
+    ''' A unit of work over an engine, opened with ``with engine.session():``
+    or ``async with engine.session():``. Inside it there is at most one
+    instance per class and id: ``Model.get()``, ``Model.get_by()`` and the
+    relations return the instance already loaded instead of reading it
+    again. Calls to ``save()`` are deferred and all the writes are sent in a
+    single transaction when the scope ends, or when ``flush()`` is called.
+    If the scope ends with an exception the pending writes are discarded '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        # (class, id) -> instance
+        self.identity = dict()
+        # (class, id) -> (instance, force), in the order they were saved
+        self.pending = dict()
+        self.token = None
+
+    @staticmethod
+    def of(model):
+        ''' Returns the session open for the engine of the given model class,
+        or None '''
+        session = current_session.get()
+
+        if session is not None and session.engine is model.get_engine():
+            return session
+
+        return None
+
+    def lookup(self, cls, id):
+        return self.identity.get((cls, id))
+
+    def register(self, obj):
+        ''' Adds the object to the identity map. Returns the instance that
+        represents it in this session, which is the one already registered if
+        any '''
+        return self.identity.setdefault((type(obj), obj.id), obj)
+
+    def missing(self, cls, ids):
+        ''' Returns the ids, without repetitions, of the objects not yet
+        loaded in this session '''
+        # a dict keeps the order of the ids and tells fast if one was seen
+        missing = dict()
+
+        for id in ids:
+            if id and (cls, id) not in self.identity:
+                missing[id] = None
+
+        return list(missing)
+
+    def merge(self, cls, ids, loaded):
+        ''' Registers the loaded objects and returns the instances for the
+        given ids, with None in place of the ones that don't exist '''
+        for obj in loaded:
+            if obj is not None:
+                self.register(obj)
+
+        return [self.lookup(cls, id) if id else None for id in ids]
+
+    def add(self, obj, force=False):
+        ''' Defers the save of the given object until the session is
+        flushed '''
+        key = (type(obj), obj.id)
+        previous = self.pending.get(key)
+
+        forced = force or (previous is not None and previous[1])
+
+        self.identity[key] = obj
+        self.pending[key] = (obj, forced)
+
+    def forget(self, keys):
+        ''' Drops the objects with the given redis keys, because they were
+        deleted '''
+        keys = set(keys)
+
+        self.identity = {
+            k: obj for k, obj in self.identity.items() if obj.key() not in keys
+        }
+        self.pending = {
+            k: item for k, item in self.pending.items()
+            if item[0].key() not in keys
+        }
+
+    def _queue_flush(self, pipe):
+        ''' Queues the writes of the pending objects and returns them '''
+        pending, self.pending = self.pending, dict()
+
+        for obj, force in pending.values():
+            obj._queue_save(pipe, force)
+
+        return [obj for obj, force in pending.values()]
+
+    def flush(self):
+        ''' Writes the pending objects in a single transaction '''
+        if not self.pending:
+            return
+
+        redis = self.engine.redis
+        pipe = redis.pipeline()
+        saved = self._queue_flush(pipe)
+
+        pipe.execute()
+
+        publish_all(redis, [n for obj in saved for n in obj._saved()])
+
+    async def aflush(self):
+        ''' Same as flush() for an AsyncEngine '''
+        if not self.pending:
+            return
+
+        redis = self.engine.redis
+        pipe = redis.pipeline()
+        saved = self._queue_flush(pipe)
+
+        await pipe.execute()
+
+        for obj in saved:
+            for channel, data in obj._saved():
+                await redis.publish(channel, data)
+
+    def __enter__(self):
+        self.token = current_session.set(self)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            current_session.reset(self.token)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                await self.aflush()
+        finally:
+            current_session.reset(self.token)
@@ -0,0 +1,249 @@
+from coralillo import Model, fields
+import asyncio
+import pytest
+
+pytest.importorskip('redis.asyncio')
+
+from coralillo import AsyncEngine  # noqa
+
+
+class Driver(Model):
+    name = fields.Text()
+    cars = fields.SetRelation(
+        'coralillo.tests.async_test.Car',
+        inverse='driver'
+    )
+
+
+class Car(Model):
+    plate = fields.Text()
+    driver = fields.ForeignIdRelation(Driver, inverse='cars')
+
+
+@pytest.fixture
+def aeng(nrm):
+    aeng = AsyncEngine()
+
+    Driver.set_engine(aeng)
+    Car.set_engine(aeng)
+
+    return aeng
+
+
+def test_save_get_delete(aeng):
+    class Vehicle(Model):
+        plate = fields.Text(index=True)
+        speed = fields.Integer(range_index=True, required=False)
+
+        class Meta:
+            engine = aeng
+
+    async def run():
+        car = await Vehicle(plate='ABC', speed=10).asave()
+
+        assert await aeng.redis.sismember('vehicle:members', car.id)
+
+        loaded = await Vehicle.aget(car.id)
+
+        assert loaded == car
+        assert loaded.plate == 'ABC'
+        assert loaded.speed == 10
+
+        loaded.speed = 20
+        await loaded.asave()
+
+        assert (await Vehicle.aget(car.id)).speed == 20
+        assert await Vehicle.aget('nonsense') is None
+        assert await Vehicle.aget_many([car.id, 'nonsense']) == [car, None]
+
+        await loaded.adelete()
+
+        assert await Vehicle.aget(car.id) is None
+        assert not await aeng.redis.hexists('vehicle:index_plate', 'ABC')
+        assert await aeng.redis.zcard('vehicle:range_speed') == 0
+
+    asyncio.run(run())
+
+
+def test_async_queryset(aeng):
+    class Vehicle(Model):
+        plate = fields.Text(index=True)
+        color = fields.Text()
+        speed = fields.Integer(range_index=True)
+
+        class Meta:
+            engine = aeng
+
+    async def run():
+        for i in range(6):
+            await Vehicle(
+                plate='C{}'.format(i),
+                color='red' if i % 2 else 'blue',
+                speed=i * 10,
+            ).asave()
+
+        fast = Vehicle.q().filter(speed__gte=20).order_by('speed')
+
+        assert [c.plate async for c in fast] == ['C2', 'C3', 'C4', 'C5']
+        red = Vehicle.q().filter(color='red', speed__lt=50).order_by('-speed')
+
+        assert [c.plate async for c in red] == ['C3', 'C1']
+        second = Vehicle.q().order_by('-speed').limit(2, offset=1)
+
+        assert [c.plate for c in await second.aall()] == ['C4', 'C3']
+        found = await Vehicle.q().filter(plate='C4').aall()
+
+        assert [c.plate for c in found] == ['C4']
+
+    asyncio.run(run())
+
+
+def test_async_relations(aeng):
+    async def run():
+        driver = await Driver(name='juan').asave()
+        a = await Car(plate='A').asave()
+        b = await Car(plate='B').asave()
+
+        await driver.cars.aadd(a)
+        await driver.cars.aadd(b)
+
+        assert await driver.cars.acount() == 2
+        assert await driver.cars.acontains(a)
+        assert await a.driver.aget() == driver
+        assert sorted(c.plate for c in await driver.cars.aall()) == ['A', 'B']
+
+        await driver.cars.aremove(a)
+
+        assert await a.driver.aget() is None
+        assert [c.plate for c in await driver.cars.aall()] == ['B']
+
+        await driver.adelete()
+
+        assert await b.driver.aget() is None
+        assert not await aeng.redis.exists(driver.key())
+
+    asyncio.run(run())
+
+
+def test_async_session(aeng):
+    async def run():
+        driver = await Driver(name='juan').asave()
+        car = await Car(plate='A').asave()
+
+        await driver.cars.aadd(car)
+
+        async with aeng.session():
+            loaded = await Car.aget(car.id)
+
+            assert await Car.aget(car.id) is loaded
+            assert (await driver.cars.aall())[0] is loaded
+
+            loaded.plate = 'B'
+            await loaded.asave()
+
+            assert await aeng.redis.hget(car.key(), 'plate') == b'A'
+
+        assert (await Car.aget(car.id)).plate == 'B'
+
+    asyncio.run(run())
+
+
+def test_async_set_expressions(aeng):
+    async def run():
+        driver = await Driver(name='juan').asave()
+        a = await Car(plate='A').asave()
+        await Car(plate='B').asave()
+
+        await driver.cars.aadd(a)
+
+        assert await (Car.expression() - driver.cars).acount() == 1
+
+        qs = await (Car.expression() - driver.cars).aq()
+
+        assert [car.plate async for car in qs] == ['B']
+
+    asyncio.run(run())
+
+
+def test_async_sorted_set_ranges(aeng):
+    class Trip(Model):
+        number = fields.Integer()
+
+        class Meta:
+            engine = aeng
+
+    class Truck(Model):
+        trips = fields.SortedSetRelation(Trip, sort_key='number')
+
+        class Meta:
+            engine = aeng
+
+    async def run():
+        truck = await Truck().asave()
+        trips = [await Trip(number=i).asave() for i in range(5)]
+
+        await truck.trips.aset(trips)
+
+        last = await truck.trips.arange(0, 1, reverse=True)
+
+        assert [t.number for t in last] == [4, 3]
+        scored = await truck.trips.aby_score(1, 3, count=2)
+
+        assert [t.number for t in scored] == [1, 2]
+        assert await truck.trips.acount(score=(1, 3)) == 3
+
+        page, cursor = await truck.trips.apage(count=3, reverse=True)
+        rest, end = await truck.trips.apage(cursor, 3, reverse=True)
+
+        assert [t.number for t in page + rest] == [4, 3, 2, 1, 0]
+        assert end is None
+
+    asyncio.run(run())
+
+
+def test_async_set_relation_bulk_operations(aeng):
+    async def run():
+        driver = await Driver(name='juan').asave()
+        cars = [await Car(plate=str(i)).asave() for i in range(3)]
+
+        await driver.cars.aadd_many(cars)
+
+        assert await driver.cars.aids() == {car.id for car in cars}
+        plates = [car.plate async for car in driver.cars.aiter(batch_size=1)]
+
+        assert sorted(plates) == ['0', '1', '2']
+
+        await driver.cars.aremove_many(cars[:1])
+
+        assert await driver.cars.acount() == 2
+        assert await (await Car.aget(cars[0].id)).driver.aget() is None
+
+        await driver.cars.aclear()
+
+        assert await driver.cars.aids() == set()
+        assert await (await Car.aget(cars[1].id)).driver.aget() is None
+
+    asyncio.run(run())
+
+
+def test_async_loads_deferred_fields_eagerly(aeng):
+    async def run():
+        driver = await Driver(name='juan').asave()
+        car = await Car(plate='A').asave()
+        await driver.cars.aadd(car)
+
+        loaded = await Car.aget(car.id, only=['driver'])
+
+        # nothing is left to be read on attribute access
+        assert loaded._deferred == frozenset()
+        assert loaded.plate == 'A'
+
+        loaded, = await Car.aget_many([car.id], defer=['plate'])
+
+        assert loaded.plate == 'A'
+        assert [c.plate for c in await Car.q().only('driver').aall()] == ['A']
+
+        with pytest.raises(AttributeError):
+            await Car.aget(car.id, only=['nonsense'])
+
+    asyncio.run(run())
@@ -0,0 +1,137 @@
+from coralillo import Engine, Model, fields
+from coralillo.cache import ObjectCache
+import pytest
+import time
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def ceng(nrm, clock):
+    return Engine(cache=ObjectCache(maxsize=3, ttl=10, clock=clock))
+
+
+def test_cache_hits_and_invalidation(ceng, clock):
+    class Ship(Model):
+        name = fields.Text()
+        code = fields.Text(index=True)
+
+        class Meta:
+            engine = ceng
+
+    cache = ceng.cache
+    ship = Ship(name='Titanic', code='TT').save()
+
+    assert Ship.get(ship.id).name == 'Titanic'
+    assert cache.stats() == {'size': 1, 'hits': 0, 'misses': 1, 'evictions': 0}
+
+    # changes made by other processes are not seen until the entry expires
+    ceng.redis.hset(ship.key(), 'name', 'Olympic')
+
+    loaded = Ship.get(ship.id)
+
+    assert loaded.name == 'Titanic'
+    assert loaded is not Ship.get(ship.id)
+    assert cache.hits == 2
+
+    clock.now = 11
+
+    assert Ship.get(ship.id).name == 'Olympic'
+
+    loaded.name = 'Britannic'
+    loaded.save()
+
+    assert Ship.get(ship.id).name == 'Britannic'
+
+    # absent objects are cached too
+    assert Ship.get('nonsense') is None
+    assert Ship.get_many(['nonsense', ship.id]) == [None, ship]
+
+    loaded.delete()
+
+    assert Ship.get(ship.id) is None
+    assert cache.evictions == 0
+
+    for i in range(4):
+        Ship.get('ship{}'.format(i))
+
+    assert cache.evictions == 3
+    assert cache.stats()['size'] == 3
+
+
+def test_cache_lookups(ceng):
+    class Ship(Model):
+        name = fields.Text()
+        code = fields.Text(index=True)
+
+        class Meta:
+            engine = ceng
+
+    cache = ceng.cache
+
+    assert Ship.get_by('code', 'TT') is None
+    assert Ship.get_by('code', 'TT') is None
+    assert cache.hits == 1
+
+    ship = Ship(name='Titanic', code='TT').save()
+
+    assert Ship.get_by('code', 'TT') == ship
+
+    hits = cache.hits
+
+    assert Ship.get_by('code', 'TT') == ship
+    assert cache.hits == hits + 2
+
+    ship.code = 'T2'
+    ship.save()
+
+    assert Ship.get_by('code', 'TT') is None
+    assert Ship.get_by('code', 'T2') == ship
+
+    hits = cache.hits
+
+    assert Ship.get_by_many('code', ['TT', 'T2']) == {'TT': None, 'T2': ship}
+    assert cache.hits == hits + 3
+
+
+def test_cache_listens_to_events(ceng):
+    class Ship(Model):
+        name = fields.Text()
+        notify = True
+
+        class Meta:
+            engine = ceng
+
+    ship = Ship(name='Titanic').save()
+    thread = ceng.cache.listen(ceng.redis)
+
+    try:
+        assert Ship.get(ship.id).name == 'Titanic'
+
+        # another process with its own cache
+        other = Engine()
+        Ship.set_engine(other)
+        Ship.get(ship.id).update(name='Olympic')
+        Ship.set_engine(ceng)
+
+        for i in range(100):
+            if Ship.get(ship.id).name == 'Olympic':
+                break
+
+            time.sleep(0.01)
+
+        assert Ship.get(ship.id).name == 'Olympic'
+    finally:
+        thread.stop()
@@ -1,6 +1,7 @@
 from coralillo import Engine, Model, fields
 from coralillo.auth import PermissionHolder
 import pytest
+import redis
 
 from .models import bound_models
 
@@ -27,3 +28,41 @@ def user(nrm):
     return User(
         name='juan',
     ).save()
+
+
+@pytest.fixture
+def round_trips(monkeypatch):
+    ''' Records the commands sent to redis, as a list with the names of the
+    commands of each round trip '''
+    recorded = []
+    execute_command = redis.Redis.execute_command
+    execute = redis.client.Pipeline.execute
+    immediate_execute_command = redis.client.Pipeline.immediate_execute_command
+
+    def counted_command(client, *args, **kwargs):
+        recorded.append([args[0]])
+
+        return execute_command(client, *args, **kwargs)
+
+    def counted_immediate_command(pipe, *args, **kwargs):
+        # sent by pipelines watching keys
+        recorded.append([args[0]])
+
+        return immediate_execute_command(pipe, *args, **kwargs)
+
+    def counted_execute(pipe, *args, **kwargs):
+        # empty pipelines are not sent
+        if len(pipe):
+            recorded.append([c[0][0] for c in pipe.command_stack])
+
+        return execute(pipe, *args, **kwargs)
+
+    monkeypatch.setattr(redis.Redis, 'execute_command', counted_command)
+    monkeypatch.setattr(
+        redis.client.Pipeline,
+        'immediate_execute_command',
+        counted_immediate_command
+    )
+    monkeypatch.setattr(redis.client.Pipeline, 'execute', counted_execute)
+
+    return recorded
@@ -222,6 +222,30 @@ def test_field_dict(nrm):
     assert c.dynamic == loaded_c.dynamic
 
 
+def test_get_many_external_fields(nrm):
+    class Dummy(Model):
+        name = Text()
+        position = Location()
+        dynamic = Dict()
+
+        class Meta:
+            engine = nrm
+
+    a = Dummy(
+        name='a',
+        position=datamodel.Location(-90, 21),
+        dynamic={'1': 'one'}
+    ).save()
+    b = Dummy(name='b', dynamic={'2': 'two'}).save()
+
+    loaded_a, loaded_b = Dummy.get_many([a.id, b.id])
+
+    assert loaded_a.position == datamodel.Location(-90, 21)
+    assert loaded_a.dynamic == {'1': 'one'}
+    assert loaded_b.position is None
+    assert loaded_b.dynamic == {'2': 'two'}
+
+
 def test_field_position_delete():
     c1 = Truck(last_position=datamodel.Location(-90, 21)).save()
     c2 = Truck(last_position=datamodel.Location(-90, 22)).save()
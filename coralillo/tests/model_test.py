@@ -1,6 +1,13 @@
 from collections.abc import Iterable
+from datetime import datetime
 from coralillo.datamodel import debyte_string
-from coralillo.errors import ModelNotFoundError
+from coralillo.errors import ModelNotFoundError, ValidationErrors
+from coralillo.errors import ImproperlyConfiguredError
+from coralillo import Model, fields
+from coralillo.core import get_fields
+from coralillo.datamodel import Location
+from coralillo.indexes import CompoundIndex
+from coralillo.bulk import ChunkSize
 from .models import House, Table, Ship, Tenanted, SideWalk, Pet
 import pytest
 
@@ -73,6 +80,278 @@ def test_filter(nrm):
     assert Pet.q().filter(name='bd').one() == pets[1]
 
 
+def test_filter_in_database(nrm):
+    class Vehicle(Model):
+        status = fields.Text(required=False)
+        speed = fields.Integer(required=False)
+        rating = fields.Float(required=False)
+        active = fields.Bool(required=False)
+        created = fields.Datetime(required=False)
+
+        class Meta:
+            engine = nrm
+
+    vehicles = [
+        Vehicle(
+            status='active', speed=90, rating=4.5, active=True,
+            created=datetime(2020, 1, 1),
+        ).save(),
+        Vehicle(
+            status='active', speed=60, rating=3.0, active=False,
+            created=datetime(2020, 2, 1),
+        ).save(),
+        Vehicle(status='idle', speed=100, active=True).save(),
+        Vehicle().save(),
+    ]
+
+    def ids(qs):
+        return sorted(obj.id for obj in qs)
+
+    def expected(*indexes):
+        return sorted(vehicles[i].id for i in indexes)
+
+    assert ids(Vehicle.q().filter(status='active')) == expected(0, 1)
+    assert ids(Vehicle.q().filter(status__ne='active')) == expected(2, 3)
+    assert ids(Vehicle.q().filter(speed__gt=80)) == expected(0, 2)
+    assert ids(
+        Vehicle.q().filter(speed__lte=90, status='active')
+    ) == expected(0, 1)
+    assert ids(Vehicle.q().filter(rating__gte=3.5)) == expected(0)
+    assert ids(Vehicle.q().filter(active=True)) == expected(0, 2)
+    assert ids(Vehicle.q().filter(active__ne=True)) == expected(1, 3)
+    assert ids(
+        Vehicle.q().filter(created__lt=datetime(2020, 1, 15))
+    ) == expected(0)
+    assert ids(Vehicle.q().filter(speed=None)) == expected(3)
+    assert ids(
+        Vehicle.q().batch(1).filter(status__startswith='act')
+    ) == expected(0, 1)
+
+
+def test_filter_range_index(nrm):
+    class Position(Model):
+        speed = fields.Integer(range_index=True, required=False)
+        created = fields.Datetime(range_index=True, required=False)
+        name = fields.Text(required=False)
+
+        class Meta:
+            engine = nrm
+
+    positions = [
+        Position(
+            speed=speed,
+            name=str(speed),
+            created=datetime(2020, 1, speed // 10)
+        ).save()
+        for speed in (50, 90, 70, 110, 80)
+    ]
+    Position(name='none').save()
+
+    assert nrm.redis.zscore('position:range_speed', positions[0].id) == 50
+
+    def speeds(qs):
+        return [obj.speed for obj in qs]
+
+    assert speeds(Position.q().filter(speed__gt=80)) == [90, 110]
+    assert speeds(Position.q().filter(speed__gte=80)) == [80, 90, 110]
+    assert speeds(Position.q().filter(speed__gt=50, speed__lt=90)) == [70, 80]
+    assert speeds(Position.q().filter(speed__gt=60).limit(2)) == [70, 80]
+    assert speeds(
+        Position.q().filter(speed__gt=60).limit(2, offset=1)
+    ) == [80, 90]
+    assert speeds(
+        Position.q().batch(1).filter(speed__gt=60, name__ne='80')
+        .limit(2, offset=1)
+    ) == [90, 110]
+    assert speeds(
+        Position.q().filter(created__gte=datetime(2020, 1, 9))
+    ) == [90, 110]
+
+    positions[1].speed = 20
+    positions[1].save()
+
+    assert speeds(Position.q().filter(speed__lt=60)) == [20, 50]
+
+    positions[1].delete()
+
+    assert nrm.redis.zscore('position:range_speed', positions[1].id) is None
+    assert speeds(Position.q().filter(speed__lt=60)) == [50]
+
+
+def test_filter_prefix_index(nrm):
+    class Plate(Model):
+        number = fields.Text(prefix_index=True)
+        state = fields.Text(required=False)
+
+        class Meta:
+            engine = nrm
+
+    plates = {
+        number: Plate(number=number, state='ver' if i % 2 else 'pue').save()
+        for i, number in enumerate(['ABC12', 'ABD34', 'AB', 'XYZ99', 'ABCD'])
+    }
+
+    def numbers(qs):
+        return [obj.number for obj in qs]
+
+    assert numbers(
+        Plate.q().filter(number__startswith='ABC')
+    ) == ['ABC12', 'ABCD']
+    assert numbers(
+        Plate.q().filter(number__startswith='AB')
+    ) == ['AB', 'ABC12', 'ABCD', 'ABD34']
+    assert numbers(
+        Plate.q().filter(number__startswith='AB', state='ver')
+    ) == ['ABD34']
+    assert numbers(
+        Plate.q().filter(number__gt='AB', number__lte='ABCD')
+    ) == ['ABC12', 'ABCD']
+    assert numbers(
+        Plate.q().filter(number__gte='AB', number__lt='ABC12')
+    ) == ['AB']
+    assert numbers(
+        Plate.q().filter(number__startswith='AB').limit(2, offset=1)
+    ) == ['ABC12', 'ABCD']
+
+    # the end of a prefix range is not valid utf8
+    plan = Plate.q().filter(number__startswith='AB').explain()
+
+    assert plan['source'] == 'ZRANGEBYLEX plate:lex_number [AB [AB\\xff'
+
+    page, cursor = Plate.q().filter(number__startswith='AB').paginate(None, 2)
+    rest, end = Plate.q().filter(number__startswith='AB').paginate(cursor, 2)
+
+    assert numbers(page + rest) == ['AB', 'ABC12', 'ABCD', 'ABD34']
+    assert end is None
+    assert numbers(
+        Plate.q().order_by('number')
+    ) == ['AB', 'ABC12', 'ABCD', 'ABD34', 'XYZ99']
+    assert numbers(
+        Plate.q().order_by('-number').limit(2)
+    ) == ['XYZ99', 'ABD34']
+    assert numbers(
+        Plate.q().filter(state='pue').order_by('-state').order_by('number')
+    ) == ['AB', 'ABC12', 'ABCD']
+
+    plate = Plate.get(plates['ABCD'].id)
+    plate.number = 'QQQ'
+    plate.save()
+
+    assert numbers(Plate.q().filter(number__startswith='ABC')) == ['ABC12']
+    assert numbers(Plate.q().filter(number__startswith='Q')) == ['QQQ']
+
+    plate.delete()
+
+    assert numbers(Plate.q().filter(number__startswith='Q')) == []
+
+
+def test_index_needs_a_suitable_field():
+    with pytest.raises(ImproperlyConfiguredError):
+        fields.Text(range_index=True)
+
+    with pytest.raises(ImproperlyConfiguredError):
+        fields.Location(range_index=True)
+
+    with pytest.raises(ImproperlyConfiguredError):
+        fields.Integer(prefix_index=True)
+
+    with pytest.raises(ImproperlyConfiguredError):
+        fields.Datetime(prefix_index=True)
+
+    assert fields.Float(range_index=True).range_index
+    assert fields.Text(prefix_index=True).prefix_index
+
+
+def test_order_by_index_keeps_null_values(nrm):
+    class Thing(Model):
+        speed = fields.Integer(range_index=True, required=False)
+        name = fields.Text(prefix_index=True, required=False)
+
+        class Meta:
+            engine = nrm
+
+    Thing(speed=5, name='a').save()
+    Thing(speed=None, name=None).save()
+
+    assert [t.speed for t in Thing.q().order_by('speed')] == [None, 5]
+    assert [t.name for t in Thing.q().order_by('-name')] == ['a', None]
+    fast = Thing.q().filter(speed__gte=0).order_by('speed')
+
+    assert [t.speed for t in fast] == [5]
+
+
+def test_order_by_without_index(nrm):
+    for number in (3, 1, 2):
+        House(number=number).save()
+
+    assert [h.number for h in House.q().order_by('number')] == [1, 2, 3]
+    houses = House.q().order_by('-number').limit(2, offset=1)
+
+    assert [h.number for h in houses] == [2, 1]
+
+
+def test_query_planner(nrm):
+    class Unit(Model):
+        code = fields.Text(index=True)
+        speed = fields.Integer(range_index=True)
+        zone = fields.TreeIndex()
+        position = fields.Location()
+
+        class Meta:
+            engine = nrm
+
+    units = [
+        Unit(
+            code='U{}'.format(i),
+            speed=i * 10,
+            zone='mx:ver' if i % 2 else 'mx:pue',
+            position=Location(-96.9 + i / 1000, 19.5),
+        ).save()
+        for i in range(10)
+    ]
+
+    plan = Unit.q().filter(code='U3', speed__gt=5).explain()
+
+    assert plan['source'] == 'HMGET unit:index_code U3'
+    assert plan['lua_filters'] == ['speed__gt']
+    assert plan['estimated_candidates'] == 1
+    assert plan['estimated_round_trips'] == 3
+    assert Unit.q().filter(code='U3', speed__gt=5).all() == [units[3]]
+    assert Unit.q().filter(code='U3', speed__gt=50).all() == []
+
+    plan = Unit.q().filter(speed__gte=80, zone='mx:ver').explain()
+
+    assert plan['source'] == 'ZRANGEBYSCORE unit:range_speed 80.0 +inf'
+    assert plan['estimated_candidates'] == 2
+    assert plan['within'] == ['unit:tree_zone:mx:ver']
+    assert plan['lua_filters'] == []
+    assert Unit.q().filter(speed__gte=80, zone='mx:ver').all() == [units[9]]
+
+    plan = Unit.q().filter(speed__gte=10, zone='mx:pue').explain()
+
+    assert plan['source'] == 'SSCAN unit:tree_zone:mx:pue'
+    assert plan['estimated_candidates'] == 5
+    found = Unit.q().filter(speed__gte=10, zone='mx:pue')
+
+    assert sorted(u.code for u in found) == ['U2', 'U4', 'U6', 'U8']
+
+    near = (Location(-96.9, 19.5), 250)
+    plan = Unit.q().filter(position__near=near).explain()
+
+    assert plan['source'].startswith('GEORADIUS unit:geo_position')
+    found = Unit.q().filter(position__near=near)
+
+    assert sorted(u.code for u in found) == ['U0', 'U1', 'U2']
+    assert Unit.q().filter(code='U1', position__near=near).all() == [units[1]]
+    assert Unit.q().filter(code='U5', position__near=near).all() == []
+
+    plan = Unit.q().filter(code__startswith='U').explain()
+
+    assert plan['source'] == 'SSCAN unit:members'
+    assert plan['lua_filters'] == ['code__startswith']
+    assert plan['estimated_round_trips'] == 3
+
+
 def test_update_keep_index(nrm):
     ship = Ship(name='the ship', code='TS').save()
 
@@ -102,6 +381,18 @@ def test_get(nrm):
     assert org == got
 
 
+def test_get_many(nrm):
+    p1 = Table(name='Juan').save()
+    p2 = Table(name='Pepe').save()
+
+    items = Table.get_many([p2.id, 'nonsense', p1.id, None])
+
+    assert items == [p2, None, p1, None]
+    assert items[0].name == 'Pepe'
+    assert items[2].name == 'Juan'
+    assert Table.get_many([]) == []
+
+
 def test_get_all(nrm):
     p1 = Table(name='Juan').save()
     p2 = Table(name='Pepe').save()
@@ -195,3 +486,522 @@ def test_recover_none_int(nrm):
 
     House.get(h.id)
     assert h.number is None
+
+
+def test_fields_added_dynamically(nrm):
+    class Dynamic(Model):
+        name = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class SubDynamic(Dynamic):
+        pass
+
+    assert [fn for fn, f in get_fields(Dynamic)] == ['name']
+
+    Dynamic.code = fields.Text(required=False)
+
+    assert [fn for fn, f in get_fields(Dynamic)] == ['code', 'name']
+    assert [fn for fn, f in get_fields(SubDynamic)] == ['code', 'name']
+
+    obj = SubDynamic(name='foo', code='bar').save()
+
+    assert SubDynamic.get(obj.id).code == 'bar'
+
+    del Dynamic.code
+
+    assert [fn for fn, f in get_fields(SubDynamic)] == ['name']
+
+
+def test_non_unique_index(nrm):
+    class Order(Model):
+        status = fields.Text(index=True, unique=False)
+        region = fields.Text(index=True, unique=False, required=False)
+        total = fields.Integer(required=False)
+        note = fields.Text(required=False)
+
+        class Meta:
+            engine = nrm
+
+    def ids(queryset):
+        return {o.id for o in queryset}
+
+    a = Order(status='open', region='north', total=10).save()
+    b = Order(status='open', region='south', total=20).save()
+    c = Order(status='closed', region='north', total=30).save()
+
+    assert nrm.redis.smembers('order:sindex_status:open') == {
+        a.id.encode(), b.id.encode(),
+    }
+
+    plan = Order.q().filter(status='open').explain()
+
+    assert plan['source'] == 'SSCAN order:sindex_status:open'
+    assert ids(Order.q().filter(status='open')) == {a.id, b.id}
+    assert Order.q().filter(status='open', region='north').all() == [a]
+    assert ids(
+        Order.q().filter(status__in=['open', 'closed'], total__gt=10)
+    ) == {b.id, c.id}
+    assert ids(Order.q().filter(region__in=['south'])) == {b.id}
+
+    # equalities on two non unique indexes intersect their sets
+    plan = Order.q().filter(status='open', region='north').explain()
+    keys = {'order:sindex_status:open', 'order:sindex_region:north'}
+
+    assert plan['lua_filters'] == plan['python_filters'] == []
+    assert {plan['source'][len('SSCAN '):]} | set(plan['within']) == keys
+    assert Order.q().filter(status='open', region='north').count() == 1
+
+    b.status = 'closed'
+    b.save()
+
+    assert nrm.redis.smembers('order:sindex_status:open') == {a.id.encode()}
+    assert ids(Order.q().filter(status='closed')) == {b.id, c.id}
+
+    c.delete()
+
+    assert nrm.redis.smembers('order:sindex_status:closed') == {b.id.encode()}
+
+    assert Order.q().count() == 2
+    assert Order.q().filter(status='closed').count() == 1
+    assert Order.q().filter(status__in=['open', 'closed']).count() == 2
+    assert Order.q().filter(status='open', total__gt=5).count() == 1
+    assert Order.q().filter(total__in=[10, 20]).count() == 2
+    assert Order.q().limit(1).count() == 1
+
+    # nothing is in an empty list, not even an empty value
+    Order(status='', region='', total=0, note='').save()
+
+    for queryset in (
+        Order.q().filter(note__in=[]),
+        Order.q().filter(region__in=[]),
+        Order.q().filter(total__in=[]),
+        Order.q().filter(status__in=[], total__gt=5),
+    ):
+        assert queryset.all() == []
+        assert queryset.count() == 0
+        assert queryset.paginate() == ([], None)
+
+
+def test_compound_indexes(nrm):
+    class Vehicle(Model):
+        tenant = fields.Text()
+        plate = fields.Text()
+        driver = fields.Text(required=False)
+        shift = fields.Integer(required=False)
+
+        class Meta:
+            engine = nrm
+            indexes = [
+                CompoundIndex('tenant', 'plate'),
+                CompoundIndex('driver', 'shift', unique=False),
+            ]
+
+    a = Vehicle(tenant='acme', plate='ABC', driver='juan', shift=1).save()
+    b = Vehicle(tenant='acme', plate='XYZ', driver='juan', shift=1).save()
+    c = Vehicle(tenant='other', plate='ABC', driver='juan', shift=2).save()
+
+    unique_key = 'vehicle:cindex_tenant_plate'
+    set_key = 'vehicle:csindex_driver_shift:juan\x001'
+
+    assert nrm.redis.hget(unique_key, 'acme\0ABC') == a.id.encode()
+    assert nrm.redis.smembers(set_key) == {a.id.encode(), b.id.encode()}
+
+    assert Vehicle.get_by(tenant='acme', plate='ABC') == a
+    assert Vehicle.get_by(plate='ABC', tenant='other') == c
+    assert Vehicle.get_by(tenant='acme', plate='QQQ') is None
+    assert Vehicle.get_by(driver='juan', shift=2) == c
+    assert Vehicle.get_by(driver='pedro', shift=2) is None
+
+    plan = Vehicle.q().filter(tenant='acme', plate='XYZ').explain()
+
+    assert plan['source'] == 'HMGET vehicle:cindex_tenant_plate acme\0XYZ'
+    assert plan['lua_filters'] == []
+    assert Vehicle.q().filter(tenant='acme', plate='XYZ').all() == [b]
+
+    plan = Vehicle.q().filter(driver='juan', shift=1, tenant='acme').explain()
+
+    assert plan['source'] == 'SSCAN vehicle:csindex_driver_shift:juan\x001'
+    assert plan['lua_filters'] == ['tenant__eq']
+    found = Vehicle.q().filter(driver='juan', shift=1, tenant='acme')
+
+    assert {v.id for v in found} == {a.id, b.id}
+
+    with pytest.raises(ValidationErrors):
+        Vehicle.validate(tenant='acme', plate='ABC')
+
+    a = Vehicle.get(a.id)
+    a.update(plate='DEF', shift=3)
+
+    assert Vehicle.get_by(tenant='acme', plate='ABC') is None
+    assert Vehicle.get_by(tenant='acme', plate='DEF') == a
+    assert nrm.redis.smembers(set_key) == {b.id.encode()}
+
+    a.delete()
+
+    assert nrm.redis.hget('vehicle:cindex_tenant_plate', 'acme\0DEF') is None
+    assert not nrm.redis.exists('vehicle:csindex_driver_shift:juan\x003')
+
+    # relations are written by their managers, so they can't be indexed
+    class Driver(Model):
+        name = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    with pytest.raises(ImproperlyConfiguredError):
+        class Shift(Model):
+            day = fields.Text()
+            driver = fields.ForeignIdRelation(Driver)
+
+            class Meta:
+                engine = nrm
+                indexes = [CompoundIndex('driver', 'day')]
+
+
+def test_save_writes_only_changed_fields(nrm):
+    class Truck(Model):
+        plate = fields.Text(index=True)
+        speed = fields.Integer(required=False)
+        extra = fields.Dict()
+
+        class Meta:
+            engine = nrm
+
+    truck = Truck(plate='ABC', speed=10, extra={'a': '1'}).save()
+
+    assert truck.dirty_fields() == set()
+
+    nrm.redis.hset(truck.key(), 'plate', 'changed elsewhere')
+
+    truck.speed = 20
+    truck.plate = 'ABC'
+
+    assert truck.dirty_fields() == {'speed'}
+
+    truck.save()
+
+    assert truck.dirty_fields() == set()
+    assert nrm.redis.hget(truck.key(), 'speed') == b'20'
+    assert nrm.redis.hget(truck.key(), 'plate') == b'changed elsewhere'
+
+    loaded = Truck.get(truck.id)
+    loaded.extra = {'b': '2'}
+    loaded.save()
+
+    assert Truck.get(truck.id).extra == {'b': '2'}
+    assert nrm.redis.hget(truck.key(), 'plate') == b'changed elsewhere'
+
+    # values changed in place are written when assigned again
+    loaded.extra['b'] = '3'
+    loaded.extra = loaded.extra
+
+    assert loaded.dirty_fields() == {'extra'}
+
+    loaded.save()
+
+    assert Truck.get(truck.id).extra == {'b': '3'}
+
+    truck.save(force=True)
+
+    assert nrm.redis.hget(truck.key(), 'plate') == b'ABC'
+    assert Truck.get_by('plate', 'ABC') == truck
+
+
+def test_reassign_indexed_datetime(nrm):
+    class Shift(Model):
+        start = fields.Datetime(index=True)
+        day = fields.Datetime(index=True, unique=False)
+
+        class Meta:
+            engine = nrm
+
+    monday, tuesday = datetime(2020, 1, 6), datetime(2020, 1, 7)
+    shift = Shift(start=monday, day=monday).save()
+
+    shift.start = tuesday
+    shift.day = tuesday
+    shift.save()
+
+    assert Shift.get_by('start', str(int(monday.timestamp()))) is None
+    assert Shift.get_by('start', str(int(tuesday.timestamp()))) == shift
+    assert Shift.q().filter(day=monday).count() == 0
+    assert Shift.q().filter(day=tuesday).count() == 1
+
+    shift.start = monday
+    shift.delete()
+
+    assert nrm.redis.hlen('shift:index_start') == 0
+    key = 'shift:sindex_day:{}'.format(int(tuesday.timestamp()))
+
+    assert not nrm.redis.exists(key)
+
+
+def test_save_many_and_delete_many(nrm):
+    class Position(Model):
+        code = fields.Text(index=True)
+        speed = fields.Integer(range_index=True)
+
+        class Meta:
+            engine = nrm
+
+    positions = [Position(code='P{}'.format(i), speed=i) for i in range(25)]
+    broken = positions[7]
+
+    # an object whose key holds a different type can't be written
+    nrm.redis.set(broken.key(), 'garbage')
+
+    errors = Position.save_many(positions, chunk_size=10)
+
+    assert len(errors) == 25
+    assert [i for i, e in enumerate(errors) if e is not None] == [7]
+    assert Position.get_by('code', 'P12') == positions[12]
+    fast = Position.q().filter(speed__gte=22)
+
+    assert [p.code for p in fast] == ['P22', 'P23', 'P24']
+    assert not broken._persisted and positions[8]._persisted
+
+    errors = Position.delete_many(
+        [positions[0], positions[1].id, 'nonsense'] +
+        [p.id for p in positions[10:]]
+    )
+
+    assert errors[:2] == [None, None]
+    assert isinstance(errors[2], ModelNotFoundError)
+    assert all(e is None for e in errors[3:])
+    assert Position.count() == 8
+    assert Position.get_by('code', 'P0') is None
+    assert Position.get_by('code', 'P12') is None
+    assert nrm.redis.zcard('position:range_speed') == 8
+
+
+def test_adaptive_chunk_size():
+    size = ChunkSize()
+
+    assert size.size == 500
+
+    size.record(1.0, 500)
+
+    assert size.size == 50
+
+    size.record(0.001, 50)
+
+    assert size.size == 100
+
+    fixed = ChunkSize(30)
+    fixed.record(1.0, 30)
+
+    assert fixed.size == 30
+
+
+def test_get_and_reload_round_trips(nrm, round_trips):
+    class Truck(Model):
+        plate = fields.Text()
+        position = fields.Location()
+        destination = fields.Location(required=False)
+        sensors = fields.Dict()
+
+        class Meta:
+            engine = nrm
+
+    truck = Truck(
+        plate='T1',
+        position=Location(-103.35, 20.72),
+        destination=Location(-99.13, 19.43),
+        sensors={'temp': 4},
+    ).save()
+
+    round_trips.clear()
+    loaded = Truck.get(truck.id)
+
+    assert round_trips == [['HGETALL', 'GEOPOS', 'GEOPOS', 'HGET']]
+    assert Truck.get('nonsense') is None
+
+    assert loaded.plate == 'T1'
+    assert loaded.destination == truck.destination
+    assert loaded.sensors == {'temp': 4}
+
+    truck.plate = 'T2'
+    truck.sensors = {'temp': 5}
+    truck.save()
+
+    loaded.plate = 'T3'
+
+    assert loaded.reload() is loaded
+    assert loaded.plate == 'T2'
+    assert loaded.sensors == {'temp': 5}
+    assert loaded.dirty_fields() == set()
+
+    truck.delete()
+
+    with pytest.raises(ModelNotFoundError):
+        loaded.reload()
+
+
+def test_only_and_defer(nrm, round_trips):
+    class Truck(Model):
+        name = fields.Text()
+        code = fields.Text(index=True)
+        speed = fields.Integer(required=False)
+        position = fields.Location()
+        sensors = fields.Dict()
+
+        class Meta:
+            engine = nrm
+
+    truck = Truck(
+        name='T1',
+        code='A1',
+        speed=10,
+        position=Location(-103.35, 20.72),
+        sensors={'temp': 4},
+    ).save()
+
+    round_trips.clear()
+    loaded = Truck.get(truck.id, only=['id', 'name'])
+
+    assert round_trips == [['HMGET']]
+    assert loaded.name == 'T1'
+    assert 'speed' not in loaded.__dict__
+
+    # the deferred fields are read together
+    assert loaded.speed == 10
+    assert loaded.position == truck.position
+    assert loaded.sensors == {'temp': 4}
+    assert round_trips[1] == ['HMGET', 'GEOPOS', 'HGET']
+    assert len(round_trips) == 2
+
+    assert Truck.get('nonsense', only=['name']) is None
+    deferred = Truck.get(truck.id, defer=['position', 'sensors'])
+
+    assert deferred.to_json() == Truck.get(truck.id).to_json()
+
+    with pytest.raises(AttributeError):
+        Truck.get(truck.id, only=['nonsense'])
+
+    # changing a deferred field keeps the index right
+    loaded = Truck.get(truck.id, only=['name'])
+    loaded.code = 'B2'
+    loaded.save()
+
+    assert Truck.get_by('code', 'A1') is None
+    assert Truck.get_by('code', 'B2') == truck
+
+    queryset = Truck.q().filter(speed__gte=5).order_by('name').only('name')
+    results = queryset.all()
+
+    assert [t.name for t in results] == ['T1']
+    assert results[0]._deferred == {'code', 'position', 'sensors'}
+    assert Truck.q().defer('sensors').all()[0]._deferred == {'sensors'}
+
+
+def test_get_by_many(nrm, round_trips):
+    devices = [
+        Ship(name='device{}'.format(i), code='IMEI{}'.format(i)).save()
+        for i in range(5)
+    ]
+
+    round_trips.clear()
+    found = Ship.get_by_many('code', ['IMEI3', 'nonsense', 'IMEI0', 'IMEI3'])
+
+    # the lookup and the objects
+    assert round_trips == [['HMGET'], ['HGETALL', 'HGETALL']]
+
+    assert found == {
+        'IMEI3': devices[3],
+        'nonsense': None,
+        'IMEI0': devices[0],
+    }
+    assert list(found) == ['IMEI3', 'nonsense', 'IMEI0']
+    assert found['IMEI0'].name == 'device0'
+    assert Ship.get_by_many('code', []) == {}
+    found = Ship.get_by_many('code', ['IMEI1'], only=['name'])
+
+    assert found['IMEI1']._deferred == {'code'}
+
+
+def test_paginate_and_iter_all(nrm):
+    class Truck(Model):
+        plate = fields.Text()
+        speed = fields.Integer(range_index=True)
+        color = fields.Text()
+
+        class Meta:
+            engine = nrm
+            ordered_members = True
+
+    trucks = [
+        Truck(
+            plate='T{:03}'.format(i),
+            speed=i,
+            color='red' if i % 3 else 'blue',
+        )
+        for i in range(100)
+    ]
+
+    Truck.save_many(trucks[:96])
+
+    for truck in trucks[96:]:
+        truck.save()
+
+    def read_pages(queryset_factory, page_size):
+        pages = []
+        cursor = None
+
+        while True:
+            page, cursor = queryset_factory().paginate(cursor, page_size)
+            pages.append([t.plate for t in page])
+
+            if cursor is None:
+                return pages
+
+    pages = read_pages(lambda: Truck.q().filter(color='red').batch(30), 20)
+    plates = [plate for page in pages for plate in page]
+
+    assert all(len(page) == 20 for page in pages[:-1])
+    assert sorted(plates) == sorted(
+        t.plate for t in trucks if t.color == 'red'
+    )
+
+    pages = read_pages(
+        lambda: Truck.q().filter(speed__gte=10).order_by('-speed').batch(7),
+        25
+    )
+
+    assert [len(page) for page in pages] == [25, 25, 25, 15]
+    assert [plate for page in pages for plate in page] == [
+        'T{:03}'.format(i) for i in range(99, 9, -1)
+    ]
+
+    # sorted in python, the cursor holds an offset
+    pages = read_pages(
+        lambda: Truck.q().filter(color='blue').order_by('plate'),
+        30
+    )
+
+    assert [plate for page in pages for plate in page] == sorted(
+        t.plate for t in trucks if t.color == 'blue'
+    )
+
+    # a cursor of another queryset
+    other = Truck.q().filter(speed__gte=10).order_by('speed')
+    page, cursor = other.paginate(None, 5)
+
+    with pytest.raises(ValueError):
+        Truck.q().filter(color='red').paginate(cursor)
+
+    plates = [t.plate for t in Truck.iter_all(batch_size=15)]
+
+    assert sorted(plates) == sorted(t.plate for t in trucks)
+
+    assert [t.plate for t in Truck.latest(3)] == ['T099', 'T098', 'T097']
+    assert [t.plate for t in Truck.latest(2, offset=2)] == ['T097', 'T096']
+    assert len(Truck.latest(200)) == 100
+
+    trucks[99].delete()
+
+    assert [t.plate for t in Truck.latest(1)] == ['T098']
+
+    with pytest.raises(ImproperlyConfiguredError):
+        Ship.latest(3)
@@ -151,6 +151,6 @@ class Log(Model):
 
 def bound_models(eng):
     for name, cls in inspect.getmembers(sys.modules[__name__]):
-        if inspect.isclass(cls):
+        if inspect.isclass(cls) and cls.__module__ == __name__:
             if issubclass(cls, Form):
                 cls.set_engine(eng)
@@ -146,3 +146,81 @@ def test_include_asterisc():
             }],
         }],
     }
+
+
+def test_to_json_many(nrm, round_trips):
+    offices = [Office(name='office{}'.format(i)).save() for i in range(3)]
+
+    for i in range(6):
+        employee = Employee(name='employee{}'.format(i)).save()
+
+        offices[i % 2].employees.add(employee)
+
+    include = ['name', 'employees.name', 'employees.office.name']
+    expected = [office.to_json(include=include) for office in offices]
+
+    round_trips.clear()
+
+    assert Office.to_json_many(offices, include=include) == expected
+    # the ids and the objects of each of the two levels
+    assert [len(commands) for commands in round_trips] == [3, 6, 6, 2]
+
+    assert Office.to_json_many([]) == []
+    assert Office.to_json_many(offices[2:]) == [offices[2].to_json()]
+
+
+def test_serializers_are_compiled_once(nrm):
+    from coralillo.core import serializer
+    from coralillo import Model, fields
+
+    class Invoice(Model):
+        number = fields.Integer()
+        issued = fields.Datetime()
+        notes = fields.Text(private=True)
+
+        class Meta:
+            engine = nrm
+
+    invoice = Invoice(number=3, notes='secret')
+
+    assert serializer(Invoice, ['number']) is serializer(Invoice, ['number'])
+    assert serializer(Invoice, None) is not serializer(Invoice, ['number'])
+    assert invoice.to_json(include=['number', 'issued']) == {
+        'number': 3,
+        'issued': None,
+    }
+
+    Invoice.total = fields.Float()
+    invoice.total = 1.5
+
+    assert invoice.to_json(include=['number', 'total']) == {
+        'number': 3,
+        'total': 1.5,
+    }
+
+
+def test_iter_json(nrm):
+    import json
+
+    office = Office(name='Fleety').save()
+    employees = [Employee(name='e{}'.format(i)).save() for i in range(5)]
+
+    office.employees.set(employees)
+
+    include = ['name', 'office.name']
+    pieces = list(Employee.q().iter_json(include=include, chunk_size=2))
+
+    assert len(pieces) == 4
+    data = sorted(json.loads(''.join(pieces)), key=lambda e: e['name'])
+
+    assert data == [e.to_json(include=include) for e in employees]
+
+    queryset = Employee.q().filter(name__in=['e1', 'e3'])
+    lines = ''.join(queryset.iter_ndjson(include=['name'])).splitlines()
+
+    data = sorted(map(json.loads, lines), key=lambda e: e['name'])
+
+    assert data == [{'name': 'e1'}, {'name': 'e3'}]
+
+    assert list(Office.q().filter(name='nonsense').iter_json()) == ['[]']
+    assert list(Office.q().filter(name='nonsense').iter_ndjson()) == []
@@ -1,7 +1,14 @@
 from collections.abc import Iterable
 from datetime import datetime
 
+from coralillo import Model, fields
+from coralillo.datamodel import Location
+from coralillo.errors import DeleteRestrictedError, ImproperlyConfiguredError
+from coralillo.fields import SetRelationManager
+from coralillo.indexes import CompoundIndex
 from .models import Pet, Person, UnattachedPerson, Driver, Car, Admin, Log
+import json
+import pytest
 
 
 def test_relation(nrm):
@@ -291,3 +298,398 @@ def test_sorted_set_relation(nrm):
 
     for log in logs:
         assert log.owner.get() is None
+
+
+def test_sorted_set_relation_ranges(nrm):
+    owner = Admin(name='Juan').save()
+    logs = [
+        Log(date=datetime(2020, 1, 1 + i // 2), data=str(i)) for i in range(10)
+    ]
+
+    Log.save_many(logs)
+
+    owner.logs.set(logs)
+
+    def data(logs):
+        return {log.data for log in logs}
+
+    # logs with the same date are in any order
+    assert data(owner.logs.range(0, 1, reverse=True)) == {'9', '8'}
+    assert data(owner.logs.range(2, 3)) == {'2', '3'}
+
+    since, until = datetime(2020, 1, 2), datetime(2020, 1, 4)
+
+    assert data(owner.logs.by_score(since, until)) == set('234567')
+    assert len(owner.logs.by_score(since, until, 1, 2)) == 2
+    last = owner.logs.by_score(since, until, count=2, reverse=True)
+
+    assert data(last) == {'6', '7'}
+    assert owner.logs.count(score=(since, until)) == 6
+    assert owner.logs.count() == 10
+
+    # pages split the logs with the same date
+    for reverse in (False, True):
+        seen = []
+        cursor = None
+
+        while True:
+            page, cursor = owner.logs.page(cursor, 3, reverse=reverse)
+            seen.extend(page)
+
+            if cursor is None:
+                break
+
+        assert sorted(log.id for log in seen) == sorted(log.id for log in logs)
+        dates = sorted((log.date for log in logs), reverse=reverse)
+
+        assert [log.date for log in seen] == dates
+
+    page, cursor = owner.logs.page(count=4)
+    owner.logs.remove(page[0])
+
+    assert data(owner.logs.page(cursor, 4)[0]) == {'4', '5', '6', '7'}
+
+
+def test_delete_round_trips(nrm, round_trips):
+    class Fleet(Model):
+        name = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class Truck(Model):
+        plate = fields.Text(index=True)
+        fleet = fields.ForeignIdRelation(Fleet, inverse='trucks')
+
+        class Meta:
+            engine = nrm
+
+    class Ping(Model):
+        speed = fields.Integer(range_index=True)
+        truck = fields.ForeignIdRelation(Truck, inverse='pings')
+
+        class Meta:
+            engine = nrm
+
+    Fleet.trucks = fields.SetRelation(
+        Truck, on_delete='cascade', inverse='fleet'
+    )
+    Truck.pings = fields.SetRelation(
+        Ping, on_delete='cascade', inverse='truck'
+    )
+
+    fleet = Fleet(name='north').save()
+
+    for i in range(3):
+        truck = Truck(plate='T{}'.format(i)).save()
+        fleet.trucks.add(truck)
+
+        for j in range(2):
+            truck.pings.add(Ping(speed=j).save())
+
+    nrm.redis.script_load(nrm.lua.cascade.script)
+
+    # the cascade script deletes the whole tree
+    round_trips.clear()
+    fleet.delete()
+
+    assert round_trips == [['EVALSHA']]
+    assert nrm.redis.keys('*') == []
+
+    # a field with a custom delete is handled in python, reading one level
+    # of cascade deletes at a time
+    class Plate(fields.Text):
+        def _delete(self, instance, redis):
+            super()._delete(instance, redis)
+
+    Ping.code = Plate(required=False)
+
+    fleet = Fleet(name='north').save()
+
+    for i in range(3):
+        truck = Truck(plate='T{}'.format(i)).save()
+        fleet.trucks.add(truck)
+
+        for j in range(2):
+            truck.pings.add(Ping(speed=j).save())
+
+    round_trips.clear()
+    fleet.delete()
+
+    # three levels of related ids, two cascade loads and the transaction
+    assert len(round_trips) == 6
+    assert nrm.redis.keys('*') == []
+
+
+def test_delete_restricted(nrm):
+    class Garage(Model):
+        name = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class Bus(Model):
+        name = fields.Text()
+        garage = fields.ForeignIdRelation(Garage, inverse='buses')
+
+        class Meta:
+            engine = nrm
+
+    Garage.buses = fields.SetRelation(
+        Bus, on_delete='restrict', inverse='garage'
+    )
+
+    garage = Garage(name='main').save()
+    bus = Bus(name='b1').save()
+    garage.buses.add(bus)
+
+    with pytest.raises(DeleteRestrictedError):
+        garage.delete()
+
+    assert Garage.get(garage.id) is not None
+    assert bus in garage.buses
+
+    errors = Garage.delete_many([garage])
+
+    assert isinstance(errors[0], DeleteRestrictedError)
+
+    bus.delete()
+
+    assert Garage.get(garage.id).buses.count() == 0
+
+    garage.delete()
+
+    assert Garage.get(garage.id) is None
+
+
+def test_cascade_script_cleans_indexes(nrm):
+    class Depot(Model):
+        name = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class Crate(Model):
+        code = fields.Text(index=True)
+        status = fields.Text(index=True, unique=False)
+        label = fields.Text(prefix_index=True)
+        weight = fields.Integer(range_index=True)
+        zone = fields.TreeIndex()
+        position = fields.Location()
+        extra = fields.Dict()
+        depot = fields.ForeignIdRelation(Depot, inverse='crates')
+        notify = True
+
+        class Meta:
+            engine = nrm
+            indexes = [CompoundIndex('code', 'status')]
+
+    class Shelf(Model):
+        name = fields.Text()
+        crates = fields.SetRelation(Crate, inverse='shelf')
+
+        class Meta:
+            engine = nrm
+
+    Crate.shelf = fields.ForeignIdRelation(Shelf, inverse='crates')
+    Depot.crates = fields.SetRelation(
+        Crate, on_delete='cascade', inverse='depot'
+    )
+
+    depot = Depot(name='main').save()
+    shelf = Shelf(name='s1').save()
+    crate = Crate(
+        code='C1', status='new', label='fragile', weight=3, zone='mx:ver',
+        position=Location(-96.9, 19.5), extra={'a': '1'},
+    ).save()
+    depot.crates.add(crate)
+    shelf.crates.add(crate)
+
+    p = nrm.redis.pubsub(ignore_subscribe_messages=True)
+    p.psubscribe('crate')
+
+    depot.delete()
+
+    message = next(p.listen())
+
+    event = json.loads(message['data'].decode('utf8'))
+    position = event['data'].pop('position')
+    expected = crate.to_json()
+
+    del expected['position']
+
+    # the external fields are read by the script too
+    assert event == {'event': 'delete', 'data': expected}
+    assert position == pytest.approx(crate.to_json()['position'])
+
+    p.unsubscribe()
+
+    # only the shelf remains, without the crate
+    assert {k.decode() for k in nrm.redis.keys('*')} == {
+        'shelf:members', 'shelf:{}:obj'.format(shelf.id),
+    }
+
+
+def test_set_expressions(nrm, round_trips):
+    class Truck(Model):
+        plate = fields.Text()
+        status = fields.Text(index=True, unique=False)
+
+        class Meta:
+            engine = nrm
+
+    class Fleet(Model):
+        trucks = fields.SetRelation(Truck)
+
+        class Meta:
+            engine = nrm
+
+    class Group(Model):
+        trucks = fields.SetRelation(Truck)
+
+        class Meta:
+            engine = nrm
+
+    a, b, c, d = [
+        Truck(plate=p, status=s).save()
+        for p, s in zip('abcd', ['ok', 'broken', 'ok', 'ok'])
+    ]
+    fleet = Fleet().save()
+    group = Group().save()
+    fleet.trucks.set([a, b, c])
+    group.trucks.set([b, c, d])
+
+    round_trips.clear()
+
+    assert (fleet.trucks & group.trucks).count() == 2
+    assert round_trips == [['SINTERSTORE', 'EXPIRE', 'SCARD']]
+
+    assert (fleet.trucks | group.trucks).ids() == {a.id, b.id, c.id, d.id}
+    assert (fleet.trucks - group.trucks).ids() == {a.id}
+    ok = Truck.indexed('status', 'ok')
+    broken = Truck.indexed('status', 'broken')
+
+    assert (fleet.trucks & group.trucks & ok).ids() == {c.id}
+    assert (Truck.expression() - fleet.trucks).ids() == {d.id}
+    only_one = (fleet.trucks - group.trucks) | (group.trucks - fleet.trucks)
+
+    assert only_one.ids() == {a.id, d.id}
+    assert (fleet.trucks - (group.trucks - broken)).ids() == {a.id, b.id}
+
+    # nested operations of the same kind are a single command
+    expr = fleet.trucks & group.trucks & Truck.indexed('status', 'ok')
+
+    assert len(expr.operands) == 3
+
+    qs = (fleet.trucks | group.trucks).q().filter(status='ok')
+
+    assert sorted(t.plate for t in qs) == ['a', 'c', 'd']
+
+    key = expr.store(ttl=30)
+
+    assert key == expr.result_key()
+    assert 0 < nrm.redis.ttl(key) <= 30
+    same = fleet.trucks & group.trucks
+
+    assert same.result_key() == (fleet.trucks & group.trucks).result_key()
+
+    with pytest.raises(TypeError):
+        fleet.trucks & Fleet.expression()
+
+    with pytest.raises(TypeError):
+        fleet.trucks & 'nonsense'
+
+    with pytest.raises(ImproperlyConfiguredError):
+        Truck.indexed('plate', 'a')
+
+
+def test_set_relation_bulk_operations(nrm, round_trips):
+    class Truck(Model):
+        plate = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class Group(Model):
+        name = fields.Text()
+        trucks = fields.SetRelation(Truck, inverse='group')
+
+        class Meta:
+            engine = nrm
+
+    Truck.group = fields.ForeignIdRelation(Group, inverse='trucks')
+
+    group = Group(name='maintenance').save()
+    trucks = [Truck(plate=str(i)) for i in range(7)]
+
+    Truck.save_many(trucks)
+
+    round_trips.clear()
+    group.trucks.add_many(trucks)
+
+    assert round_trips == [['SADD'] + ['HSET'] * 7]
+    assert group.trucks.ids() == {t.id for t in trucks}
+    assert Truck.get(trucks[0].id).group.get() == group
+
+    plates = [t.plate for t in group.trucks.iter(batch_size=2)]
+
+    assert sorted(plates) == [str(i) for i in range(7)]
+
+    group.trucks.remove_many(trucks[:2])
+
+    assert group.trucks.ids() == {t.id for t in trucks[2:]}
+    assert Truck.get(trucks[0].id).group.get() is None
+
+    round_trips.clear()
+    group.trucks.clear()
+
+    # the ids are read and the relations removed without loading the trucks
+    assert round_trips == [['WATCH'], ['SMEMBERS'], ['DEL'] + ['HDEL'] * 5]
+    assert group.trucks.ids() == set()
+    assert all(Truck.get(t.id).group.get() is None for t in trucks)
+
+
+def test_clear_retries_when_the_relation_changes(nrm, monkeypatch):
+    class Truck(Model):
+        plate = fields.Text()
+
+        class Meta:
+            engine = nrm
+
+    class Group(Model):
+        name = fields.Text()
+        trucks = fields.SetRelation(Truck, inverse='group')
+
+        class Meta:
+            engine = nrm
+
+    Truck.group = fields.ForeignIdRelation(Group, inverse='trucks')
+
+    group = Group(name='maintenance').save()
+    first = Truck(plate='first').save()
+    late = Truck(plate='late').save()
+
+    group.trucks.add(first)
+
+    get_related_ids = SetRelationManager.get_related_ids
+    reads = []
+
+    def concurrent_add(manager, redis):
+        ids = get_related_ids(manager, redis)
+
+        # another client adds a truck after the ids are read
+        if not reads:
+            group.trucks.add(late)
+
+        reads.append(ids)
+
+        return ids
+
+    monkeypatch.setattr(SetRelationManager, 'get_related_ids', concurrent_add)
+
+    group.trucks.clear()
+
+    assert len(reads) == 2
+    assert group.trucks.ids() == set()
+    assert Truck.get(first.id).group.get() is None
+    assert Truck.get(late.id).group.get() is None
@@ -0,0 +1,121 @@
+from coralillo import Model, fields
+from threading import Thread
+import pytest
+
+
+class Fleet(Model):
+    name = fields.Text(index=True)
+    trucks = fields.SetRelation(
+        'coralillo.tests.session_test.Truck',
+        inverse='fleet'
+    )
+
+
+class Truck(Model):
+    plate = fields.Text()
+    fleet = fields.ForeignIdRelation(Fleet, inverse='trucks')
+
+
+@pytest.fixture
+def fleet(nrm):
+    Fleet.set_engine(nrm)
+    Truck.set_engine(nrm)
+
+    fleet = Fleet(name='north').save()
+
+    fleet.trucks.set([Truck(plate='A').save(), Truck(plate='B').save()])
+
+    return fleet
+
+
+def test_identity_map(nrm, fleet, round_trips):
+    with nrm.session():
+        loaded = Fleet.get(fleet.id)
+        a, b = sorted(loaded.trucks.all(), key=lambda t: t.plate)
+
+        round_trips.clear()
+
+        assert Fleet.get(fleet.id) is loaded
+        assert Fleet.get_by('name', 'north') is loaded
+        assert a.fleet.get() is loaded
+        assert b.fleet.get() is loaded
+        assert Truck.get(a.id) is a
+        assert Truck.get_many([b.id, 'nonsense', a.id]) == [b, None, a]
+        assert Truck.get_many([b.id, a.id])[1] is a
+
+        # only the index lookup, the related ids and the missing object
+        assert round_trips == [['HGET'], ['HGET'], ['HGET'], ['HGETALL']]
+
+    assert Fleet.get(fleet.id) is not Fleet.get(fleet.id)
+
+
+def test_writes_flushed_at_the_end(nrm, fleet):
+    with nrm.session() as session:
+        loaded = Fleet.get(fleet.id)
+        loaded.name = 'south'
+        loaded.save()
+
+        truck = Truck(plate='C').save()
+
+        assert Truck.get(truck.id) is truck
+        assert not nrm.redis.exists(truck.key())
+        assert nrm.redis.hget(fleet.key(), 'name') == b'north'
+
+        session.flush()
+
+        assert nrm.redis.exists(truck.key())
+
+        truck.plate = 'D'
+        truck.save()
+
+    assert Fleet.get(fleet.id).name == 'south'
+    assert Fleet.get_by('name', 'south') == fleet
+    assert Truck.get(truck.id).plate == 'D'
+    assert loaded.dirty_fields() == set()
+
+
+def test_session_discards_writes_on_error(nrm, fleet):
+    with pytest.raises(ValueError):
+        with nrm.session():
+            loaded = Fleet.get(fleet.id)
+            loaded.name = 'south'
+            loaded.save()
+
+            raise ValueError()
+
+    assert Fleet.get(fleet.id).name == 'north'
+
+
+def test_session_forgets_deleted(nrm, fleet):
+    with nrm.session():
+        truck = Truck.get(fleet.trucks.all()[0].id)
+        truck.plate = 'Z'
+        truck.save()
+        truck.delete()
+
+        assert Truck.get(truck.id) is None
+
+    assert Truck.get(truck.id) is None
+
+
+def test_session_is_per_thread(nrm, fleet):
+    found = []
+
+    with nrm.session():
+        loaded = Fleet.get(fleet.id)
+
+        thread = Thread(target=lambda: found.append(Fleet.get(fleet.id)))
+        thread.start()
+        thread.join()
+
+        assert found[0] == loaded
+        assert found[0] is not loaded
+
+
+def test_missing_ids(nrm, fleet):
+    with nrm.session() as session:
+        loaded = Fleet.get(fleet.id)
+        ids = ['b', loaded.id, 'a', 'b', None, 'a'] * 1000
+
+        assert session.missing(Fleet, ids) == ['b', 'a']
+        assert session.missing(Truck, [loaded.id]) == [loaded.id]
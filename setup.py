@@ -45,11 +45,13 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
 
+    # sessions rely on contextvars and on the order of dicts
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='redis database mapper',
 
@@ -72,6 +74,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': [],
+        'asyncio': ['redis>=4.2'],
     },
 
     setup_requires=['pytest-runner'],